@@ -1 +1,11 @@
 from .pyn_aod import *
+from .pyn_stack import *
+from .pyn_sweep import *
+from .pyn_montecarlo import *
+from .pyn_nav import *
+from .pyn_limits import *
+from .pyn_precision import *
+from .pyn_record import *
+from .pyn_timing import *
+from .pyn_saturation import *
+from .pyn_upperlimits import *
@@ -1,42 +1,104 @@
+import logging
 import numpy as np
-from scipy import interpolate
 import matplotlib.pyplot as plt
+from .pyn_cache import GridCache, readonly
+from .pyn_precision import low_memory, pyn_precision
+from .pyn_record import logger, pyn_measurement, log_measurement, \
+    _verbose_report
+from .pyn_timing import timed, stage
 # Assumptions:
 #
 #  -- Arrays are passed as velocity, flux
 #  -- Velocity spacing is constant (enough)
 
+# Memoized pixel spacings and integration weights, keyed on the grid
+_weights_cache = GridCache(maxsize=256)
+
 
 def fix_unwriteable_spec(spec):
     # FIX NON-WRITEABLE ARRAYS due to discontiguous memory
+    #  Only the read-only arrays are copied.
     for kkk in spec.keys():
         if isinstance(spec[kkk],(np.ndarray)):
-            spec[kkk] = spec[kkk].copy()
+            if not spec[kkk].flags.writeable:
+                spec[kkk] = spec[kkk].copy()
 
     return spec
 
-def integration_weights(x,limits):
-    # Calculate the weighting for each pixel in the column density integration.
-    #  Includes partial pixel weighting for edge effects.
+def _output_spec(spec_in, inplace=False):
+    # The dictionary the measurements are written to. By default this is a
+    #  shallow copy of the input with any read-only (readsav) arrays copied.
+    #  With inplace=True the input dictionary itself is filled in and its
+    #  arrays are used as they are, read-only or not.
+    if inplace:
+        return spec_in
 
-    # Pixel number array
-    pix_num_array = np.arange(len(x))
+    spec = spec_in.copy()
+
+    # FIX NON-WRITEABLE ARRAYS due to discontiguous
+    # memory in some readsav inputs
+    spec = fix_unwriteable_spec(spec)
+
+    return spec
+
+def _pixel_spacing(x):
+    # Pixel spacing (median), memoized per grid.
+    delx = _weights_cache.lookup(x, 'pixel_spacing')
+    if delx is None:
+        delx = np.median(np.roll(x,-1)-x)
+        _weights_cache.store(x, delx, 'pixel_spacing')
+
+    return delx
+
+def _full_pixel_range(x, delx, limits):
+    # Find the pixels [first, stop) that are fully within our integration
+    #  range, x-delx/2 >= limits[0] and x+delx/2 < limits[1], by binary
+    #  search. The search is done on x itself; the result is then nudged
+    #  to satisfy the exact inequalities, which can differ from the
+    #  rearranged ones by rounding.
+    npix = len(x)
+
+    first = np.searchsorted(x, limits[0]+delx/2, 'left')
+    while (first > 0) and (x[first-1]-delx/2 >= limits[0]):
+        first -= 1
+    while (first < npix) and not (x[first]-delx/2 >= limits[0]):
+        first += 1
+
+    stop = np.searchsorted(x, limits[1]-delx/2, 'left')
+    while (stop < npix) and (x[stop]+delx/2 < limits[1]):
+        stop += 1
+    while (stop > 0) and not (x[stop-1]+delx/2 < limits[1]):
+        stop -= 1
+
+    return first, stop
+
+def _integration_weights(x, limits, delx = None):
+    # The weights of integration_weights, memoized on the grid, the limits
+    #  and the pixel spacing (by default the median spacing of x). The
+    #  returned array is shared and read-only.
+    key = ('integration_weights',
+            type(limits[0]), float(limits[0]),
+            type(limits[1]), float(limits[1]), delx)
+    weights = _weights_cache.lookup(x, *key)
+    if weights is not None:
+        return weights
 
     # Pixel spacing
-    delx = np.median(np.roll(x,-1)-x)
+    if delx is None:
+        delx = _pixel_spacing(x)
 
     # Find the pixels that are fully within our integration range.
-    idx = ((x-delx/2 >= limits[0]) & (x+delx/2 < limits[1]))
-    weights = idx*1.0
+    first, stop = _full_pixel_range(x, delx, limits)
+    if stop <= first:
+        raise ValueError('No complete pixels within the integration limits.')
 
-    # Limits of complete pixels in indices.
-    pix_limits = [np.min(pix_num_array[idx]),
-                    np.max(pix_num_array[idx])]
+    weights = np.zeros(len(x))
+    weights[first:stop] = 1.0
 
     # Calculate fractions of edge pixels in the integration:
     # Identify edge pixels
-    lo_pix = pix_limits[0]-1
-    hi_pix = pix_limits[1]+1
+    lo_pix = first-1
+    hi_pix = stop
 
     # Fraction of edge pixels contained within integration ranges
     lo_frac = ((x[lo_pix]+delx/2)-limits[0])/(delx)
@@ -46,8 +108,21 @@ def integration_weights(x,limits):
     weights[lo_pix] = lo_frac
     weights[hi_pix] = hi_frac
 
+    weights = readonly(weights)
+    _weights_cache.store(x, weights, *key)
+
     return weights
 
+@timed()
+def integration_weights(x,limits):
+    # Calculate the weighting for each pixel in the column density integration.
+    #  Includes partial pixel weighting for edge effects.
+    #
+    #  The weights are memoized on the grid and the limits; each call
+    #  returns its own copy.
+
+    return _integration_weights(x, limits).copy()
+
 
 def xlimit(x, limits):
     # Determine the integration limits for integer pixel integrations.
@@ -55,8 +130,10 @@ def xlimit(x, limits):
     def _ret():  return idx1, idx2
 
     # To be consistent with iNorm, we use x>=xmin, x<xmax
-    idx1 = np.asarray(x >= limits[0]).nonzero()[0][0]
-    idx2 = np.asarray(x > limits[1]).nonzero()[0][0]-1
+    idx1 = np.searchsorted(x, limits[0], 'left')
+    idx2 = np.searchsorted(x, limits[1], 'right')-1
+    if (idx1 >= len(x)) or (idx2 >= len(x)-1):
+        raise IndexError('Integration limits fall outside the pixel grid.')
 
     return _ret()
 
@@ -147,59 +224,85 @@ def integrate_column(velocity, flux, flux_err,
     return column, column_err_total, flag_sat
 
 
-def pyn_column(spec_in, integration_limits = None,
-                partial_pixels = True):
+def _spectrum_arrays(spec):
+    # Extract the arrays used by the AOD measurements,
+    #  resolving the old-style continuum keywords. The arrays are
+    #  only read, so no copies are made.
 
-    spec = spec_in.copy()
-
-    # FIX NON-WRITEABLE ARRAYS due to discontiguous
-    # memory in some readsav inputs
-    if ~spec['vel'].flags.writeable:
-        spec = fix_unwriteable_spec(spec)
-
-    # Make sure there are integration limits:
-    if integration_limits is None:
-        integration_limits = [spec['v1'],spec['v2']]
-
-    # Some constants and flags
-    column_factor = 2.654e-15
-    flag_sat = False
-
-    velocity = spec['vel'].copy()
-    flux = spec['flux'].copy()
-    flux_err = spec['eflux'].copy()
-    wavc=spec['wavc'].copy()
-    fval=spec['fval'].copy()
+    velocity = spec['vel']
+    flux = spec['flux']
+    flux_err = spec['eflux']
+    wavc=spec['wavc']
+    fval=spec['fval']
 
     # Deal with the continuum:
     if "contin" in spec.keys():
-        continuum=spec['contin'].copy()
+        continuum=spec['contin']
     else:
         try:
-            continuum=spec['cont'].copy()
+            continuum=spec['cont']
         except:
-            continuum=spec['ycon'].copy()
+            continuum=spec['ycon']
 
     if "contin_err" in spec.keys():
-        continuum_err = spec['contin_err'].copy()
+        continuum_err = spec['contin_err']
     else:
         try:
-            continuum_err = spec['econt'].copy()
+            continuum_err = spec['econt']
         except:
-            continuum_err = spec['ycon_sig'].copy()
+            continuum_err = spec['ycon_sig']
 
-    # Work out partial pixel weighting
-    weights = integration_weights(velocity,integration_limits)
+    return velocity, flux, flux_err, wavc, fval, continuum, continuum_err
+
+
+def _pixel_weights(velocity, integration_limits, partial_pixels,
+                    delx = None):
+    # Work out partial pixel weighting (delx: the pixel spacing, if not
+    #  that of velocity itself)
+    if partial_pixels:
+        weights = _integration_weights(velocity,integration_limits,
+                                        delx).copy()
     # Uniform weighting if not partial pixel weighting
-    if not partial_pixels:
+    else:
         weights = np.zeros_like(velocity)
         xlim1, xlim2 = xlimit(velocity,integration_limits)
         weights[xlim1:xlim2+1] = 1.0
 
+    return weights
+
+
+def _velocity_spacing(velocity):
     # An array of delta v:
     delv = velocity[1:]-velocity[:-1]
     delv = np.concatenate((delv,[delv[-1]]))
 
+    return delv
+
+
+def _convert_efnorm(spec):
+    # Rename the old-style normalized flux errors. They carry no
+    #  continuum part; the zeros are allocated, not written.
+    if 'efnorm' in spec.keys():
+        spec['fnorm_err'] = spec['efnorm']
+        spec['fnorm_err_contin'] = np.zeros(np.shape(spec['efnorm']),
+                                    dtype=np.result_type(spec['efnorm'], 0.))
+        spec['fnorm_err_stat'] = spec['efnorm']
+
+        del spec['efnorm']
+        del spec['efnorm1']
+        del spec['efnorm2']
+
+    return spec
+
+
+def _fill_column(spec, integration_limits, velocity, flux, flux_err,
+                    wavc, fval, continuum, continuum_err, weights, delv):
+    # Apparent column density calculations; fills the pyn_column outputs.
+
+    # Some constants and flags
+    column_factor = 2.654e-15
+    flag_sat = False
+
     # Test for clearly saturated pixels:
     #   -- If the idx_saturation is already filled, use the results:
     try:
@@ -208,8 +311,8 @@ def pyn_column(spec_in, integration_limits = None,
         idx_saturation = (flux <= 0.)
 
     # Fix saturation if it's present.
-    flux[idx_saturation] = np.abs(flux[idx_saturation])
-    flux[(flux==0)] = 2.*flux_err[(flux==0)]
+    flux = np.where(idx_saturation, np.abs(flux), flux)
+    flux = np.where((flux==0), 2.*flux_err, flux)
 
     # Set overall saturation flag for saturation in the integration range
     if (idx_saturation*weights).sum() > 0:
@@ -296,14 +399,7 @@ def pyn_column(spec_in, integration_limits = None,
     #     spec['detection_3sig'] = False
 
 
-    if 'efnorm' in spec.keys():
-        spec['fnorm_err'] = spec['efnorm']
-        spec['fnorm_err_contin'] = spec['efnorm']*0.
-        spec['fnorm_err_stat'] = spec['efnorm']
-
-        del spec['efnorm']
-        del spec['efnorm1']
-        del spec['efnorm2']
+    spec = _convert_efnorm(spec)
 
 
     try:
@@ -316,64 +412,39 @@ def pyn_column(spec_in, integration_limits = None,
     return spec
 
 
-def pyn_eqwidth(spec_in,integration_limits = None,
-                partial_pixels = True):
-
-    spec = spec_in.copy()
+@timed()
+def pyn_column(spec_in, integration_limits = None,
+                partial_pixels = True, inplace = False):
 
-    # FIX NON-WRITEABLE ARRAYS due to discontiguous
-    # memory in some readsav inputs
-    if ~spec['vel'].flags.writeable:
-        spec = fix_unwriteable_spec(spec)
+    spec = _output_spec(spec_in, inplace)
 
     # Make sure there are integration limits:
     if integration_limits is None:
         integration_limits = [spec['v1'],spec['v2']]
 
-    # Some constants and flags
-    column_factor = 2.654e-15
-    ew_factor = 1.13e17
-    lightspeed = 2.998e5 # km/s
+    velocity, flux, flux_err, wavc, fval, continuum, continuum_err = \
+        _spectrum_arrays(spec)
 
-    velocity = spec['vel'].copy()
-    flux = spec['flux'].copy()
-    flux_err = spec['eflux'].copy()
-    wavc=spec['wavc'].copy()
-    fval=spec['fval'].copy()
+    weights = _pixel_weights(velocity, integration_limits, partial_pixels)
+    delv = _velocity_spacing(velocity)
 
-    # Deal with the continuum
-    if "contin" in spec.keys():
-        continuum=spec['contin'].copy()
-    else:
-        try:
-            continuum=spec['cont'].copy()
-        except:
-            continuum=spec['ycon'].copy()
+    spec = _fill_column(spec, integration_limits, velocity, flux, flux_err,
+                wavc, fval, continuum, continuum_err, weights, delv)
 
-    if "contin_err" in spec.keys():
-        continuum_err = spec['contin_err'].copy()
-    else:
-        try:
-            continuum_err = spec['econt'].copy()
-        except:
-            continuum_err = spec['ycon_sig'].copy()
+    return spec
 
 
-    # Define the limits of the integration:
-    if not integration_limits:
-        integration_limits = [spec['v1'],spec['v2']]
+def _fill_eqwidth(spec, integration_limits, velocity, flux, flux_err,
+                    continuum, continuum_err, weights):
+    # Equivalent width calculations; fills the pyn_eqwidth outputs.
 
-    # Work out partial pixel weighting
-    weights = integration_weights(velocity,integration_limits)
-    # Uniform weighting if not partial pixel weighting
-    if not partial_pixels:
-        weights = np.zeros_like(velocity)
-        xlim1, xlim2 = xlimit(velocity,integration_limits)
-        weights[xlim1:xlim2+1] = 1.0
+    # Some constants and flags
+    ew_factor = 1.13e17
+    lightspeed = 2.998e5 # km/s
 
     # Create the wavelength array
     try:
-        wave=spec['wave'].copy()
+        wave=spec['wave']
     except:
         wave = spec['wavc']*(velocity/lightspeed)+spec['wavc']
         spec['wave'] = wave
@@ -460,72 +531,72 @@ def pyn_eqwidth(spec_in,integration_limits = None,
     return spec
 
 
-def pyn_istat(spec_in,integration_limits = None,
-                partial_pixels = True):
+@timed()
+def pyn_eqwidth(spec_in,integration_limits = None,
+                partial_pixels = True, inplace = False):
 
-    spec = spec_in.copy()
-    # FIX NON-WRITEABLE ARRAYS due to discontiguous
-    # memory in some readsav inputs
-    if ~spec['vel'].flags.writeable:
-        spec = fix_unwriteable_spec(spec)
+    spec = _output_spec(spec_in, inplace)
 
     # Make sure there are integration limits:
     if integration_limits is None:
         integration_limits = [spec['v1'],spec['v2']]
 
-    # Some constants and flags
-    column_factor = 2.654e-15
-    ew_factor = 1.13e17
-    lightspeed = 2.998e5 # km/s
-
-    velocity = spec['vel'].copy()
-    flux = spec['flux'].copy()
-    flux_err = spec['eflux'].copy()
-    wavc=spec['wavc'].copy()
-    fval=spec['fval'].copy()
-
-    # Deal with the continuum
-    if "contin" in spec.keys():
-        continuum=spec['contin'].copy()
-    else:
-        try:
-            continuum=spec['cont'].copy()
-        except:
-            continuum=spec['ycon'].copy()
-
-    if "contin_err" in spec.keys():
-        continuum_err = spec['contin_err'].copy()
-    else:
-        try:
-            continuum_err = spec['econt'].copy()
-        except:
-            continuum_err = spec['ycon_sig'].copy()
-
+    velocity, flux, flux_err, wavc, fval, continuum, continuum_err = \
+        _spectrum_arrays(spec)
 
     # Define the limits of the integration:
     if not integration_limits:
         integration_limits = [spec['v1'],spec['v2']]
 
-    # Work out partial pixel weighting
-    weights = integration_weights(velocity,integration_limits)
-    # Uniform weighting if not partial pixel weighting
-    if not partial_pixels:
-        weights = np.zeros_like(velocity)
-        xlim1, xlim2 = xlimit(velocity,integration_limits)
-        weights[xlim1:xlim2+1] = 1.0
+    weights = _pixel_weights(velocity, integration_limits, partial_pixels)
 
-    # An array of delta v:
-    delv = velocity[1:]-velocity[:-1]
-    delv = np.concatenate((delv,[delv[-1]]))
+    spec = _fill_eqwidth(spec, integration_limits, velocity, flux, flux_err,
+                continuum, continuum_err, weights)
+
+    return spec
+
+
+def _v90_velocity(velocity, tau_cum, tau_tot, frac, grid_start = None):
+    # Velocity of the (first) pixel whose cumulative optical depth is
+    #  closest to frac of the total.
+    #
+    #  grid_start: if velocity is a window of a longer grid, the velocity
+    #  of the first pixel of that grid. The pixels before the window have
+    #  no weight (zero cumulative optical depth) and come first, so the
+    #  search covers them as it would on the full grid; those after it
+    #  repeat the last cumulative value and can never come first.
+    dist = np.abs(tau_cum/tau_tot-frac)
+    idx = dist.argmin()
+    if grid_start is None:
+        return velocity[idx]
+
+    # argmin takes the first minimum, treating NaN as the minimum.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dist_before = np.abs(0./tau_tot-frac)
+    if np.isnan(dist_before) or \
+        (not np.isnan(dist[idx]) and (dist_before <= dist[idx])):
+        return grid_start
+    return velocity[idx]
+
+
+def _moments(velocity, flux, flux_err, continuum, continuum_err,
+                weights, delv):
+    # Velocity moments of the apparent optical depth along the last axis:
+    #  the kernel of pyn_istat, shared with the stacks of pyn_stack (one
+    #  row per transition). Returns va, va_err, ba, ba_err, m3, m3_err,
+    #  the cumulative and the total optical depth; the sums keep their
+    #  axis, so the moments broadcast against the pixel arrays.
+
+    def _sum(x):  return np.sum(x, axis=-1, keepdims=True)
 
     # TODO: Saturation?
     # Calculate the zeroth moment
     tau = np.log(np.abs(continuum/flux))
-    tau_tot = np.sum(tau*delv*weights)
+    tau_tot = _sum(tau*delv*weights)
 
     # M1
     # Calculate the first moment (average velocity)
-    a = np.sum(tau*velocity*delv*weights)
+    a = _sum(tau*velocity*delv*weights)
     m1 = a/tau_tot
 
     # M1 error
@@ -537,14 +608,14 @@ def pyn_istat(spec_in,integration_limits = None,
     dm1di = (tau_tot * dadi - a * dwdi) / tau_tot**2
     dm1dc = (tau_tot * dadc - a * dwdc) / tau_tot**2
 
-    q1 = np.sqrt(np.sum((flux_err*weights)**2 * dm1di**2))
-    q2 = np.sum(np.sqrt((continuum_err*weights)**2 * dm1dc**2))
+    q1 = np.sqrt(_sum((flux_err*weights)**2 * dm1di**2))
+    q2 = _sum(np.sqrt((continuum_err*weights)**2 * dm1dc**2))
 
     m1err = np.sqrt(q1**2 + q2**2)
 
     # M2
     # Calculate the second moment (width)
-    bsqared = np.sum(tau*(velocity-m1)**2*delv*weights)
+    bsqared = _sum(tau*(velocity-m1)**2*delv*weights)
     m2 = np.sqrt(bsqared/tau_tot)
 
     # M2 error
@@ -556,9 +627,9 @@ def pyn_istat(spec_in,integration_limits = None,
     dm2dc = (tau_tot * dbdc - bsqared*dwdc) / tau_tot**2
     dm2dm1 = dbdm1 / tau_tot
 
-    q1 = np.sqrt(np.sum((flux_err*weights)**2 * dm2di**2))
-    q2 = np.sum(np.sqrt((continuum_err*weights)**2 * dm2dc**2))
-    q3 = np.sqrt(np.sum(m1err**2 * dm2dm1**2))
+    q1 = np.sqrt(_sum((flux_err*weights)**2 * dm2di**2))
+    q2 = _sum(np.sqrt((continuum_err*weights)**2 * dm2dc**2))
+    q3 = np.sqrt(_sum(m1err**2 * dm2dm1**2))
 
     m2err = np.sqrt(q1**2 + q2**2 + q3**2)
     m2err = m2err / (2.*m2)
@@ -568,7 +639,7 @@ def pyn_istat(spec_in,integration_limits = None,
 
     # M3
     # Calculate the third moment (skewness)
-    c = np.sum(tau*weights*((velocity*weights - m1)/m2)**3*delv*weights)
+    c = _sum(tau*weights*((velocity*weights - m1)/m2)**3*delv*weights)
     m3 = c/tau_tot
 
     # M3 error
@@ -582,53 +653,48 @@ def pyn_istat(spec_in,integration_limits = None,
     dm3dm1 = dfdm1 / tau_tot
     dm3dm2 = dfdm2 / tau_tot
 
-    q1 = np.sqrt(np.sum((flux_err*weights)**2 * dm3di**2))
-    q2 = np.sum(np.sqrt((continuum_err*weights)**2 * dm3dc**2))
-    q3 = np.sqrt(np.sum(m1err**2 * dm3dm1**2))
-    q4 = np.sqrt(np.sum(m2err**2 * dm3dm2**2))
+    q1 = np.sqrt(_sum((flux_err*weights)**2 * dm3di**2))
+    q2 = _sum(np.sqrt((continuum_err*weights)**2 * dm3dc**2))
+    q3 = np.sqrt(_sum(m1err**2 * dm3dm1**2))
+    q4 = np.sqrt(_sum(m2err**2 * dm3dm2**2))
 
     m3err = np.sqrt(q1**2 + q2**2 + q3**2 + q4**2)
 
-    # Calculate the extent (same as m2, except that m1 is assumed to be 0)
-    b4 = np.sum(tau*(velocity*weights - 0)**2*delv*weights)
-    m4 = np.sqrt(b4/tau_tot)
-
-    # M4 error
-    dbdi = -1./flux*(velocity*weights - 0.0)**2 * delv*weights
-    dbdc = 1./ continuum*(velocity*weights - 0.0)**2 * delv*weights
+    tau_cum = np.cumsum(tau*delv*weights, axis=-1)
 
-    dm4di = (tau_tot * dbdi - b4 * dwdi) / tau_tot**2
-    dm4dc = (tau_tot * dbdc - b4 * dwdc) / tau_tot**2
+    return m1, m1err, bvalue, bvalue_err, m3, m3err, tau_cum, tau_tot
 
-    q1 = np.sqrt(np.sum((flux_err*weights)**2 * dm4di**2))
-    q2 = np.sum(np.sqrt((continuum_err*weights)**2 * dm4dc**2))
-
-    m4err = np.sqrt(q1**2 + q2**2)
-    m4err = m4err / (2. * m4)
+def _fill_istat(spec, velocity, flux, flux_err,
+                    continuum, continuum_err, weights, delv,
+                    grid_start = None):
+    # Velocity moment calculations; fills the pyn_istat outputs. grid_start
+    #  is set when the arrays are a window of a longer grid (see
+    #  _v90_velocity).
 
+    m1, m1err, bvalue, bvalue_err, m3, m3err, tau_cum, tau_tot = \
+        _moments(velocity, flux, flux_err, continuum, continuum_err,
+                    weights, delv)
+    tau_tot = tau_tot[0]
 
     # Velocities at 5% and 95% of total optical depth as dv90
-    tau_cum = np.cumsum(tau*delv*weights)
     # 5% limit
-    v90a = (np.abs(tau_cum/tau_tot-0.05)).argmin()
-    v90a = velocity[v90a]
+    v90a = _v90_velocity(velocity, tau_cum, tau_tot, 0.05, grid_start)
     # 95% limit
-    v90b = (np.abs(tau_cum/tau_tot-0.95)).argmin()
-    v90b = velocity[v90b]
+    v90b = _v90_velocity(velocity, tau_cum, tau_tot, 0.95, grid_start)
 
     # Calculate dv90:
     dv90 = np.abs(v90b - v90a)
 
 
     # Fill the spec output
-    spec['va'] = m1
-    spec['va_err'] = m1err
+    spec['va'] = m1[0]
+    spec['va_err'] = m1err[0]
     # spec['ba'] = m2
     # spec['ba_err'] = m2err
-    spec['ba'] = bvalue
-    spec['ba_err'] = bvalue_err
-    spec['m3'] = m3
-    spec['m3_err'] = m3err
+    spec['ba'] = bvalue[0]
+    spec['ba_err'] = bvalue_err[0]
+    spec['m3'] = m3[0]
+    spec['m3_err'] = m3err[0]
 
     spec['dv90'] = dv90
     spec['v90a'] = v90a
@@ -643,120 +709,403 @@ def pyn_istat(spec_in,integration_limits = None,
         pass
 
     return spec
+
+
+@timed()
+def pyn_istat(spec_in,integration_limits = None,
+                partial_pixels = True, inplace = False):
+
+    spec = _output_spec(spec_in, inplace)
+
+    # Make sure there are integration limits:
+    if integration_limits is None:
+        integration_limits = [spec['v1'],spec['v2']]
+
+    velocity, flux, flux_err, wavc, fval, continuum, continuum_err = \
+        _spectrum_arrays(spec)
+
+    # Define the limits of the integration:
+    if not integration_limits:
+        integration_limits = [spec['v1'],spec['v2']]
+
+    weights = _pixel_weights(velocity, integration_limits, partial_pixels)
+    delv = _velocity_spacing(velocity)
+
+    spec = _fill_istat(spec, velocity, flux, flux_err,
+                continuum, continuum_err, weights, delv)
+
+    return spec
+
+
+@timed()
+def pyn_fused(spec_in,integration_limits = None,
+                partial_pixels = True, inplace = False):
+    """Single-pass equivalent of pyn_eqwidth, pyn_column and pyn_istat.
+
+    The continuum, pixel weights and velocity spacing are worked out once
+    and shared by all three sets of measurements. The output is identical
+    to running pyn_eqwidth, pyn_column and pyn_istat in turn.
+
+    With inplace=True the outputs are written straight into spec_in and the
+    input arrays are never duplicated (read-only arrays are left as is).
+    """
+
+    spec = _output_spec(spec_in, inplace)
+
+    # Make sure there are integration limits:
+    if integration_limits is None:
+        integration_limits = [spec['v1'],spec['v2']]
+
+    return _fused_aod(spec, integration_limits, partial_pixels)
+
+
+def _fused_aod(spec, integration_limits, partial_pixels,
+                delx = None, grid_start = None):
+    # The measurements of pyn_fused, written into spec. For a window of a
+    #  longer grid, delx is the pixel spacing to weight the pixels with
+    #  and grid_start the velocity of the grid's first pixel.
+
+    # Shared intermediates
+    velocity, flux, flux_err, wavc, fval, continuum, continuum_err = \
+        _spectrum_arrays(spec)
+    weights = _pixel_weights(velocity, integration_limits, partial_pixels,
+                                delx)
+    delv = _velocity_spacing(velocity)
+
+    spec = _fill_eqwidth(spec, integration_limits, velocity, flux, flux_err,
+                continuum, continuum_err, weights)
+    spec = _fill_column(spec, integration_limits, velocity, flux, flux_err,
+                wavc, fval, continuum, continuum_err, weights, delv)
+    spec = _fill_istat(spec, velocity, flux, flux_err,
+                continuum, continuum_err, weights, delv, grid_start)
+
+    return spec
 # Added by saloni 
 # to turn off blemish_correction set it to False in both pyn_batch and read_rbcodes
-def pyn_blemish(spec_in,blemish_correction):
-    spec = spec_in.copy()
+@timed()
+def pyn_blemish(spec_in,blemish_correction, inplace = False):
+    spec = _output_spec(spec_in, inplace)
 
     if blemish_correction:
-        print('***** Will correct for blemishes, if present. *****')
-    for i in range(len(spec['vel'])):
-        if (((spec['eflux'][i]==-1.)|(spec['eflux'][i]>1))):
-            if ((spec['vel'][i]>=spec['v1'])&(spec['vel'][i]<=spec['v2'])):
-                spec['flag_blemish']=True #check
-    
-            if blemish_correction:
-                x = (spec['vel'][i-20:i+21]).tolist(); y = (spec['flux'][i-20:i+21]).tolist(); z = (spec['eflux'][i-20:i+21]).tolist()
-                ind = np.where((np.array(y)==0.0)|(np.array(z)>1))[0]
-                for k in sorted(ind,reverse=True):
-                    del x[k]; del y[k]
-                if (len(x)<2):                     # unable to interpolate if blemish is on the leftmost edge
-                    continue
-                if (x[len(x)-1]<spec['vel'][i]):   # does not correct for blemishes on the edges, skips it
-                    continue
-                else:
-                    ff=interpolate.interp1d(x,y,fill_value='extrapolate')
-                    if (ff(spec['vel'][i])>=0):
-                        spec['flux'][i]=ff(spec['vel'][i])
-                    else:
-                        spec['flux'][i]=0.0
-                    spec['eflux'][i]=-0.9
+        logger.debug('***** Will correct for blemishes, if present. *****')
+
+    velocity = spec['vel']
+    flux = spec['flux']
+    flux_err = spec['eflux']
+
+    # Blemished pixels are flagged with eflux == -1 or eflux > 1.
+    idx_blemish = ((flux_err == -1.) | (flux_err > 1))
+    if not idx_blemish.any():
+        return spec
+
+    # Flag blemishes within the integration range
+    if (idx_blemish & (velocity >= spec['v1']) & (velocity <= spec['v2'])).any():
+        spec['flag_blemish'] = True #check
+
+    if not blemish_correction:
+        return spec
+
+    # Repair every blemished pixel at once by linear interpolation between
+    #  the nearest good pixels within +/-20 pixels. Good pixels have
+    #  non-zero flux and eflux <= 1.
+    half_width = 20
+    idx_good = (flux != 0.0) & ~(flux_err > 1)
+    blem = np.flatnonzero(idx_blemish)
+    nodes = np.flatnonzero(idx_good)
+    nnodes = np.size(nodes)
+    if nnodes == 0:
+        return spec
+
+    # Nearest good pixels at or below (left) and at or above (right) each
+    #  blemish, plus the second good pixel to the right for extrapolation.
+    r = np.searchsorted(nodes, blem, 'left')
+    l = np.searchsorted(nodes, blem, 'right')-1
+    left = nodes[np.clip(l, 0, nnodes-1)]
+    right = nodes[np.clip(r, 0, nnodes-1)]
+    right2 = nodes[np.clip(r+1, 0, nnodes-1)]
+
+    # Number of good pixels in each window
+    ngood = np.searchsorted(nodes, blem+half_width, 'right') - \
+                np.searchsorted(nodes, blem-half_width, 'left')
+
+    has_left = (l >= 0) & (left >= blem-half_width)
+    has_right = (r < nnodes) & (right <= blem+half_width)
+
+    # Unable to interpolate with fewer than 2 good pixels, on the leftmost
+    #  edge of the spectrum, or without a good pixel on the right (edges).
+    fixable = (ngood >= 2) & has_right & (blem >= half_width)
+
+    # Interpolate between the neighbours, or extrapolate from the two
+    #  good pixels on the right if there is none on the left.
+    p1 = np.where(has_left, left, right)
+    p2 = np.where(has_left, right, right2)
+
+    # Repaired pixels serve as good pixels for the blemishes that follow
+    #  them. Blemishes within +/-20 pixels of each other, with no good
+    #  pixel in between, are therefore repaired along the line set by the
+    #  first repairable pixel of the group.
+    chain = np.flatnonzero(~idx_good[blem])
+    if np.size(chain) > 0:
+        pos = np.arange(np.size(chain))
+        new_group = (np.diff(blem[chain], prepend=-2*half_width) > half_width) | \
+                        (np.diff(r[chain], prepend=-1) != 0)
+        group_start = np.flatnonzero(new_group)
+        group_id = np.cumsum(new_group)-1
+        first_fix = np.minimum.reduceat(
+            np.where(fixable[chain], pos, np.size(chain)), group_start)[group_id]
+        chained = first_fix < pos
+        src = chain[np.minimum(first_fix, np.size(chain)-1)]
+        p1[chain[chained]] = p1[src[chained]]
+        p2[chain[chained]] = p2[src[chained]]
+        fixable[chain[chained]] = has_right[chain[chained]] & \
+                                    (blem[chain[chained]] >= half_width)
+
+    dv = velocity[p2]-velocity[p1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(p1 == p2, 0.,
+                    (flux[p2].astype(float)-flux[p1])/dv)
+    flux_fix = flux[p1]+slope*(velocity[blem]-velocity[p1])
+
+    # Negative interpolants are set to zero.
+    flux_fix = np.where(flux_fix >= 0, flux_fix, 0.0)
+
+    # Only write into the input arrays when asked to and able to.
+    if not (inplace and flux.flags.writeable):
+        flux = flux.copy()
+    if not (inplace and flux_err.flags.writeable):
+        flux_err = flux_err.copy()
+    flux[blem[fixable]] = flux_fix[fixable]
+    flux_err[blem[fixable]] = -0.9
+
+    spec['flux'] = flux
+    spec['eflux'] = flux_err
+
     return spec
 
+def _batch_measure(spec, integration_limits, partial_pixels,
+                    blemish_correction, fused, inplace):
+    # Blemish correction and measurements for pyn_batch.
+    spec = pyn_blemish(spec,blemish_correction, inplace)
+    # spec is our own dictionary from here on, so the measurements can be
+    #  filled in without further copies.
+    spec = _batch_aod(spec, integration_limits, partial_pixels, fused)
+
+    return spec
+
+
+def _batch_aod(spec, integration_limits, partial_pixels, fused):
+    # The fused kernel shares the continuum, weights and delta v between
+    #  the EW, column and moment calculations.
+    if fused:
+        spec = pyn_fused(spec,integration_limits, partial_pixels,
+                            inplace = True)
+    else:
+        spec = pyn_eqwidth(spec,integration_limits, partial_pixels,
+                            inplace = True)
+        spec = pyn_column(spec,integration_limits, partial_pixels,
+                            inplace = True)
+        spec = pyn_istat(spec,integration_limits, partial_pixels,
+                            inplace = True)
+
+    return spec
+
+
+def _window_spec(spec, start, stop):
+    # A copy of spec holding views of the per-pixel arrays over the
+    #  pixels [start, stop).
+    velocity = spec['vel']
+    window = spec.copy()
+    for kkk in spec.keys():
+        value = spec[kkk]
+        if isinstance(value, np.ndarray) and \
+            (np.shape(value) == np.shape(velocity)):
+            window[kkk] = value[start:stop]
+
+    return window
+
+
+def _window_slice(velocity, integration_limits, window_margin):
+    # Pixels [start, stop) spanning the integration limits, their edge
+    #  pixels and window_margin more pixels on either side. One more pixel
+    #  is kept on the right: the last pixel of a window takes the spacing
+    #  of the one before it (see _velocity_spacing), so it must be outside
+    #  the integration.
+    npix = len(velocity)
+    start = np.searchsorted(velocity, integration_limits[0], 'left')
+    stop = np.searchsorted(velocity, integration_limits[1], 'right')
+    start = max(start-window_margin-1, 0)
+    stop = min(stop+window_margin+2, npix)
+
+    return start, stop
+
+
+def _window_spacing(velocity, integration_limits):
+    # Pixel spacing (median) of the window of margin 0, so that it is the
+    #  same whatever the margin. On a uniform grid this is the spacing of
+    #  the full grid.
+    start, stop = _window_slice(velocity, integration_limits, 0)
+
+    return np.median(np.diff(velocity[start:stop]))
+
+
+def _scatter_pixels(kkk, value, npix, start, stop):
+    # Put a per-pixel output computed on the window back on the full grid.
+    if kkk == 'Nav_sat':
+        full = np.zeros(npix, dtype=value.dtype)
+    elif kkk == 'integration_weights':
+        full = np.zeros(npix, dtype=value.dtype)
+    elif kkk == 'EW_cumulative':
+        full = np.zeros(npix, dtype=value.dtype)
+        full[stop:] = value[-1]
+    else:
+        full = np.full(npix, np.nan, dtype=np.result_type(value, np.float32))
+    full[start:stop] = value
+
+    return full
+
+
+def _batch_window(spec, integration_limits, partial_pixels,
+                    blemish_correction, inplace, window_margin,
+                    window_scatter):
+    # pyn_batch measurements on a window around the integration range.
+    #  Only the window is read or written, unless the repairs of blemishes
+    #  or window_scatter call for full-length arrays.
+
+    velocity = spec['vel']
+    npix = len(velocity)
+    start, stop = _window_slice(velocity, integration_limits, window_margin)
+
+    spec = _convert_efnorm(spec)
+
+    # Blemishes are repaired over the window plus the +/-20 pixels used
+    #  to interpolate across them; repairs go back into the full spectrum.
+    blem_start = max(start-20, 0)
+    blem_stop = min(stop+20, npix)
+    window = _window_spec(spec, blem_start, blem_stop)
+    window = pyn_blemish(window, blemish_correction, inplace)
+    for kkk in ['flux','eflux']:
+        if not np.may_share_memory(window[kkk], spec[kkk]):
+            full = spec[kkk].copy()
+            full[blem_start:blem_stop] = window[kkk]
+            spec[kkk] = full
+    if 'flag_blemish' in window:
+        spec['flag_blemish'] = window['flag_blemish']
+
+    # Measurements over the window, with the v90 search of the full grid
+    views = _window_spec(spec, start, stop)
+    window = _fused_aod(views.copy(), integration_limits, partial_pixels,
+                delx = _window_spacing(velocity, integration_limits),
+                grid_start = velocity[0] if start > 0 else None)
+
+    for kkk in list(spec.keys()):
+        if kkk not in window:
+            del spec[kkk]
+
+    for kkk in window.keys():
+        value = window[kkk]
+        if (kkk in views) and (value is views[kkk]):
+            # Window views of the input arrays; the full arrays are kept.
+            continue
+        elif window_scatter and isinstance(value, np.ndarray) and \
+            (np.shape(value) == (stop-start,)):
+            # Per-pixel outputs (Nav, EW_cumulative, wave, ...)
+            if kkk == 'wave':
+                value = spec['wavc']*(velocity/2.998e5)+spec['wavc']
+            else:
+                value = _scatter_pixels(kkk, value, npix, start, stop)
+        spec[kkk] = value
+
+    spec['pixel_window'] = np.array([start, stop])
+
+    return spec
+
+@timed()
 def pyn_batch(spec_in,integration_limits = None,
                 partial_pixels = True, blemish_correction=True,
-                verbose = True):
-
-    spec = spec_in.copy()
+                verbose = None, fused = True, inplace = False,
+                window_margin = None, window_scatter = False,
+                record = False):
+    """Blemish correction, equivalent width, column density and velocity
+    moments of a transition (pyn_blemish, pyn_eqwidth, pyn_column and
+    pyn_istat).
+
+    integration_limits default to [spec['v1'], spec['v2']].
+
+    fused = True (default) shares the continuum, weights and velocity
+    spacing between the measurements (see pyn_fused); fused = False runs
+    the separate functions in turn. The results are the same.
+
+    inplace = True writes the results into spec_in itself and uses its
+    arrays as they are; by default a copy is returned.
+
+    window_margin: if set, only the pixels within the integration range
+    plus window_margin pixels on either side are measured (always in one
+    pass, whatever fused), and only those are checked for blemishes (with
+    the +/-20 pixels used to repair them), so the cost does not grow with
+    the length of the spectrum (except that repairs made without inplace
+    go into copies of flux and eflux). The partial pixel weights use the
+    median spacing of the pixels spanning the integration range, so the
+    measurements do not depend on the margin (and are those of the full
+    grid if it is uniform). The window's [start, stop) pixels are stored
+    in spec['pixel_window'], and the per-pixel outputs (Nav, Nav_err,
+    Nav_sat, EW_cumulative, integration_weights, and wave if it is
+    computed) cover the window only.
+
+    window_scatter = True puts the per-pixel outputs back on the full
+    grid instead: NaN (Nav, Nav_err) or zero (weights, saturation)
+    outside the window. This costs full-length arrays.
+
+    The human-readable report is logged at INFO by the 'pyNorm.aod'
+    logger, and only formatted if that logger emits it; wrap the call in
+    verbose_output() to print it when logging is not configured.
+    verbose is deprecated: verbose = True does the same as
+    verbose_output(), verbose = False nothing.
+
+    record = True returns (spec, Measurement), the typed record of the
+    results that pyn_measurement(spec) gives.
+
+    The optional stages have their own functions: pyn_auto_limits (limits
+    from the data) and pyn_montecarlo (Monte Carlo errors).
+    """
+
+    spec = _output_spec(spec_in, inplace)
+
+    # Low-memory mode: per-pixel arrays are stored as float32 (the sums
+    #  are still accumulated in float64; see pyn_precision).
+    if low_memory():
+        with stage('pyn_batch.precision'):
+            spec = pyn_precision(spec, inplace = True)
 
     # In case the flags don't exist, set them to the defaults. 
     spec.setdefault('flag_blemish', False)
     spec.setdefault('flag_sat', False)
     spec.setdefault('detection_3sig', False)
 
-    # FIX NON-WRITEABLE ARRAYS due to discontiguous
-    # memory in some readsav inputs
-    if ~spec['vel'].flags.writeable:
-        spec = fix_unwriteable_spec(spec)
-
-
     # Make sure there are integration limits:
     if integration_limits is None:
         integration_limits = [spec['v1'],spec['v2']]
     
-    spec = pyn_blemish(spec,blemish_correction)
-    spec = pyn_eqwidth(spec,integration_limits, partial_pixels)
-    spec = pyn_column(spec,integration_limits, partial_pixels)
-    spec = pyn_istat(spec,integration_limits, partial_pixels)
+    if window_margin is None:
+        spec = _batch_measure(spec, integration_limits, partial_pixels,
+                    blemish_correction, fused, inplace)
+    else:
+        spec = _batch_window(spec, integration_limits, partial_pixels,
+                    blemish_correction, inplace, window_margin,
+                    window_scatter)
+
+    # New per-pixel outputs (Nav, EW_cumulative, ...) to the storage precision
+    if low_memory():
+        with stage('pyn_batch.precision'):
+            spec = pyn_precision(spec, inplace = True)
     
-    dashes = '--------------------------------------------'
-    if verbose:
-
-        try:
-            spec['ion'] = spec['ion'].decode('utf-8')
-            spec['wni'] = spec['wni'].decode('utf-8')
-        except:
-            pass
-        finally:
-            # TODO: FIX ME TO LOOK FOR MISSING WNI
-            print('********** '+spec['ion']+' '+spec['wni']+' **********')
-
-        print('pyn_batch: Wavelength = {0:0.3f}'.format(spec['wavc']))
-        # if spec['fval'] <= 1.e-3:
-        #     print('pyn_batch: f-value = {0:0.2g}'.format(spec['fval']))
-        # else:
-        #     print('pyn_batch: f-value = {0:0.3f}'.format(spec['fval']))
-        print('pyn_batch: f-value = {0:0.3e}'.format(spec['fval']))
-        print('\nVelocity range of integration: {0:0.1f} <= v <= {1:0.1f}'.format(spec['v1'],spec['v2']))
-
-        print('\n'+dashes)
-        # Print column densities:
-        if spec.get('flag_blemish'):
-            print('***** WARNING: BLEMISHES PRESENT IN THE INTEGRATION RANGE! *****')
-
-        if spec.get('flag_sat'):
-            print('***** WARNING: SATURATION IS PRESENT! *****')
-            print(dashes)
-            print('log N > {0:0.3f} ({1:+0.3f}, {2:+0.3f})'.format(\
-                    spec['ncol'],spec['ncol_err_lo'],spec['ncol_err_hi']))
-            print(dashes)
-        else:
-            print('log N = {0:0.3f} ({1:+0.3f}, {2:+0.3f})'.format(\
-                    spec['ncol'],spec['ncol_err_lo'],spec['ncol_err_hi']))
-        print(dashes)
-
-        print('\n'+dashes)
-        print('<v>       = {0:6.2f}  +/- {1:0.2f}'.format(spec['va'], spec['va_err']))
-        print('<b>       = {0:6.2f}  +/- {1:0.2f}'.format(spec['ba'],spec['ba_err']))
-        print('dv90      = {0:6.2f}  +/- {1:0.2f}'.format(spec['dv90'], spec['va_err']*np.sqrt(2)))
-        print('Skew      = {0:6.2f}  +/- {1:0.2f}'.format(spec['m3'],spec['m3_err']))
-        print(dashes)
-
-        ew3sigma = 3.*spec['EW_err']
-
-        print('\n'+dashes)
-        print('EW           = {0:0.2f}'.format(spec['EW']))
-        print('Stat Error   = {0:0.2f}'.format(spec['EW_err_stat']))
-        print('Cont Error   = {0:0.2f}'.format(spec['EW_err_cont']))
-        print('Tot Error    = {0:0.2f}'.format(spec['EW_err']))
-        print('3sigma EW    < {0:0.2f}'.format(ew3sigma))
-        if not spec['detection_3sig']:
-            print('***** WARNING: LINE NOT DETECTED AT 3 SIGMA! *****')
-
-        print('\n')
-        print('Linear COG N = {0:0.2f}'.format(spec['ncol_linearCoG']))
-        print('2sigma N     < {0:0.2f}'.format(spec['ncol_linear2sig']))
-        print('3sigma N     < {0:0.2f}'.format(spec['ncol_linear3sig']))
-        print(dashes)
-
+    # The report is only put together if the logger emits it, or for
+    #  the record.
+    with _verbose_report('pyn_batch', verbose):
+        if record or logger.isEnabledFor(logging.INFO):
+            with stage('pyn_batch.report'):
+                measurement = pyn_measurement(spec)
+                log_measurement(measurement)
+
+    if record:
+        return spec, measurement
     return spec
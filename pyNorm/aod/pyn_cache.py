@@ -0,0 +1,98 @@
+import hashlib
+import weakref
+import numpy as np
+from collections import OrderedDict
+# Small memoization helpers for results that depend only on a pixel grid
+#  (e.g., integration weights) and are asked for repeatedly, as the GUI
+#  does on every click.
+
+
+class LRUCache(object):
+    """A bounded least-recently-used cache.
+
+    Once maxsize entries are stored, adding a new one discards the entry
+    that was used least recently.
+    """
+
+    def __init__(self, maxsize = 128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default = None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class GridCache(LRUCache):
+    """An LRUCache of results computed from a pixel grid array.
+
+    Lookups are keyed on the grid's identity, shape, dtype and end points
+    (plus any extra key), which costs nothing whatever the grid length.
+    Each entry keeps a weak reference to its grid, so an entry is only
+    returned for that same array, not for a new one that happens to get
+    the id of a grid that has since been freed. The grid is assumed not to
+    be modified in place.
+    """
+
+    def _grid_key(self, x, key):
+        return (id(x), x.shape, x.dtype.str, x.flat[0], x.flat[-1]) + key
+
+    def lookup(self, x, *key):
+        try:
+            ref, value = self.get(self._grid_key(x, key), (None, None))
+        except (AttributeError, IndexError):
+            return None
+        if (ref is None) or (ref() is not x):
+            return None
+        return value
+
+    def store(self, x, value, *key):
+        # Grids that can't be weakly referenced (or are empty) aren't cached
+        try:
+            self.put(self._grid_key(x, key), (weakref.ref(x), value))
+        except (AttributeError, IndexError, TypeError):
+            pass
+
+
+def array_fingerprint(x):
+    # A hashable summary of an array's contents: its shape, dtype and a
+    #  digest of its bytes. Equal arrays give equal fingerprints.
+    x = np.ascontiguousarray(x)
+    digest = hashlib.blake2b(x.reshape(-1).view(np.uint8),
+                                digest_size=16).hexdigest()
+
+    return (x.shape, x.dtype.str, digest)
+
+
+def readonly(x):
+    # Mark a cached array read-only so that callers sharing it can't
+    #  modify the cached copy.
+    x.flags.writeable = False
+
+    return x
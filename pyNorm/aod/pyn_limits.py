@@ -0,0 +1,192 @@
+import numpy as np
+from collections import OrderedDict
+from .pyn_stack import stack_spectra, _stack_edges, _stack_delta, _stack_tau
+from .pyn_timing import timed
+# Automatic integration limits from the significance of the apparent
+#  optical depth.
+#
+# Assumptions:
+#
+#  -- Velocity increases monotonically along each spectrum
+#  -- Absorption is detected where tau/tau_err >= nsig over at least
+#     min_pix consecutive pixels
+
+
+def _run_lengths(mask):
+    # Runs of True along each row of a 2-D mask. Returns the row, first
+    #  pixel and (exclusive) last pixel of every run, ordered by row and
+    #  position.
+    nrow = mask.shape[0]
+    padded = np.zeros((nrow, mask.shape[1]+2), dtype=np.int8)
+    padded[:,1:-1] = mask
+    step = np.diff(padded, axis=1)
+
+    run_row, run_start = np.nonzero(step == 1)
+    run_stop = np.nonzero(step == -1)[1]
+
+    return run_row, run_start, run_stop
+
+
+def auto_limits(vel, flux, eflux, contin, valid = None, nsig = 3.,
+                min_pix = 3, merge_dv = 20., vrange = None, vcenter = 0.):
+    """Integration limits for a stack of spectra from the significance of
+    the apparent optical depth.
+
+    Pixels with tau/tau_err >= nsig are found on all rows at once, runs of
+    at least min_pix such pixels are kept, and runs separated by gaps of
+    at most merge_dv km/s are merged into components. The component
+    closest to vcenter (containing it, if any) sets the limits, which are
+    placed on the outer edges of its end pixels; ties, or all components
+    if vcenter is None, go to the largest integrated optical depth. Only
+    pixels within vrange (if given) are considered.
+
+    vel, flux, eflux and contin are (n_spec x n_pixels) arrays, with valid
+    marking the pixels that hold data. Returns an OrderedDict with the
+    (n_spec x 2) 'integration_limits', 'found' (False where nothing was
+    detected; those limits are NaN), the number of components 'ncomp' and
+    the (row, v1, v2, tau_int) of every component in 'components'.
+    """
+
+    vel = np.atleast_2d(np.asarray(vel, dtype=float))
+    nrow, npix = vel.shape
+    if valid is None:
+        valid = np.ones(vel.shape, dtype=bool)
+    valid = np.atleast_2d(valid)
+
+    flux = np.where(valid, flux, 1.)
+    flux_err = np.where(valid, eflux, 0.)
+    continuum = np.where(valid, contin, 1.)
+
+    # Optical depth and its error, as in pyn_column
+    tau_array, tau_array_err, idx_saturation = \
+        _stack_tau(flux, flux_err, continuum, valid)
+
+    # Significant pixels. Pixels without a (positive) error can't count.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        significance = tau_array/tau_array_err
+    detected = valid & (flux_err > 0) & (significance >= nsig)
+    if vrange is not None:
+        detected &= (vel >= vrange[0]) & (vel <= vrange[1])
+
+    # Runs of significant pixels, dropping the short ones
+    run_row, run_start, run_stop = _run_lengths(detected)
+    gd = (run_stop-run_start) >= min_pix
+    run_row, run_start, run_stop = run_row[gd], run_start[gd], run_stop[gd]
+
+    # Merge runs separated by small gaps into components
+    gap = np.full(np.size(run_row), np.inf)
+    if np.size(run_row) > 1:
+        same_row = (run_row[1:] == run_row[:-1])
+        gap[1:] = np.where(same_row,
+                    vel[run_row[1:], run_start[1:]] - \
+                    vel[run_row[:-1], run_stop[:-1]-1], np.inf)
+    new_comp = (gap > merge_dv)
+    comp_first = np.flatnonzero(new_comp)
+    # Last run of each component (none if nothing was detected)
+    comp_last = np.append(comp_first[1:],
+                    np.size(run_row))[:np.size(comp_first)]-1
+    comp_row = run_row[comp_first]
+    comp_start = run_start[comp_first]
+    comp_stop = run_stop[comp_last]
+
+    # Integrated optical depth of each component
+    first, last = _stack_edges(valid)
+    delv = _stack_delta(np.where(valid, vel, 0.), valid, first, last)
+    tau_cum = np.zeros((nrow, npix+1))
+    tau_cum[:,1:] = np.cumsum(tau_array*delv, axis=1)
+    comp_tau = tau_cum[comp_row, comp_stop]-tau_cum[comp_row, comp_start]
+
+    # Limits on the outer edges of the end pixels
+    comp_v1 = vel[comp_row, comp_start]-delv[comp_row, comp_start]/2.
+    comp_v2 = vel[comp_row, comp_stop-1]+delv[comp_row, comp_stop-1]/2.
+
+    # Component nearest vcenter (then strongest) of each row
+    if vcenter is None:
+        comp_dist = np.zeros(np.size(comp_row))
+    else:
+        comp_dist = np.maximum(np.maximum(comp_v1-vcenter, vcenter-comp_v2), 0.)
+    order = np.lexsort((-comp_tau, comp_dist, comp_row))
+    rows_found, best = np.unique(comp_row[order], return_index=True)
+    best = order[best]
+
+    limits = np.full((nrow, 2), np.nan)
+    limits[rows_found, 0] = comp_v1[best]
+    limits[rows_found, 1] = comp_v2[best]
+    found = np.zeros(nrow, dtype=bool)
+    found[rows_found] = True
+
+    results = OrderedDict()
+    results['integration_limits'] = limits
+    results['found'] = found
+    results['ncomp'] = np.bincount(comp_row, minlength=nrow)
+    results['components'] = np.rec.fromarrays(
+        [comp_row, comp_v1, comp_v2, comp_tau],
+        names=['row', 'v1', 'v2', 'tau_int'])
+
+    return results
+
+
+@timed()
+def pyn_auto_limits(spec_list, nsig = 3., min_pix = 3, merge_dv = 20.,
+                    vrange = None, vcenter = 0.,
+                    default_limits = (-100., 100.), inplace = False):
+    """Set the integration limits of a list of spectra automatically.
+
+    The limits of all the spectra are found in one pass (see auto_limits)
+    and written to each spec's 'v1' and 'v2'; spectra with no significant
+    absorption get default_limits. Each spec also records how its limits
+    were chosen in 'limits_auto', an OrderedDict holding the parameters,
+    whether absorption was found and all components found.
+
+    Returns the updated list of spectra and a record table (OrderedDict of
+    arrays: ion, wni, v1, v2, found, ncomp).
+    """
+
+    stack = stack_spectra(spec_list)
+    auto = auto_limits(stack['vel'], stack['flux'], stack['eflux'],
+                stack['contin'], stack['valid'], nsig = nsig,
+                min_pix = min_pix, merge_dv = merge_dv, vrange = vrange,
+                vcenter = vcenter)
+
+    limits = auto['integration_limits']
+    found = auto['found']
+    limits[~found] = default_limits
+    components = auto['components']
+
+    # Components are ordered by row
+    bounds = np.searchsorted(components['row'], np.arange(len(spec_list)+1))
+
+    out_list = []
+    for j, spec_in in enumerate(spec_list):
+        if inplace:
+            spec = spec_in
+        else:
+            spec = spec_in.copy()
+
+        spec['v1'] = limits[j,0]
+        spec['v2'] = limits[j,1]
+
+        record = OrderedDict()
+        record['nsig'] = nsig
+        record['min_pix'] = min_pix
+        record['merge_dv'] = merge_dv
+        record['vrange'] = vrange
+        record['vcenter'] = vcenter
+        record['found'] = bool(found[j])
+        gd = slice(bounds[j], bounds[j+1])
+        record['components'] = np.array([components['v1'][gd],
+                                components['v2'][gd]]).T
+        record['tau_int'] = components['tau_int'][gd]
+        spec['limits_auto'] = record
+
+        out_list.append(spec)
+
+    table = OrderedDict()
+    table['ion'] = [spec.get('ion', '') for spec in spec_list]
+    table['wni'] = [spec.get('wni', '') for spec in spec_list]
+    table['v1'] = limits[:,0].copy()
+    table['v2'] = limits[:,1].copy()
+    table['found'] = found
+    table['ncomp'] = auto['ncomp']
+
+    return out_list, table
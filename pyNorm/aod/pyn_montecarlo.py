@@ -0,0 +1,147 @@
+import numpy as np
+from collections import OrderedDict
+from .pyn_aod import _output_spec, _spectrum_arrays, _pixel_weights, \
+    _velocity_spacing, pyn_blemish
+from .pyn_stack import _stack_tau, _stack_moments
+from .pyn_timing import timed
+# Monte Carlo error propagation for the AOD measurements.
+#
+# Assumptions:
+#
+#  -- Flux errors are independent from pixel to pixel
+#  -- Continuum errors are fully correlated across the spectrum (as in
+#     the analytic continuum errors of pyn_column and pyn_eqwidth)
+
+
+def _montecarlo_kernel(velocity, flux, flux_err, continuum, wavc, fval,
+                        weights, delv, delw):
+    # Linear column, EW and velocity moments for a (K x n_pixels) stack of
+    #  flux and continuum realizations. The grid arrays are 1 x n_pixels.
+
+    # Some constants
+    column_factor = 2.654e-15
+
+    velocity = np.broadcast_to(velocity, flux.shape)
+    valid = np.ones(flux.shape, dtype=bool)
+    zeros = np.zeros(flux.shape)
+
+    samples = OrderedDict()
+
+    # Apparent column density [pyn_column]
+    tau_array, tau_array_err, idx_saturation = \
+        _stack_tau(flux, np.broadcast_to(flux_err, flux.shape),
+                    continuum, valid)
+    tau_int = np.sum(tau_array*delv*weights, axis=1)
+    samples['ncol'] = tau_int/(wavc*fval*column_factor)
+
+    # Equivalent width [pyn_eqwidth], in milliAngstrom
+    samples['EW'] = np.sum((1.-flux/continuum)*delw*weights, axis=1)*1000.
+
+    # Velocity moments [pyn_istat]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        moments = _stack_moments(velocity, flux, zeros, continuum,
+                    zeros, np.broadcast_to(weights, flux.shape),
+                    np.broadcast_to(delv, flux.shape))
+    for kkk in ['va','ba','dv90']:
+        samples[kkk] = moments[kkk]
+
+    return samples
+
+
+@timed()
+def pyn_montecarlo(spec_in, integration_limits = None,
+                    partial_pixels = True, nsamples = 1000,
+                    chunk_size = 250, percentiles = (15.87, 50., 84.13),
+                    seed = None, blemish_correction = True,
+                    inplace = False):
+    """Monte Carlo errors for the column density, EW, va, ba and dv90.
+
+    nsamples realizations of the spectrum are drawn as (K x n_pixels)
+    arrays: the flux is perturbed pixel by pixel by its error (eflux) and
+    the continuum by its error (contin_err) scaled by a single normal
+    deviate per realization. All quantities are measured for a chunk of
+    chunk_size realizations at a time, which bounds the memory used.
+
+    For each quantity q in ncol, EW, va, ba and dv90 the outputs are
+    q_mc (the middle percentile) and q_mc_err_lo, q_mc_err_hi (the offsets
+    of the lower and upper percentiles from it; err_lo is negative), so
+    percentiles must hold exactly three values (lower, middle, upper). ncol
+    percentiles are taken on the linear column and converted to log10, so
+    ncol_mc_err_lo is NaN when the lower percentile is not positive.
+
+    Blemished pixels are repaired first, as in pyn_batch (see pyn_blemish;
+    blemish_correction = False only flags them). Blemishes that remain
+    are not perturbed: their eflux (-1 or > 1) is a flag, not an error.
+    """
+
+    if np.size(percentiles) != 3:
+        raise ValueError('percentiles must hold three values (lower, '
+                            'middle, upper), not {0}'.format(percentiles))
+
+    spec = _output_spec(spec_in, inplace)
+    spec = pyn_blemish(spec, blemish_correction, inplace)
+
+    # Some constants
+    lightspeed = 2.998e5 # km/s
+
+    # Make sure there are integration limits:
+    if integration_limits is None:
+        integration_limits = [spec['v1'],spec['v2']]
+
+    velocity, flux, flux_err, wavc, fval, continuum, continuum_err = \
+        _spectrum_arrays(spec)
+
+    weights = _pixel_weights(velocity, integration_limits, partial_pixels)
+    delv = _velocity_spacing(velocity)
+
+    # Create the wavelength array
+    try:
+        wave = spec['wave']
+    except:
+        wave = wavc*(velocity/lightspeed)+wavc
+    delw = _velocity_spacing(wave)
+
+    # Everything as 1 x n_pixels rows
+    def _row(x):  return np.asarray(x, dtype=float)[np.newaxis,:]
+    velocity, flux, continuum, weights, delv, delw = \
+        [_row(x) for x in [velocity, flux, continuum, weights, delv, delw]]
+    # Repaired blemishes carry eflux = -0.9; the analytic errors square it.
+    #  Blemish flags left in eflux give no noise.
+    flux_err = np.asarray(flux_err, dtype=float)
+    idx_blemish = (flux_err == -1.) | (flux_err > 1)
+    flux_err = _row(np.where(idx_blemish, 0., np.abs(flux_err)))
+    continuum_err = _row(continuum_err)
+    wavc = float(wavc)
+    fval = float(fval)
+
+    rng = np.random.default_rng(seed)
+
+    # Draw and measure the realizations chunk by chunk
+    samples = OrderedDict()
+    for start in range(0, nsamples, chunk_size):
+        nk = min(chunk_size, nsamples-start)
+
+        flux_mc = flux + flux_err*rng.standard_normal((nk, flux.shape[1]))
+        continuum_mc = continuum + \
+            continuum_err*rng.standard_normal((nk, 1))
+
+        chunk = _montecarlo_kernel(velocity, flux_mc, flux_err, continuum_mc,
+                    wavc, fval, weights, delv, delw)
+        for kkk in chunk.keys():
+            samples.setdefault(kkk, []).append(chunk[kkk])
+
+    # Percentiles of each quantity
+    for kkk in samples.keys():
+        pct = np.nanpercentile(np.concatenate(samples[kkk]), percentiles)
+
+        if kkk == 'ncol':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pct = np.log10(pct)
+
+        spec[kkk+'_mc'] = pct[1]
+        spec[kkk+'_mc_err_lo'] = pct[0]-pct[1]
+        spec[kkk+'_mc_err_hi'] = pct[2]-pct[1]
+
+    spec['mc_nsamples'] = nsamples
+
+    return spec
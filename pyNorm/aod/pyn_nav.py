@@ -0,0 +1,285 @@
+import numpy as np
+from collections import OrderedDict
+from .pyn_stack import _stack_edges, _stack_searchsorted
+# Na(v) profiles on a common velocity grid, and the apparent column density
+#  ratio test for unresolved saturation (Savage & Sembach 1991).
+#
+# Assumptions:
+#
+#  -- Na(v) profiles come from pyn_column (spec['Nav'], spec['Nav_err'])
+#  -- Velocity increases monotonically along each spectrum
+#  -- Transitions of the same ion share spec['ion']; only transitions of
+#     the same target (spec['targname'] or spec['object']) and redshift
+#     (spec['redshift'] or spec['z']) are compared
+
+
+def nav_common_grid(vel_list, dv = None, vrange = None):
+    # Edges of a common velocity grid for a list of velocity arrays. By
+    #  default the grid covers the range all the arrays overlap with the
+    #  coarsest of their pixel spacings, so that no spectrum is resampled
+    #  to finer pixels than it has. Without an overlap there are no bins.
+
+    if dv is None:
+        dv = np.max([np.median(np.diff(vel)) for vel in vel_list])
+    if vrange is None:
+        vrange = [np.max([np.min(vel) for vel in vel_list]),
+                    np.min([np.max(vel) for vel in vel_list])]
+
+    nbins = max(int(np.ceil((vrange[1]-vrange[0])/dv)), 0)
+    if nbins == 0:
+        return np.zeros(0)
+    edges = vrange[0]+dv*np.arange(nbins+1)
+
+    return edges
+
+
+def nav_rebin(vel, y, y_err, edges, valid = None):
+    """Flux-conserving rebinning of a stack of profiles onto common bins.
+
+    vel, y and y_err are (n_spec x n_pixels) arrays (padded rows are marked
+    by valid, which must be contiguous); edges holds the n_bins+1 edges of
+    the common grid. Each output bin is the mean of y over the bin, so the
+    integral of y dv is conserved. Errors are propagated treating the noise
+    as uncorrelated between pixels, so a pixel split between two bins adds
+    the variance of the part in each; bins not fully covered by a spectrum
+    are NaN. Returns the rebinned y and y_err and the (n_spec x n_bins)
+    coverage mask.
+    """
+
+    vel = np.atleast_2d(np.asarray(vel, dtype=float))
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    y_err = np.atleast_2d(np.asarray(y_err, dtype=float))
+    edges = np.asarray(edges, dtype=float)
+    if valid is None:
+        valid = np.ones(vel.shape, dtype=bool)
+    valid = np.atleast_2d(valid)
+
+    nrow, npix = vel.shape
+    rows = np.arange(nrow)
+    first, last = _stack_edges(valid)
+
+    # Pixel edges: midpoints between pixels, half a pixel beyond the ends.
+    vel_lo = np.empty(vel.shape)
+    vel_lo[:,1:] = (vel[:,:-1]+vel[:,1:])/2.
+    vel_lo[rows, first] = vel[rows, first] - \
+        (vel[rows, np.minimum(first+1, last)]-vel[rows, first])/2.
+    vel_hi = np.empty(vel.shape)
+    vel_hi[:,:-1] = vel_lo[:,1:]
+    vel_hi[rows, last] = vel[rows, last] + \
+        (vel[rows, last]-vel[rows, np.maximum(last-1, first)])/2.
+
+    # Padded pixels sort before/after the data and carry nothing.
+    pix_num_array = np.arange(npix)[None,:]
+    vel_lo = np.where(pix_num_array < first[:,None], -np.inf, vel_lo)
+    vel_lo = np.where(pix_num_array > last[:,None], np.inf, vel_lo)
+    width = np.where(valid, vel_hi-vel_lo, 0.)
+    y = np.where(valid, y, 0.)
+    var = np.where(valid, y_err**2, 0.)
+
+    # Integral of y up to the start of each pixel, and the variance of the
+    #  integral over the whole pixels up to the end of each pixel
+    cum_y = np.cumsum(y*width, axis=1)-y*width
+    cum_var = np.cumsum(var*width**2, axis=1)
+
+    # Integrals up to each common edge, clipped to the covered range
+    cover_lo = vel_lo[rows, first][:,None]
+    cover_hi = vel_hi[rows, last][:,None]
+    grid = np.clip(np.broadcast_to(edges, (nrow, np.size(edges))),
+                    cover_lo, cover_hi)
+    pix = _stack_searchsorted(vel_lo, grid, 'right')-1
+    pix = np.clip(pix, first[:,None], last[:,None])
+    rr = rows[:,None]
+    part = grid-vel_lo[rr, pix]
+    int_y = cum_y[rr, pix] + y[rr, pix]*part
+
+    # The variance of the integral over a bin is not a difference of
+    #  cumulative variances: a part p of a pixel adds var*p**2. Each bin
+    #  holds the rest of its first pixel, the whole pixels in between and
+    #  the start of its last pixel, or a piece of a single pixel.
+    pix_lo, pix_hi = pix[:,:-1], pix[:,1:]
+    part_lo, part_hi = part[:,:-1], part[:,1:]
+    rest_lo = width[rr, pix_lo]-part_lo
+    bin_var = np.where(pix_hi > pix_lo,
+        var[rr, pix_lo]*rest_lo**2 + \
+            (cum_var[rr, pix_hi-1]-cum_var[rr, pix_lo]) + \
+            var[rr, pix_hi]*part_hi**2,
+        var[rr, pix_lo]*(part_hi-part_lo)**2)
+
+    # Average over each bin
+    bin_width = np.diff(edges)
+    y_bin = np.diff(int_y, axis=1)/bin_width
+    y_bin_err = np.sqrt(bin_var)/bin_width
+
+    covered = (edges[:-1] >= cover_lo) & (edges[1:] <= cover_hi)
+    y_bin[~covered] = np.nan
+    y_bin_err[~covered] = np.nan
+
+    return y_bin, y_bin_err, covered
+
+
+def nav_resample(spec_list, dv = None, vrange = None):
+    # Put the Na(v) profiles of a list of spectra onto one common velocity
+    #  grid (see nav_common_grid) with flux-conserving rebinning.
+
+    vel_list = [np.asarray(spec['vel'], dtype=float) for spec in spec_list]
+    edges = nav_common_grid(vel_list, dv = dv, vrange = vrange)
+
+    nspec = len(spec_list)
+    if np.size(edges) < 2:
+        resampled = OrderedDict()
+        resampled['vel'] = np.zeros(0)
+        resampled['vel_edges'] = edges
+        resampled['Nav'] = np.zeros([nspec, 0])
+        resampled['Nav_err'] = np.zeros([nspec, 0])
+        resampled['covered'] = np.zeros([nspec, 0], dtype=bool)
+        return resampled
+
+    npix = np.max([np.size(vel) for vel in vel_list])
+    vel = np.zeros([nspec, npix])
+    nav = np.zeros([nspec, npix])
+    nav_err = np.zeros([nspec, npix])
+    valid = np.zeros([nspec, npix], dtype=bool)
+    for j, spec in enumerate(spec_list):
+        nn = np.size(vel_list[j])
+        vel[j,:nn] = vel_list[j]
+        # Pad with the last velocity so the rows stay sorted
+        vel[j,nn:] = vel_list[j][-1]
+        nav[j,:nn] = spec['Nav']
+        nav_err[j,:nn] = spec['Nav_err']
+        valid[j,:nn] = True
+
+    nav_bin, nav_bin_err, covered = nav_rebin(vel, nav, nav_err,
+                                        edges, valid)
+
+    resampled = OrderedDict()
+    resampled['vel'] = (edges[:-1]+edges[1:])/2.
+    resampled['vel_edges'] = edges
+    resampled['Nav'] = nav_bin
+    resampled['Nav_err'] = nav_bin_err
+    resampled['covered'] = covered
+
+    return resampled
+
+
+def _nav_group(spec):
+    # (target, redshift, ion) of a spectrum: only transitions of the same
+    #  ion in the same absorber are compared.
+    target = spec.get('targname', spec.get('object'))
+    redshift = spec.get('redshift', spec.get('z'))
+    ion = spec['ion']
+    if isinstance(target, bytes):
+        target = target.decode('utf-8')
+    if isinstance(ion, bytes):
+        ion = ion.decode('utf-8')
+    if redshift is not None:
+        redshift = float(np.squeeze(redshift))
+    return target, redshift, ion
+
+
+def _nav_pairs(spec_list):
+    # The transitions of each (target, redshift, ion) group and their
+    #  pairs, ordered (strong, weak) by f*lambda, as indices into
+    #  spec_list.
+    groups = OrderedDict()
+    for j, spec in enumerate(spec_list):
+        groups.setdefault(_nav_group(spec), []).append(j)
+
+    flam = np.array([float(spec['fval'])*float(spec['wavc'])
+                        for spec in spec_list])
+
+    pairs = OrderedDict()
+    for group in groups.keys():
+        idx = groups[group]
+        strong = []
+        weak = []
+        for a in range(len(idx)):
+            for b in range(a+1, len(idx)):
+                i, j = idx[a], idx[b]
+                if flam[i] == flam[j]:
+                    continue
+                if flam[i] < flam[j]:
+                    i, j = j, i
+                strong.append(i)
+                weak.append(j)
+        if strong:
+            pairs[group] = (idx, strong, weak)
+
+    return pairs, flam
+
+
+def pyn_nav_saturation(spec_list, dv = None, vrange = None, nsig = 2.):
+    """Apparent column density ratio test for a catalog of transitions.
+
+    The transitions are grouped by ion, target and redshift. The Na(v)
+    profiles of each group are rebinned to a grid of its own, over the
+    velocities all of them cover and at the coarsest of their pixel
+    spacings (dv and vrange override these), and every pair in the group
+    (strong, weak by f*lambda) is compared pixel by pixel in a single
+    array operation. Without unresolved saturation both lines give the
+    same Na(v); a pixel is flagged as saturated when the weak line's Na(v)
+    exceeds the strong line's by more than nsig times their combined
+    error.
+
+    Returns an OrderedDict with per-pair indices into spec_list ('strong',
+    'weak'), 'ion', the f*lambda ratios and 'flag_sat', which is True if
+    any saturated pixel lies within both lines' integration ranges. The
+    per-pixel results are lists with one array per pair, on the grid of
+    its group: 'vel', the Na(v) ratios strong/weak ('ratio', 'ratio_err')
+    and the saturated pixels ('sat_pix').
+    """
+
+    pairs, flam = _nav_pairs(spec_list)
+
+    v1 = np.array([float(spec['v1']) for spec in spec_list])
+    v2 = np.array([float(spec['v2']) for spec in spec_list])
+
+    results = OrderedDict()
+    for kkk in ['vel', 'strong', 'weak', 'ion', 'flambda_ratio', 'ratio',
+                'ratio_err', 'sat_pix', 'flag_sat']:
+        results[kkk] = []
+
+    for group in pairs.keys():
+        idx, strong, weak = pairs[group]
+        resampled = nav_resample([spec_list[j] for j in idx],
+                                    dv = dv, vrange = vrange)
+
+        # Rows of the group's grid for each pair
+        row = dict((j, r) for r, j in enumerate(idx))
+        rs = [row[j] for j in strong]
+        rw = [row[j] for j in weak]
+
+        nav = resampled['Nav']
+        nav_err = resampled['Nav_err']
+        vel = resampled['vel']
+
+        nav_s, nav_s_err = nav[rs], nav_err[rs]
+        nav_w, nav_w_err = nav[rw], nav_err[rw]
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            ratio = nav_s/nav_w
+            ratio_err = np.abs(ratio)*np.sqrt((nav_s_err/nav_s)**2 + \
+                            (nav_w_err/nav_w)**2)
+
+            # Weak line's Na(v) significantly above the strong line's
+            sat_pix = (nav_w-nav_s) > nsig*np.sqrt(nav_s_err**2+nav_w_err**2)
+
+        # Flag saturation within the overlap of the integration ranges
+        lo = np.maximum(v1[strong], v1[weak])[:,None]
+        hi = np.minimum(v2[strong], v2[weak])[:,None]
+        in_range = (vel[None,:] >= lo) & (vel[None,:] <= hi)
+
+        results['vel'] += [vel]*len(strong)
+        results['strong'] += strong
+        results['weak'] += weak
+        results['ion'] += [group[2]]*len(strong)
+        results['ratio'] += list(ratio)
+        results['ratio_err'] += list(ratio_err)
+        results['sat_pix'] += list(sat_pix)
+        results['flag_sat'] += list((sat_pix & in_range).any(axis=1))
+
+    results['strong'] = np.array(results['strong'], dtype=int)
+    results['weak'] = np.array(results['weak'], dtype=int)
+    results['flambda_ratio'] = flam[results['strong']]/flam[results['weak']]
+    results['flag_sat'] = np.array(results['flag_sat'], dtype=bool)
+
+    return results
@@ -0,0 +1,135 @@
+import numpy as np
+# Storage precision of the pixel arrays.
+#
+#  -- 'float64' (the default): arrays are kept at the precision they come
+#     in with, as pyNorm has always done
+#  -- 'float32': the per-pixel arrays of a spectrum (flux, errors,
+#     continuum, Na(v), ...) are stored as native float32, halving the
+#     memory of a sightline catalog
+#
+# The pixel grids ('vel', 'wave', 'vnorm') are always kept in float64, and
+#  every sum over pixels includes the pixel spacing, so the integrals are
+#  accumulated in float64 in either mode; only the per-pixel values are
+#  rounded to float32. A float32 value carries a relative error of at most
+#  2**-24 (6e-8), but the integrals take differences of nearly equal numbers
+#  (1-flux/contin, the moments about <v>), which amplifies it. For float64
+#  spectra measured both ways (tests/test_pyn_precision.py: the docs/Data
+#  spectra perturbed below float32 resolution and synthetic absorbers of
+#  S/N 8-80) float32 storage changes log N and its errors by < 1e-6 dex,
+#  EW and its errors by < 2e-6 (relative), va and ba by < 1e-4 km/s and
+#  m3 by < 1e-3; dv90 and v90a/b snap to pixels and were unchanged.
+#  Weaker lines can do worse in relative terms. Continuum fits are solved
+#  in float64 either way.
+
+_PRECISIONS = {'float32': np.dtype(np.float32),
+                'float64': np.dtype(np.float64)}
+
+# Arrays that are never reduced in precision: the pixel grids, velocity
+#  ranges and fit coefficients
+_FLOAT64_KEYS = ('vel', 'wave', 'vnorm',
+    'contin_v1', 'contin_v2', 'contin_coeff')
+
+_precision = {'name': 'float64'}
+
+
+def _precision_name(precision):
+    # Accept 'float32', np.float32, np.dtype('float32'), ...
+    try:
+        name = np.dtype(precision).name
+    except TypeError:
+        name = None
+    if name not in _PRECISIONS:
+        raise ValueError('Precision must be float32 or float64, '
+                            'not {0}'.format(precision))
+    return name
+
+
+def set_precision(precision = 'float64'):
+    """Set the global storage precision ('float32' or 'float64') of the
+    per-pixel arrays. Returns the previous setting.
+    """
+    previous = _precision['name']
+    _precision['name'] = _precision_name(precision)
+    return previous
+
+
+def get_precision():
+    """The current storage precision, 'float32' or 'float64'."""
+    return _precision['name']
+
+
+class precision(object):
+    """Context manager for a temporary storage precision:
+
+        with precision('float32'):
+            spec = read_inorm('CIV1548.2i_o.save')
+    """
+
+    def __init__(self, precision):
+        self.name = _precision_name(precision)
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = set_precision(self.name)
+        return self
+
+    def __exit__(self, *args):
+        set_precision(self.previous)
+        return False
+
+
+def low_memory():
+    # Is float32 storage in effect?
+    return _precision['name'] == 'float32'
+
+
+def storage_array(x, precision = None):
+    """A floating-point array in the storage precision (native byte order).
+    Other values, and everything in float64 mode, are returned unchanged.
+    """
+    if precision is None:
+        precision = _precision['name']
+    if _precision_name(precision) == 'float64':
+        return x
+
+    if isinstance(x, np.ndarray) and (x.dtype.kind == 'f') and \
+        (x.dtype != _PRECISIONS['float32']):
+        return x.astype(np.float32)
+    return x
+
+
+def pyn_precision(spec_in, precision = None, inplace = False):
+    """Convert the per-pixel arrays of a spectrum to the storage precision
+    (by default the global setting; see set_precision).
+
+    In float32 mode, floating-point arrays are stored as float32 while the
+    pixel grids ('vel', 'wave', 'vnorm'), the continuum ranges and the
+    continuum coefficients are kept as (native) float64. Scalar
+    measurements are not touched. In float64 mode the spectrum is returned
+    as it is.
+    """
+
+    if precision is None:
+        precision = _precision['name']
+    precision = _precision_name(precision)
+
+    if inplace:
+        spec = spec_in
+    else:
+        spec = spec_in.copy()
+
+    if precision == 'float64':
+        return spec
+
+    for kkk in list(spec.keys()):
+        value = spec[kkk]
+        if not (isinstance(value, np.ndarray) and (value.dtype.kind == 'f')
+                    and (value.ndim > 0)):
+            continue
+        if kkk in _FLOAT64_KEYS:
+            if value.dtype != _PRECISIONS['float64']:
+                spec[kkk] = value.astype(np.float64)
+        else:
+            spec[kkk] = storage_array(value, precision)
+
+    return spec
@@ -0,0 +1,198 @@
+import contextlib
+import logging
+import sys
+import warnings
+from typing import NamedTuple
+import numpy as np
+# Measurement records and the human-readable pyn_batch report.
+#
+#  -- The report goes through the logging module ('pyNorm' loggers) with
+#     lazy formatting: nothing is formatted unless the message is emitted
+#  -- As a library, pyNorm only attaches a NullHandler: applications
+#     capture, redirect or silence its messages with their own logging
+#     setup
+#  -- pyn_batch logs its report at INFO; under verbose_output() it is
+#     printed on stdout if logging is not configured
+
+logger = logging.getLogger('pyNorm.aod')
+logger.addHandler(logging.NullHandler())
+
+
+def _logging_configured(log):
+    # Is there a handler (other than a NullHandler) that would see the
+    #  records of log?
+    while log is not None:
+        for handler in log.handlers:
+            if not isinstance(handler, logging.NullHandler):
+                return True
+        if not log.propagate:
+            return False
+        log = log.parent
+    return False
+
+
+class verbose_output(object):
+    """Context manager under which the INFO messages of the 'pyNorm.aod'
+    logger are printed on stdout, unless the application has configured
+    logging, in which case its setup is left alone.
+    """
+
+    def __init__(self):
+        self.handler = None
+        self.level = None
+
+    def __enter__(self):
+        if not _logging_configured(logger):
+            self.handler = logging.StreamHandler(sys.stdout)
+            self.handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(self.handler)
+            if logger.getEffectiveLevel() > logging.INFO:
+                self.level = logger.level
+                logger.setLevel(logging.INFO)
+        return self
+
+    def __exit__(self, *args):
+        if self.handler is not None:
+            logger.removeHandler(self.handler)
+            self.handler = None
+        if self.level is not None:
+            logger.setLevel(self.level)
+            self.level = None
+        return False
+
+
+def _verbose_report(name, verbose):
+    # The context of the report for the deprecated verbose keyword of
+    #  pyn_batch and the readers: verbose = True prints it, as
+    #  verbose_output() does. name(...) is called by the user through the
+    #  timed() wrapper, hence the stack level.
+    if verbose is not None:
+        warnings.warn(name+'(verbose = ...) is deprecated: the report is '
+                        'logged by the pyNorm.aod logger; wrap the call in '
+                        'verbose_output() to print it.',
+                        DeprecationWarning, stacklevel = 4)
+    if verbose:
+        return verbose_output()
+    return contextlib.nullcontext()
+
+
+class Measurement(NamedTuple):
+    """AOD measurements of one transition, as filled in by pyn_batch."""
+    ion: str
+    wni: str
+    wavc: float
+    fval: float
+    v1: float
+    v2: float
+    ncol: float
+    ncol_err_lo: float
+    ncol_err_hi: float
+    flag_sat: bool
+    flag_blemish: bool
+    EW: float
+    EW_err: float
+    EW_err_stat: float
+    EW_err_cont: float
+    EW_err_zero: float
+    detection_2sig: bool
+    detection_3sig: bool
+    ncol_linearCoG: float
+    ncol_linear2sig: float
+    ncol_linear3sig: float
+    va: float
+    va_err: float
+    ba: float
+    ba_err: float
+    m3: float
+    m3_err: float
+    dv90: float
+    v90a: float
+    v90b: float
+
+
+def _as_str(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return str(value)
+
+def _field(spec, kkk, kind):
+    # Missing entries are NaN (floats), False (flags) or '' (names).
+    try:
+        value = spec[kkk]
+    except KeyError:
+        return {str: '', float: np.nan, bool: False}[kind]
+    if kind is str:
+        return _as_str(value)
+    return kind(value)
+
+
+def pyn_measurement(spec):
+    """The Measurement record of a spectrum measured by pyn_batch."""
+    types = Measurement.__annotations__
+    return Measurement(*[_field(spec, kkk, types[kkk])
+                            for kkk in Measurement._fields])
+
+
+# The report, formatted from a dictionary by the logging module
+_DASHES = '--------------------------------------------'
+_REPORT = '\n'.join([
+    '********** %(ion)s %(wni)s **********',
+    'pyn_batch: Wavelength = %(wavc)0.3f',
+    'pyn_batch: f-value = %(fval)0.3e',
+    '',
+    'Velocity range of integration: %(v1)0.1f <= v <= %(v2)0.1f',
+    '',
+    _DASHES,
+    '%(blemish_warning)s%(sat_warning)s'
+    'log N %(ncol_sign)s %(ncol)0.3f (%(ncol_err_lo)+0.3f, %(ncol_err_hi)+0.3f)',
+    '%(sat_dashes)s' + _DASHES,
+    '',
+    _DASHES,
+    '<v>       = %(va)6.2f  +/- %(va_err)0.2f',
+    '<b>       = %(ba)6.2f  +/- %(ba_err)0.2f',
+    'dv90      = %(dv90)6.2f  +/- %(dv90_err)0.2f',
+    'Skew      = %(m3)6.2f  +/- %(m3_err)0.2f',
+    _DASHES,
+    '',
+    _DASHES,
+    'EW           = %(EW)0.2f',
+    'Stat Error   = %(EW_err_stat)0.2f',
+    'Cont Error   = %(EW_err_cont)0.2f',
+    'Tot Error    = %(EW_err)0.2f',
+    '3sigma EW    < %(ew3sigma)0.2f',
+    '%(detection_warning)s',
+    '',
+    'Linear COG N = %(ncol_linearCoG)0.2f',
+    '2sigma N     < %(ncol_linear2sig)0.2f',
+    '3sigma N     < %(ncol_linear3sig)0.2f',
+    _DASHES])
+
+
+def log_measurement(record, level = logging.INFO):
+    """Log the human-readable summary of a Measurement record. Nothing is
+    formatted unless the 'pyNorm.aod' logger emits at this level.
+    """
+    if not logger.isEnabledFor(level):
+        return
+
+    args = record._asdict()
+    args['blemish_warning'] = ''
+    if record.flag_blemish:
+        args['blemish_warning'] = \
+            '***** WARNING: BLEMISHES PRESENT IN THE INTEGRATION RANGE! *****\n'
+    args['sat_warning'] = ''
+    args['sat_dashes'] = ''
+    args['ncol_sign'] = '='
+    if record.flag_sat:
+        args['sat_warning'] = '***** WARNING: SATURATION IS PRESENT! *****\n' + \
+            _DASHES + '\n'
+        args['sat_dashes'] = _DASHES + '\n'
+        args['ncol_sign'] = '>'
+    args['dv90_err'] = record.va_err*np.sqrt(2)
+    args['ew3sigma'] = 3.*record.EW_err
+    args['detection_warning'] = ''
+    if not record.detection_3sig:
+        args['detection_warning'] = \
+            '***** WARNING: LINE NOT DETECTED AT 3 SIGMA! *****\n'
+
+    logger.log(level, _REPORT, args)
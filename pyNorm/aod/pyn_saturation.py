@@ -0,0 +1,56 @@
+import numpy as np
+from .pyn_record import logger
+# Saturation correction for doublets following Savage & Sembach (1991).
+#
+# Assumptions:
+#
+#  -- The two lines of each pair differ by a factor of ~2 in f*lambda
+#  -- Apparent column densities are in log10, errors symmetric in dex
+
+
+def pyn_correct_saturation(logN, err_logN, corr_max = 0.15):
+    """Correct mildly saturated apparent column densities of doublets
+    following the recommendation of Savage & Sembach (1991).
+
+    logN and err_logN are (..., 2) arrays holding the apparent log column
+    densities and their errors of each pair, ordered [strong, weak]. Pairs
+    given in the wrong order (strong line with the larger column) are
+    swapped. The correction is a polynomial fit to the SS1991 results in
+    the difference weak - strong, added to the weak line's column; if it
+    reaches corr_max, corr_max is applied and the result is saturated (a
+    lower limit).
+
+    Returns the corrected log column densities, their errors and the
+    saturation flags, each of the shape logN.shape[:-1].
+    """
+
+    logN = np.asarray(logN, dtype=float)
+    err_logN = np.asarray(err_logN, dtype=float)
+
+    logN_strong, logN_weak = logN[...,0], logN[...,1]
+    err_strong, err_weak = err_logN[...,0], err_logN[...,1]
+
+    # The difference in columns. Assume the lines are reversed if it is
+    #  negative.
+    swapped = (logN_weak < logN_strong)
+    if swapped.any():
+        logger.warning('pyn_correct_saturation: %d pair(s) with a negative '
+            'logN difference were taken to be reversed.', np.sum(swapped))
+        logN_strong, logN_weak = np.where(swapped, logN_weak, logN_strong), \
+            np.where(swapped, logN_strong, logN_weak)
+        err_strong, err_weak = np.where(swapped, err_weak, err_strong), \
+            np.where(swapped, err_strong, err_weak)
+    ssdiff = logN_weak-logN_strong
+
+    # Calculate the correction using polynomial fit to SS1991 results.
+    sscorrect = 16.026*ssdiff**3 - 0.507*ssdiff**2 \
+                + 0.9971*ssdiff + 5.e-5
+    err_logNf = np.sqrt(err_weak**2 + \
+        ((48.078*ssdiff**2 - 1.014*ssdiff + 0.9971)* \
+            np.sqrt(err_weak**2 + err_strong**2))**2)
+
+    # Corrections beyond corr_max: apply the maximum, flag as saturated.
+    flag_sat = (sscorrect >= corr_max)
+    logNf = logN_weak + np.where(flag_sat, corr_max, sscorrect)
+
+    return logNf, err_logNf, flag_sat
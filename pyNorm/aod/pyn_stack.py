@@ -0,0 +1,442 @@
+import numpy as np
+from collections import OrderedDict
+from .pyn_aod import _moments
+# Vectorized AOD measurements for stacks of transitions.
+#
+# Assumptions:
+#
+#  -- Arrays are passed as 2-D (n_transitions x n_pixels) stacks
+#  -- Each row holds one spectrum on its own velocity grid
+#  -- Ragged grids are padded; the valid pixels of a row are contiguous
+#  -- Velocity spacing is constant (enough) within each row
+
+
+def stack_spectra(spec_list):
+    """Stack a list of pyNorm spec dictionaries into padded 2-D arrays.
+
+    Returns an OrderedDict holding the (n_spec x n_pixels) arrays 'vel',
+    'flux', 'eflux', 'contin', 'contin_err', 'wave' and 'valid', plus the
+    per-spectrum vectors 'wavc', 'fval' and 'integration_limits'. The
+    output can be passed directly to pyn_stack as keyword arguments.
+    """
+
+    lightspeed = 2.998e5 # km/s
+
+    nspec = len(spec_list)
+    npix = np.max([np.size(spec['vel']) for spec in spec_list])
+
+    stack = OrderedDict()
+    for kkk in ['vel','flux','eflux','contin','contin_err','wave']:
+        stack[kkk] = np.zeros([nspec, npix])
+    stack['valid'] = np.zeros([nspec, npix], dtype=bool)
+    stack['wavc'] = np.zeros(nspec)
+    stack['fval'] = np.zeros(nspec)
+    stack['integration_limits'] = np.zeros([nspec, 2])
+
+    for j, spec in enumerate(spec_list):
+        nn = np.size(spec['vel'])
+
+        # Deal with the continuum:
+        if "contin" in spec.keys():
+            continuum = spec['contin']
+        else:
+            try:
+                continuum = spec['cont']
+            except:
+                continuum = spec['ycon']
+
+        if "contin_err" in spec.keys():
+            continuum_err = spec['contin_err']
+        else:
+            try:
+                continuum_err = spec['econt']
+            except:
+                continuum_err = spec['ycon_sig']
+
+        # Create the wavelength array if it doesn't exist
+        try:
+            wave = spec['wave']
+        except:
+            wave = spec['wavc']*(spec['vel']/lightspeed)+spec['wavc']
+
+        stack['vel'][j,:nn] = spec['vel']
+        stack['flux'][j,:nn] = spec['flux']
+        stack['eflux'][j,:nn] = spec['eflux']
+        stack['contin'][j,:nn] = continuum
+        stack['contin_err'][j,:nn] = continuum_err
+        stack['wave'][j,:nn] = wave
+        stack['valid'][j,:nn] = True
+
+        stack['wavc'][j] = spec['wavc']
+        stack['fval'][j] = spec['fval']
+        stack['integration_limits'][j] = [spec['v1'], spec['v2']]
+
+    return stack
+
+
+def _stack_edges(valid):
+    # First and last valid pixel of each row.
+    npix = valid.shape[1]
+    first = np.argmax(valid, axis=1)
+    last = npix - 1 - np.argmax(valid[:,::-1], axis=1)
+
+    return first, last
+
+
+def _stack_delta(x, valid, first, last):
+    # Pixel-to-pixel differences along each row, repeating the last
+    # difference for the final valid pixel (as in pyn_column).
+    rows = np.arange(x.shape[0])
+
+    delx = np.zeros_like(x)
+    delx[:,:-1] = x[:,1:]-x[:,:-1]
+    delx[rows, last] = delx[rows, np.maximum(last-1, first)]
+    delx[~valid] = 0.
+
+    return delx
+
+
+def _stack_searchsorted(a, v, side='left'):
+    # Row-by-row np.searchsorted: indices into each (sorted) row of a at
+    #  which the values in the same row of v would be inserted. A binary
+    #  search carried out on all rows and values at once.
+    a = np.atleast_2d(a)
+    v = np.atleast_2d(v)
+    nrow, npix = a.shape
+    rows = np.arange(nrow)[:,None]
+
+    lo = np.zeros(v.shape, dtype=int)
+    hi = np.full(v.shape, npix)
+    for iteration in range(int(np.ceil(np.log2(npix+1)))):
+        active = (lo < hi)
+        mid = (lo+hi)//2
+        amid = a[rows, np.minimum(mid, npix-1)]
+        if side == 'left':
+            go_right = active & (amid < v)
+        else:
+            go_right = active & (amid <= v)
+        lo = np.where(go_right, mid+1, lo)
+        hi = np.where(active & ~go_right, mid, hi)
+
+    return lo
+
+
+def _stack_spacing(vel, valid, first, last):
+    # Pixel spacing of each row; like integration_weights, this is the
+    #  median over the rolled differences, including the wrap-around term.
+    rows = np.arange(vel.shape[0])
+    rolled = np.full(vel.shape, np.nan)
+    rolled[:,:-1] = vel[:,1:]-vel[:,:-1]
+    rolled[rows, last] = vel[rows, first]-vel[rows, last]
+    rolled[~valid] = np.nan
+
+    return np.nanmedian(rolled, axis=1)
+
+
+def stack_integration_weights(vel, limits, valid=None):
+    # Calculate the weighting for each pixel in the column density
+    #  integration for every row of a stack. Includes partial pixel
+    #  weighting for edge effects. Row-by-row equivalent of
+    #  integration_weights.
+
+    vel = np.atleast_2d(vel)
+    limits = np.broadcast_to(limits, (vel.shape[0], 2))
+    if valid is None:
+        valid = np.ones(vel.shape, dtype=bool)
+
+    nrow, npix = vel.shape
+    rows = np.arange(nrow)
+    first, last = _stack_edges(valid)
+
+    delx = _stack_spacing(vel, valid, first, last)[:,None]
+
+    v1 = limits[:,0][:,None]
+    v2 = limits[:,1][:,None]
+
+    # Find the pixels that are fully within our integration range.
+    idx = ((vel-delx/2 >= v1) & (vel+delx/2 < v2) & valid)
+    weights = idx*1.0
+
+    # Limits of complete pixels in indices.
+    lo_full = np.argmax(idx, axis=1)
+    hi_full = npix - 1 - np.argmax(idx[:,::-1], axis=1)
+    has_full = idx.any(axis=1)
+
+    # Identify edge pixels; as in integration_weights, an edge pixel
+    #  below the start of the row wraps around to the last pixel.
+    lo_pix = lo_full-1
+    lo_pix = np.where(lo_pix < first, last, lo_pix)
+    hi_pix = hi_full+1
+
+    # Fraction of edge pixels contained within integration ranges
+    delx = delx[:,0]
+    lo_frac = ((vel[rows, lo_pix]+delx/2)-limits[:,0])/(delx)
+    hi_frac = (limits[:,1]-(vel[rows, np.minimum(hi_pix, npix-1)]-delx/2))/(delx)
+
+    # Assign fractional weights to the edge pixels
+    gd = has_full
+    weights[rows[gd], lo_pix[gd]] = lo_frac[gd]
+    gd = has_full & (hi_pix <= last)
+    weights[rows[gd], hi_pix[gd]] = hi_frac[gd]
+
+    return weights
+
+
+def stack_xlimit_weights(vel, limits, valid=None):
+    # Uniform weights for integer pixel integrations for every row of
+    #  a stack. Row-by-row equivalent of xlimit.
+
+    vel = np.atleast_2d(vel)
+    limits = np.broadcast_to(limits, (vel.shape[0], 2))
+    if valid is None:
+        valid = np.ones(vel.shape, dtype=bool)
+
+    npix = vel.shape[1]
+    first, last = _stack_edges(valid)
+    pix_num_array = np.arange(npix)[None,:]
+
+    # To be consistent with iNorm, we use x>=xmin, x<xmax
+    above1 = (vel >= limits[:,0][:,None]) & valid
+    above2 = (vel > limits[:,1][:,None]) & valid
+    idx1 = np.argmax(above1, axis=1)
+    idx2 = np.where(above2.any(axis=1), np.argmax(above2, axis=1), last+1)-1
+
+    weights = ((pix_num_array >= idx1[:,None]) &
+               (pix_num_array <= idx2[:,None]) & valid)*1.0
+
+    return weights
+
+
+def _stack_tau(flux, flux_err, continuum, valid):
+    # Saturation-corrected optical depth arrays, as in pyn_column.
+
+    # Test for clearly saturated pixels:
+    idx_saturation = (flux <= 0.) & valid
+
+    # Fix saturation if it's present.
+    flux = np.where(idx_saturation, np.abs(flux), flux)
+    flux = np.where((flux == 0) & valid, 2.*flux_err, flux)
+
+    # Create an optical depth array and its error
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau_array = np.log(continuum / flux)
+        tau_array_err = np.sqrt((flux_err/flux)**2)
+
+    # If optical depth NaN, set to zero.
+    # This happens when continuum < 0.
+    bd = np.isnan(tau_array)
+    tau_array[bd] = 0.
+    tau_array_err[bd] = 0.
+
+    return tau_array, tau_array_err, idx_saturation
+
+
+def _stack_kernel(vel, flux, flux_err, continuum, continuum_err,
+                    wavc, fval, weights, delv, delw, valid):
+    # Core AOD calculations on padded 2-D stacks. Padded pixels must
+    #  carry zero weights, zero delv/delw, unit flux and continuum and
+    #  zero errors. wavc and fval are column vectors.
+
+    # Some constants
+    column_factor = 2.654e-15
+    ew_factor = 1.13e17
+
+    results = OrderedDict()
+
+    # ---- Equivalent width [pyn_eqwidth]
+    # Calculate the equivalent width
+    ew_pix = (1.-flux/continuum)*delw*weights
+    eqw_int = np.sum(ew_pix, axis=1)
+    # Random flux errors
+    eqw_stat_err = \
+        np.sqrt(np.sum((flux_err/continuum*delw*weights)**2, axis=1))
+    # Continuum errors
+    eqw_cont_err = \
+        np.sum(continuum_err*(flux/continuum**2)*delw*weights, axis=1)
+
+    # Zero point error
+    z_eps = 0.01
+    eqw_zero_err = z_eps*eqw_int
+
+    # Combine errors
+    eqw_err = np.sqrt(eqw_stat_err**2 \
+        +eqw_cont_err**2 + eqw_zero_err**2)
+
+    # Store the EW in milliAngstrom
+    results['EW'] = eqw_int*1000.
+    results['EW_err'] = eqw_err*1000.
+    results['EW_err_stat'] = eqw_stat_err*1000.
+    results['EW_err_cont'] = eqw_cont_err*1000.
+    results['EW_err_zero'] = eqw_zero_err*1000.
+    results['EW_cumulative'] = np.cumsum(ew_pix, axis=1)*1000.
+
+    # Calculate linear column density and error.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        linear_ncol = \
+          ew_factor*results['EW']/(fval[:,0]*wavc[:,0]**2)
+        linear_ncol2sig = 2.0* \
+          ew_factor*results['EW_err']/(fval[:,0]*wavc[:,0]**2)
+        linear_ncol3sig = 3.0* \
+          ew_factor*results['EW_err']/(fval[:,0]*wavc[:,0]**2)
+
+        results['ncol_linearCoG'] = np.round(np.log10(linear_ncol),4)
+        results['ncol_linear2sig'] = np.round(np.log10(linear_ncol2sig),4)
+        results['ncol_linear3sig'] = np.round(np.log10(linear_ncol3sig),4)
+
+    # Is the line detected at 2, 3 sigma?
+    results['detection_2sig'] = results['EW'] >= 2.*results['EW_err']
+    results['detection_3sig'] = results['EW'] >= 3.*results['EW_err']
+
+    # ---- Apparent column density [pyn_column]
+    tau_array, tau_array_err, idx_saturation = \
+        _stack_tau(flux, flux_err, continuum, valid)
+
+    # Set overall saturation flag for saturation in the integration range
+    results['flag_sat'] = (idx_saturation*weights).sum(axis=1) > 0
+
+    # Integrate the apparent optical depth
+    tau_int = np.sum(tau_array*delv*weights, axis=1)
+    tau_int_err = \
+     np.sqrt(np.sum((tau_array_err*delv*weights)**2, axis=1))
+
+    # Create an apparent column density array
+    nav_array = tau_array/(wavc*fval*column_factor)
+    nav_err_stat = tau_array_err/(wavc*fval*column_factor)
+    nav_err_cont = (continuum_err/continuum)/(wavc*fval*column_factor)
+    nav_err_tot = np.sqrt(nav_err_stat**2 + nav_err_cont**2)
+
+    # Integrate the apparent column density profiles
+    column = tau_int/(wavc[:,0]*fval[:,0]*column_factor)
+
+    # Error in the column
+    column_err = tau_int_err/(wavc[:,0]*fval[:,0]*column_factor)
+
+    # Continuum error: errors are correlated, so don't add in quadrature.
+    column_err_cont = \
+        np.sum(((continuum_err/continuum)*delv*weights), axis=1) /\
+         (wavc[:,0]*fval[:,0]*column_factor)
+
+    # Combine errors
+    column_err_total = np.sqrt(column_err**2 \
+        +column_err_cont**2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results['ncol'] = np.log10(column)
+        results['ncol_err_lo'] = \
+            np.log10(column-column_err_total) - np.log10(column)
+        results['ncol_err_hi'] = \
+            np.log10(column+column_err_total) - np.log10(column)
+
+    # Fill the Na(v) arrays
+    results['Nav'] = nav_array
+    results['Nav_err'] = nav_err_tot
+    results['Nav_sat'] = idx_saturation
+
+    # ---- Velocity moments [pyn_istat]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        moments = _stack_moments(vel, flux, flux_err,
+                    continuum, continuum_err, weights, delv)
+    results.update(moments)
+
+    # Add the weights of the pixel integrations
+    results['integration_weights'] = weights
+
+    return results
+
+
+def _stack_moments(velocity, flux, flux_err, continuum, continuum_err,
+                    weights, delv):
+    # Velocity moments of the apparent optical depth for every row of a
+    #  stack, with the pyn_istat kernel.
+
+    m1, m1err, bvalue, bvalue_err, m3, m3err, tau_cum, tau_tot = \
+        _moments(velocity, flux, flux_err, continuum, continuum_err,
+                    weights, delv)
+
+    # Velocities at 5% and 95% of total optical depth as dv90
+    rows = np.arange(velocity.shape[0])
+    # 5% limit
+    v90a = (np.abs(tau_cum/tau_tot-0.05)).argmin(axis=1)
+    v90a = velocity[rows, v90a]
+    # 95% limit
+    v90b = (np.abs(tau_cum/tau_tot-0.95)).argmin(axis=1)
+    v90b = velocity[rows, v90b]
+
+    # Calculate dv90:
+    dv90 = np.abs(v90b - v90a)
+
+    moments = OrderedDict()
+    moments['va'] = m1[:,0]
+    moments['va_err'] = m1err[:,0]
+    moments['ba'] = bvalue[:,0]
+    moments['ba_err'] = bvalue_err[:,0]
+    moments['m3'] = m3[:,0]
+    moments['m3_err'] = m3err[:,0]
+    moments['dv90'] = dv90
+    moments['v90a'] = v90a
+    moments['v90b'] = v90b
+
+    return moments
+
+
+def pyn_stack(vel, flux, eflux, contin, contin_err, wavc, fval,
+                integration_limits, valid = None, wave = None,
+                partial_pixels = True):
+    """Measure columns, equivalent widths and velocity moments for a stack
+    of transitions in one vectorized pass.
+
+    vel, flux, eflux, contin, contin_err and (optionally) wave are
+    (n_transitions x n_pixels) arrays; wavc and fval are n_transitions
+    vectors and integration_limits is an (n_transitions x 2) array (or a
+    single [v1, v2] pair applied to every row). For ragged grids, valid
+    marks the (contiguous) pixels of each row that hold data.
+
+    Returns an OrderedDict of arrays keyed as the pyn_eqwidth, pyn_column
+    and pyn_istat outputs; scalar quantities are n_transitions vectors and
+    per-pixel quantities (Nav, EW_cumulative, ...) are 2-D.
+    """
+
+    lightspeed = 2.998e5 # km/s
+
+    vel = np.atleast_2d(np.asarray(vel, dtype=float))
+    nrow = vel.shape[0]
+    if valid is None:
+        valid = np.ones(vel.shape, dtype=bool)
+    valid = np.atleast_2d(valid)
+
+    wavc = np.broadcast_to(np.asarray(wavc, dtype=float), (nrow,))[:,None]
+    fval = np.broadcast_to(np.asarray(fval, dtype=float), (nrow,))[:,None]
+    integration_limits = np.broadcast_to(
+        np.asarray(integration_limits, dtype=float), (nrow, 2))
+
+    # Padded pixels get unit flux and continuum, no errors and no weight.
+    flux = np.where(valid, flux, 1.)
+    flux_err = np.where(valid, eflux, 0.)
+    continuum = np.where(valid, contin, 1.)
+    continuum_err = np.where(valid, contin_err, 0.)
+    velocity = np.where(valid, vel, 0.)
+
+    # Work out partial pixel weighting
+    if partial_pixels:
+        weights = stack_integration_weights(vel, integration_limits, valid)
+    # Uniform weighting if not partial pixel weighting
+    else:
+        weights = stack_xlimit_weights(vel, integration_limits, valid)
+
+    # Arrays of delta v and delta wavelength
+    first, last = _stack_edges(valid)
+    delv = _stack_delta(velocity, valid, first, last)
+    if wave is None:
+        wave = wavc*(velocity/lightspeed)+wavc
+    delw = _stack_delta(np.where(valid, wave, 0.), valid, first, last)
+
+    results = _stack_kernel(velocity, flux, flux_err,
+                continuum, continuum_err, wavc, fval,
+                weights, delv, delw, valid)
+
+    results['v1'] = integration_limits[:,0].copy()
+    results['v2'] = integration_limits[:,1].copy()
+    results.move_to_end('v2', last=False)
+    results.move_to_end('v1', last=False)
+
+    return results
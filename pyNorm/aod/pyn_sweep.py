@@ -0,0 +1,223 @@
+import numpy as np
+from collections import OrderedDict
+from .pyn_aod import _spectrum_arrays, _velocity_spacing
+# Integration-limit sweeps: column densities and equivalent widths for
+#  many [v1, v2] pairs on a single spectrum.
+#
+# Assumptions:
+#
+#  -- Arrays are passed as velocity, flux
+#  -- Velocity increases monotonically
+#  -- Velocity spacing is constant (enough)
+
+
+class AODSweep(object):
+    """Column densities and equivalent widths for arbitrary integration limits.
+
+    The per-pixel terms of pyn_column and pyn_eqwidth are summed once into
+    prefix (cumulative) sums. The sum over any [v1, v2] is then the
+    difference of two prefix sums plus the two partial edge pixels, found
+    by binary search, so each query costs the same no matter how wide the
+    integration range is. v1 and v2 may be scalars or arrays (broadcast
+    against each other); the grid method fills a full (v1 x v2) grid.
+
+    Ranges that contain no complete pixel (including v1 >= v2) return NaN.
+    """
+
+    # Some constants
+    column_factor = 2.654e-15
+    lightspeed = 2.998e5 # km/s
+
+    def __init__(self, spec, partial_pixels = True):
+
+        velocity, flux, flux_err, wavc, fval, continuum, continuum_err = \
+            _spectrum_arrays(spec)
+
+        self.partial_pixels = partial_pixels
+        self.velocity = velocity
+        self.wavc = wavc
+        self.fval = fval
+
+        # Pixel spacing, as in integration_weights, and the pixel edges
+        #  searched by each query
+        self.delx = np.median(np.roll(velocity,-1)-velocity)
+        self._lo_edges = velocity-self.delx/2
+        self._hi_edges = velocity+self.delx/2
+
+        # Arrays of delta v and delta wavelength:
+        delv = _velocity_spacing(velocity)
+        try:
+            wave = spec['wave']
+        except:
+            wave = wavc*(velocity/self.lightspeed)+wavc
+        delw = _velocity_spacing(wave)
+
+        # Saturation and optical depth, as in pyn_column
+        idx_saturation = (flux <= 0.)
+        flux_aod = np.where(idx_saturation, np.abs(flux), flux)
+        flux_aod = np.where((flux_aod==0), 2.*flux_err, flux_aod)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tau_array = np.log(continuum / flux_aod)
+            tau_array_err = np.sqrt((flux_err/flux_aod)**2)
+        bd = np.isnan(tau_array)
+        tau_array[bd] = 0.
+        tau_array_err[bd] = 0.
+
+        # Terms that enter the sums linearly in the weights:
+        #   tau*dv, continuum error in N, EW, continuum error in EW, saturation
+        linear = np.array([tau_array*delv,
+                    (continuum_err/continuum)*delv,
+                    (1.-flux/continuum)*delw,
+                    continuum_err*(flux/continuum**2)*delw,
+                    idx_saturation*1.0], dtype=float)
+        # Terms that enter as squares of the weights (variances):
+        #   N statistical error, EW statistical error
+        quadratic = np.array([(tau_array_err*delv)**2,
+                    (flux_err/continuum*delw)**2], dtype=float)
+
+        self._linear = linear
+        self._quadratic = quadratic
+
+        # Prefix sums, with a leading zero so that the sum over the pixels
+        #  [i, j) is prefix[j]-prefix[i].
+        self._linear_sum = np.concatenate((np.zeros([len(linear), 1]),
+                                np.cumsum(linear, axis=1)), axis=1)
+        self._quadratic_sum = np.concatenate((np.zeros([len(quadratic), 1]),
+                                np.cumsum(quadratic, axis=1)), axis=1)
+
+    def _edges(self, v1, v2):
+        # Complete pixels [first, stop) plus the fractions of the partial
+        #  pixels lo (= first-1) and hi (= stop) in the integration.
+        x = self.velocity
+        npix = np.size(x)
+
+        if self.partial_pixels:
+            delx = self.delx
+            # Pixels fully within our integration range:
+            #   x-delx/2 >= v1 and x+delx/2 < v2
+            first = np.searchsorted(self._lo_edges, v1, 'left')
+            stop = np.searchsorted(self._hi_edges, v2, 'left')
+
+            # Edge pixels. As in integration_weights, the low edge of a
+            #  range starting at the first pixel wraps to the last pixel.
+            lo = np.mod(first-1, npix)
+            hi = np.minimum(stop, npix-1)
+            lo_frac = (self._hi_edges[lo]-v1)/delx
+            hi_frac = np.where(stop < npix,
+                        (v2-self._lo_edges[hi])/delx, 0.)
+        else:
+            # To be consistent with iNorm (xlimit), we use x>=xmin, x<=xmax
+            first = np.searchsorted(x, v1, 'left')
+            stop = np.searchsorted(x, v2, 'right')
+            lo = np.zeros_like(first)
+            hi = np.zeros_like(stop)
+            lo_frac = np.zeros(np.shape(first))
+            hi_frac = np.zeros(np.shape(stop))
+
+        valid = (stop > first)
+
+        return first, stop, lo, hi, lo_frac, hi_frac, valid
+
+    def _sums(self, v1, v2):
+        # Weighted sums of the linear and quadratic terms over [v1, v2].
+        v1, v2 = np.broadcast_arrays(np.asarray(v1, dtype=float),
+                                        np.asarray(v2, dtype=float))
+        first, stop, lo, hi, lo_frac, hi_frac, valid = self._edges(v1, v2)
+
+        linear = self._linear_sum[:, stop]-self._linear_sum[:, first] + \
+            lo_frac*self._linear[:, lo] + hi_frac*self._linear[:, hi]
+        quadratic = \
+            self._quadratic_sum[:, stop]-self._quadratic_sum[:, first] + \
+            lo_frac**2*self._quadratic[:, lo] + \
+            hi_frac**2*self._quadratic[:, hi]
+
+        linear = np.where(valid, linear, np.nan)
+        quadratic = np.where(valid, quadratic, np.nan)
+
+        return v1, v2, linear, quadratic
+
+    def _column(self, v1, v2, linear, quadratic):
+        out = OrderedDict()
+
+        scale = self.wavc*self.fval*self.column_factor
+
+        # Integrated apparent column density and its errors
+        column = linear[0]/scale
+        column_err = np.sqrt(quadratic[0])/scale
+        # Continuum error: errors are correlated, so don't add in quadrature.
+        column_err_cont = linear[1]/scale
+        column_err_total = np.sqrt(column_err**2+column_err_cont**2)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out['v1'] = v1
+            out['v2'] = v2
+            out['ncol'] = np.log10(column)
+            out['ncol_err_lo'] = \
+                np.log10(column-column_err_total) - np.log10(column)
+            out['ncol_err_hi'] = \
+                np.log10(column+column_err_total) - np.log10(column)
+        out['flag_sat'] = (linear[4] > 0)
+
+        return out
+
+    def _eqwidth(self, v1, v2, linear, quadratic):
+        out = OrderedDict()
+
+        eqw_int = linear[2]
+        eqw_stat_err = np.sqrt(quadratic[1])
+        eqw_cont_err = linear[3]
+        # Zero point error
+        z_eps = 0.01
+        eqw_zero_err = z_eps*eqw_int
+        eqw_err = np.sqrt(eqw_stat_err**2 \
+            +eqw_cont_err**2 + eqw_zero_err**2)
+
+        # Store the EW in milliAngstrom
+        out['v1'] = v1
+        out['v2'] = v2
+        out['EW'] = eqw_int*1000.
+        out['EW_err'] = eqw_err*1000.
+        out['EW_err_stat'] = eqw_stat_err*1000.
+        out['EW_err_cont'] = eqw_cont_err*1000.
+        out['EW_err_zero'] = eqw_zero_err*1000.
+
+        # Is the line detected at 2, 3 sigma?
+        out['detection_2sig'] = (out['EW'] >= 2.*out['EW_err'])
+        out['detection_3sig'] = (out['EW'] >= 3.*out['EW_err'])
+
+        return out
+
+    def column(self, v1, v2):
+        """Apparent column density (ncol, ncol_err_lo, ncol_err_hi, flag_sat)
+        integrated over [v1, v2], as returned by pyn_column."""
+        v1, v2, linear, quadratic = self._sums(v1, v2)
+        return self._column(v1, v2, linear, quadratic)
+
+    def eqwidth(self, v1, v2):
+        """Equivalent width (EW and its errors, in mA) integrated over
+        [v1, v2], as returned by pyn_eqwidth."""
+        v1, v2, linear, quadratic = self._sums(v1, v2)
+        return self._eqwidth(v1, v2, linear, quadratic)
+
+    def measure(self, v1, v2):
+        """Both the column density and equivalent width over [v1, v2]."""
+        v1, v2, linear, quadratic = self._sums(v1, v2)
+        out = self._eqwidth(v1, v2, linear, quadratic)
+        out.update(self._column(v1, v2, linear, quadratic))
+        return out
+
+    def grid(self, v1, v2):
+        """Measurements for every pair of the 1-D arrays v1 and v2.
+
+        Returns an OrderedDict of (len(v1) x len(v2)) arrays; the 'v1' and
+        'v2' entries hold the broadcast limits.
+        """
+        v1 = np.atleast_1d(np.asarray(v1, dtype=float))
+        v2 = np.atleast_1d(np.asarray(v2, dtype=float))
+        return self.measure(v1[:, np.newaxis], v2[np.newaxis, :])
+
+
+def pyn_sweep(spec_in, partial_pixels = True):
+    # Build an integration-limit sweep for a spectrum.
+    return AODSweep(spec_in, partial_pixels = partial_pixels)
@@ -0,0 +1,140 @@
+import json
+import time
+import functools
+from collections import OrderedDict
+# Per-stage timing of the AOD and continuum pipeline.
+#
+#  -- Stages are timed with the stage() context manager or the timed()
+#     decorator; each stage accumulates a call count and wall time
+#  -- Timing is off by default, when a stage costs one flag lookup
+#  -- timing_report() / dump_timing() give the aggregates (as JSON)
+
+_timing = {'enabled': False}
+_stages = OrderedDict()
+
+
+def enable_timing(enabled = True):
+    """Turn the stage timers on (or off). Returns the previous setting."""
+    previous = _timing['enabled']
+    _timing['enabled'] = bool(enabled)
+    return previous
+
+
+def timing_enabled():
+    return _timing['enabled']
+
+
+def reset_timing():
+    """Forget all recorded timings."""
+    _stages.clear()
+
+
+def _record(name, elapsed):
+    # [count, total, min, max] of each stage
+    try:
+        entry = _stages[name]
+    except KeyError:
+        _stages[name] = [1, elapsed, elapsed, elapsed]
+        return
+    entry[0] += 1
+    entry[1] += elapsed
+    if elapsed < entry[2]:
+        entry[2] = elapsed
+    if elapsed > entry[3]:
+        entry[3] = elapsed
+
+
+class stage(object):
+    """Time a block of code as the named stage:
+
+        with stage('pyn_batch.blemish'):
+            ...
+    """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if _timing['enabled']:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.start is not None:
+            _record(self.name, time.perf_counter()-self.start)
+        return False
+
+
+def timed(name = None):
+    """Decorator timing every call of a function as a stage (by default
+    named after the function).
+    """
+    def decorator(func):
+        stage_name = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _timing['enabled']:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(stage_name, time.perf_counter()-start)
+        return wrapper
+    return decorator
+
+
+class timing(object):
+    """Context manager that turns timing on for a block, starting from a
+    clean slate unless reset = False:
+
+        with timing() as t:
+            spec = read_inorm('CIV1548.2i_o.save')
+        print(t.report())
+    """
+
+    def __init__(self, reset = True):
+        self.reset = reset
+        self.previous = None
+
+    def __enter__(self):
+        if self.reset:
+            reset_timing()
+        self.previous = enable_timing(True)
+        return self
+
+    def __exit__(self, *args):
+        enable_timing(self.previous)
+        return False
+
+    def report(self):
+        return timing_report()
+
+
+def timing_report():
+    """Aggregates of each stage: an OrderedDict of stage name to an
+    OrderedDict of calls, total, mean, min and max wall time [s], in the
+    order the stages were first seen.
+    """
+    report = OrderedDict()
+    for name, (count, total, tmin, tmax) in _stages.items():
+        entry = OrderedDict()
+        entry['calls'] = count
+        entry['total'] = total
+        entry['mean'] = total/count
+        entry['min'] = tmin
+        entry['max'] = tmax
+        report[name] = entry
+    return report
+
+
+def dump_timing(filename = None, indent = 2):
+    """The timing report as JSON, also written to filename if given."""
+    text = json.dumps(timing_report(), indent = indent)
+    if filename is not None:
+        with open(filename, 'w') as file:
+            file.write(text)
+    return text
@@ -0,0 +1,198 @@
+import numpy as np
+from collections import OrderedDict
+from .pyn_stack import stack_spectra, _stack_edges, _stack_delta, \
+    _stack_spacing, _stack_searchsorted
+from .pyn_timing import timed
+# Equivalent width errors and linear curve-of-growth column density limits
+#  over grids of integration windows, for many transitions at once.
+#
+# Assumptions:
+#
+#  -- Arrays are passed as 2-D (n_transitions x n_pixels) stacks, as
+#     returned by stack_spectra
+#  -- Velocity increases monotonically along each row
+#  -- Velocity spacing is constant (enough) within each row
+
+
+def _stack_window_edges(vel, valid, v1, v2, partial_pixels = True):
+    # Complete pixels [first, stop) of each (n_spec x n_windows) window,
+    #  plus the fractions of the partial pixels lo and hi, as in
+    #  integration_weights (partial_pixels) or xlimit.
+    nrow, npix = vel.shape
+    rows = np.arange(nrow)[:,None]
+    first, last = _stack_edges(valid)
+    first, last = first[:,None], last[:,None]
+
+    # Padded pixels sort before/after the data.
+    pix_num_array = np.arange(npix)[None,:]
+    x = np.where(valid, vel, np.where(pix_num_array < first, -np.inf, np.inf))
+
+    if partial_pixels:
+        delx = _stack_spacing(vel, valid, first[:,0], last[:,0])[:,None]
+        # Pixels fully within the window: x-delx/2 >= v1 and x+delx/2 < v2
+        start = _stack_searchsorted(x-delx/2, v1, 'left')
+        stop = _stack_searchsorted(x+delx/2, v2, 'left')
+
+        # Edge pixels. As in integration_weights, the low edge of a window
+        #  starting at the first pixel wraps to the last pixel.
+        lo = np.where(start-1 < first, last, start-1)
+        hi = np.minimum(stop, last)
+        lo_frac = ((vel[rows, lo]+delx/2)-v1)/delx
+        hi_frac = np.where(stop <= last, (v2-(vel[rows, hi]-delx/2))/delx, 0.)
+    else:
+        # To be consistent with iNorm (xlimit), we use x>=xmin, x<=xmax
+        start = _stack_searchsorted(x, v1, 'left')
+        stop = _stack_searchsorted(x, v2, 'right')
+        lo = np.zeros_like(start)
+        hi = np.zeros_like(stop)
+        lo_frac = np.zeros(start.shape)
+        hi_frac = np.zeros(stop.shape)
+
+    has_full = (stop > start)
+
+    return start, stop, lo, hi, lo_frac, hi_frac, has_full
+
+
+def stack_window_eqwidth(vel, flux, eflux, contin, contin_err, wave,
+                            wavc, fval, v1, v2, valid = None,
+                            partial_pixels = True):
+    """Equivalent widths, their errors and the linear CoG column density
+    limits for every window [v1, v2] on every row of a stack.
+
+    The per-pixel terms of pyn_eqwidth (the EW, its continuum error and its
+    statistical variance) are summed once into prefix sums along each row;
+    each window is then the difference of two prefix sums plus its partial
+    edge pixels, found by binary search on all rows at once. v1 and v2 are
+    (n_spec x n_windows) arrays (or broadcast to that). Windows without a
+    complete pixel give NaN.
+
+    Returns an OrderedDict of (n_spec x n_windows) arrays: EW, EW_err,
+    EW_err_stat, EW_err_cont, EW_err_zero (mA), ncol_linearCoG,
+    ncol_linear2sig, ncol_linear3sig, detection_2sig and detection_3sig,
+    as pyn_eqwidth computes them.
+    """
+
+    # Some constants
+    ew_factor = 1.13e17
+
+    vel = np.atleast_2d(np.asarray(vel, dtype=float))
+    nrow, npix = vel.shape
+    if valid is None:
+        valid = np.ones(vel.shape, dtype=bool)
+    valid = np.atleast_2d(valid)
+    v1, v2 = np.broadcast_arrays(np.atleast_2d(v1), np.atleast_2d(v2))
+    v1 = np.broadcast_to(v1, (nrow, v1.shape[1])).astype(float)
+    v2 = np.broadcast_to(v2, (nrow, v2.shape[1])).astype(float)
+    wavc = np.asarray(wavc, dtype=float).reshape(nrow, 1)
+    fval = np.asarray(fval, dtype=float).reshape(nrow, 1)
+
+    # Padded pixels contribute nothing.
+    flux = np.where(valid, flux, 1.)
+    flux_err = np.where(valid, eflux, 0.)
+    continuum = np.where(valid, contin, 1.)
+    continuum_err = np.where(valid, contin_err, 0.)
+    first, last = _stack_edges(valid)
+    delw = _stack_delta(np.where(valid, wave, 0.), valid, first, last)
+
+    # The terms of pyn_eqwidth: EW and continuum error (linear in the
+    #  weights), statistical error (quadratic).
+    terms = np.array([(1.-flux/continuum)*delw,
+                continuum_err*(flux/continuum**2)*delw,
+                (flux_err/continuum*delw)**2])
+    prefix = np.zeros((3, nrow, npix+1))
+    prefix[:,:,1:] = np.cumsum(terms, axis=2)
+
+    start, stop, lo, hi, lo_frac, hi_frac, has_full = \
+        _stack_window_edges(vel, valid, v1, v2, partial_pixels)
+
+    rows = np.arange(nrow)[:,None]
+    def _window_sum(j, power):
+        return prefix[j][rows, stop]-prefix[j][rows, start] + \
+            lo_frac**power*terms[j][rows, lo] + \
+            hi_frac**power*terms[j][rows, hi]
+
+    eqw_int = _window_sum(0, 1)
+    eqw_cont_err = _window_sum(1, 1)
+    eqw_stat_err = np.sqrt(_window_sum(2, 2))
+
+    # Zero point error
+    z_eps = 0.01
+    eqw_zero_err = z_eps*eqw_int
+
+    # Combine errors
+    eqw_err = np.sqrt(eqw_stat_err**2 \
+        +eqw_cont_err**2 + eqw_zero_err**2)
+
+    results = OrderedDict()
+    # Store the EW in milliAngstrom
+    results['EW'] = np.where(has_full, eqw_int*1000., np.nan)
+    results['EW_err'] = np.where(has_full, eqw_err*1000., np.nan)
+    results['EW_err_stat'] = np.where(has_full, eqw_stat_err*1000., np.nan)
+    results['EW_err_cont'] = np.where(has_full, eqw_cont_err*1000., np.nan)
+    results['EW_err_zero'] = np.where(has_full, eqw_zero_err*1000., np.nan)
+
+    # Linear column density and its 2, 3 sigma limits
+    scale = ew_factor/(fval*wavc**2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results['ncol_linearCoG'] = \
+            np.round(np.log10(scale*results['EW']),4)
+        results['ncol_linear2sig'] = \
+            np.round(np.log10(2.0*scale*results['EW_err']),4)
+        results['ncol_linear3sig'] = \
+            np.round(np.log10(3.0*scale*results['EW_err']),4)
+
+    # Is the line detected at 2, 3 sigma?
+    results['detection_2sig'] = (results['EW'] >= 2.*results['EW_err'])
+    results['detection_3sig'] = (results['EW'] >= 3.*results['EW_err'])
+
+    return results
+
+
+@timed()
+def pyn_upper_limits(spec_list, vcenter = 0., width = None,
+                        partial_pixels = True):
+    """EW errors and linear CoG column density limits of a list of
+    spectra over a grid of integration windows.
+
+    Every window [vcenter-width/2, vcenter+width/2] for each of the
+    vcenter and width values (km/s; scalars or 1-D arrays) is measured on
+    every spectrum in one vectorized pass (see stack_window_eqwidth). By
+    default the widths are the distinct widths of the spectra's own
+    [v1, v2] ranges.
+
+    Returns an OrderedDict holding 'vcenter', 'width', the window limits
+    'v1' and 'v2' (n_center x n_width), and (n_spec x n_center x n_width)
+    arrays of EW, EW_err, EW_err_stat, EW_err_cont, EW_err_zero,
+    ncol_linearCoG, ncol_linear2sig, ncol_linear3sig, detection_2sig and
+    detection_3sig. ncol_linear2sig/3sig are the 2 and 3 sigma upper
+    limits to log N for non-detections, as in pyn_eqwidth.
+    """
+
+    stack = stack_spectra(spec_list)
+    nspec = len(spec_list)
+
+    vcenter = np.atleast_1d(np.asarray(vcenter, dtype=float))
+    if width is None:
+        limits = stack['integration_limits']
+        width = np.unique(limits[:,1]-limits[:,0])
+    width = np.atleast_1d(np.asarray(width, dtype=float))
+
+    v1 = vcenter[:,None]-width[None,:]/2.
+    v2 = vcenter[:,None]+width[None,:]/2.
+    grid_shape = v1.shape
+
+    results = stack_window_eqwidth(stack['vel'], stack['flux'],
+                stack['eflux'], stack['contin'], stack['contin_err'],
+                stack['wave'], stack['wavc'], stack['fval'],
+                v1.reshape(1,-1), v2.reshape(1,-1), stack['valid'],
+                partial_pixels)
+
+    limits = OrderedDict()
+    limits['vcenter'] = vcenter
+    limits['width'] = width
+    limits['v1'] = v1
+    limits['v2'] = v2
+    for kkk in results.keys():
+        limits[kkk] = results[kkk].reshape((nspec,)+grid_shape)
+
+    return limits
@@ -1,19 +1,2 @@
-def __fix_unwriteable_spec(spec):
-    # FIX NON-WRITEABLE ARRAYS due to discontiguous memory
-    for kkk in spec.keys():
-        if isinstance(spec[kkk],(np.ndarray)):
-            spec[kkk] = spec[kkk].copy()
-
-    return spec
-
-
-def pyn_autocontinuum(spec_in,integration_limits = None):
-
-    spec = spec_in.copy()
-
-    # FIX NON-WRITEABLE ARRAYS due to discontiguous
-    # memory in some readsav inputs
-    if ~spec['vel'].flags.writeable:
-        spec = __fix_unwriteable_spec(spec)
-
-    
+# The autocontinuum lives in pyNorm.continuum; kept here for old imports.
+from pyNorm.continuum.pyn_autocontinuum import *
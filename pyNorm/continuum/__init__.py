@@ -1,2 +1,5 @@
 from .pyn_autocontinuum import *
 from .pyn_continuum import *
+from .pyn_binstats import *
+from .pyn_do_cont_aod import *
+from .pyn_intervals import *
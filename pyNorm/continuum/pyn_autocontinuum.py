@@ -1,3 +1,6 @@
+import numpy as np
+from .pyn_continuum import continuum_autofit
+
 def __fix_unwriteable_spec(spec):
     # FIX NON-WRITEABLE ARRAYS due to discontiguous memory
     for kkk in spec.keys():
@@ -7,11 +10,30 @@ def __fix_unwriteable_spec(spec):
     return spec
 
 
-def pyn_autocontinuum(spec_in,integration_limits = None):
+def pyn_autocontinuum(spec_in,integration_limits = None,
+                minord=0, maxord=10, vshift=0., vcont = [-1000,1000],
+                vclip = 5., nsig1=3., nsig2=0.75, pix1=4, pix2=8,
+                fmin=0.5e-15, ftest_table=False):
+    """
+    Automatically mask and fit the continuum of a spectrum (see
+    continuum_autofit for the algorithm and keywords). If given,
+    integration_limits = [v1, v2] (in the shifted frame) are stored as the
+    AOD integration range.
+    """
 
     spec = spec_in.copy()
 
     # FIX NON-WRITEABLE ARRAYS due to discontiguous
     # memory in some readsav inputs
-    if ~spec['vel'].flags.writeable:
+    if not spec['vel'].flags.writeable:
         spec = __fix_unwriteable_spec(spec)
+
+    spec = continuum_autofit(spec, minord=minord, maxord=maxord,
+                vshift=vshift, vcont=vcont, vclip=vclip,
+                nsig1=nsig1, nsig2=nsig2, pix1=pix1, pix2=pix2,
+                fmin=fmin, ftest_table=ftest_table)
+
+    if integration_limits is not None:
+        spec['v1'], spec['v2'] = integration_limits
+
+    return spec
@@ -0,0 +1,112 @@
+import numpy as np
+# Binned statistics, run-length encoding and mask dilation for the
+#  continuum masks.
+#
+#  -- Bins are (strided) views of the array, one row per bin, so a
+#     statistic over all bins is a single NumPy reduction
+#  -- Runs are described by their [start, end) pixels
+#  -- Masks are boolean arrays, True where the condition holds
+
+
+def bin_starts(npix, nbin, offset = 0):
+    """First pixels of the bins [i-nbin, i] (inclusive), i = nbin, 2*nbin,
+    ... < npix, of the IDL loops "for i = nbin, n-1, nbin", plus offset.
+    """
+    return offset + np.arange(0, npix-nbin, nbin)
+
+
+def bin_windows(x, nbin, step = None, starts = None):
+    """(n_bins x nbin) view of x: bins of nbin pixels every step pixels
+    (default step = nbin, consecutive bins, with any incomplete bin at the
+    end dropped), or the bins starting at the pixels starts.
+    """
+    x = np.asarray(x)
+    if step is None:
+        step = nbin
+
+    if (starts is None) and (step == nbin):
+        nbins = x.size // nbin
+        return x[:nbins*nbin].reshape(nbins, nbin)
+
+    if x.size < nbin:
+        return np.zeros((0, nbin), dtype=x.dtype)
+    windows = np.lib.stride_tricks.sliding_window_view(x, nbin)
+    if starts is None:
+        return windows[::step]
+    return windows[np.asarray(starts, dtype=int)]
+
+
+def binned_mean(x, nbin, step = None, starts = None):
+    """Mean of x over each bin (see bin_windows)."""
+    windows = bin_windows(x, nbin, step, starts)
+    if windows.shape[0] == 0:
+        return np.zeros(0)
+    return windows.mean(axis=1)
+
+
+def binned_median(x, nbin, step = None, starts = None):
+    """Median of x over each bin (see bin_windows)."""
+    windows = bin_windows(x, nbin, step, starts)
+    if windows.shape[0] == 0:
+        return np.zeros(0)
+    return np.median(windows, axis=1)
+
+
+def binned_std(x, nbin, step = None, starts = None, ddof = 1):
+    """Standard deviation of x over each bin (see bin_windows); ddof = 1
+    as IDL's stdev.
+    """
+    windows = bin_windows(x, nbin, step, starts)
+    if windows.shape[0] == 0:
+        return np.zeros(0)
+    return np.std(windows, axis=1, ddof=ddof)
+
+
+def run_lengths(mask):
+    """Run-length encoding of the True runs of a boolean mask. Returns
+    the first pixels and the (exclusive) last pixels of the runs.
+    """
+    padded = np.zeros(np.size(mask)+2, dtype=np.int8)
+    padded[1:-1] = np.ravel(mask)
+    delta = np.diff(padded)
+    starts = np.flatnonzero(delta == 1)
+    ends = np.flatnonzero(delta == -1)
+    return starts, ends
+
+
+def runs_to_mask(starts, ends, size):
+    """Boolean mask of the given size, True over the runs [starts, ends)
+    (clipped to the array; the runs may overlap).
+    """
+    starts = np.clip(np.asarray(starts, dtype=int), 0, size)
+    ends = np.clip(np.asarray(ends, dtype=int), 0, size)
+    keep = (ends > starts)
+
+    # +1 where a run begins, -1 where it ends: the running sum counts the
+    #  runs covering each pixel.
+    edges = np.zeros(size+1, dtype=int)
+    np.add.at(edges, starts[keep], 1)
+    np.add.at(edges, ends[keep], -1)
+    return np.cumsum(edges[:-1]) > 0
+
+
+def dilate_mask(mask, before, after = None, min_length = 0):
+    """Grow every True run of a boolean mask longer than min_length pixels
+    by before pixels at its start and after (default: before) pixels at
+    its end. Shorter runs are dropped.
+    """
+    if after is None:
+        after = before
+    starts, ends = run_lengths(mask)
+    long_runs = (ends-starts) > min_length
+    return runs_to_mask(starts[long_runs]-before, ends[long_runs]+after,
+                        np.size(mask))
+
+
+def mask_bins(mask, starts, nbin, value = False):
+    """Set the pixels of the bins of nbin pixels starting at starts to
+    value (in place); returns mask.
+    """
+    starts = np.asarray(starts, dtype=int)
+    mask[(starts[:,np.newaxis] + np.arange(nbin)).ravel()] = value
+    return mask
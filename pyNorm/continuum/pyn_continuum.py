@@ -1,16 +1,21 @@
-# TODO: Switch to scipy F-test
+from functools import lru_cache
+from pyNorm.aod.pyn_timing import timed
+from pyNorm.aod.pyn_cache import LRUCache, array_fingerprint, readonly
+from pyNorm.aod.pyn_record import logger
+from .pyn_binstats import bin_starts, binned_mean, mask_bins
+from .pyn_intervals import IntervalSet, as_mask
+
+# Memoized continuum solutions (coefficients, order, error), keyed on the
+#  data, the fit mask and the orders
+_contin_cache = LRUCache(maxsize=128)
+
 # TODO: Switch to numpy Legendre fitting / error analysis
 
-def pyn_ftest(nu, p):
-    """
-    This function calculates the significance of a fit using the
-     	"f-test".  See Bevington (1969).
-    """
+def _ftest_table():
+    # Bevington (1969) table of F critical values for one added parameter:
+    #  rows nu (degrees of freedom), columns p (probability).
     import numpy as np
 
-    n_params = 2
-    def _ret():  return None
-
     f_array = np.zeros([20, 8], dtype="float32")
     i = np.array([[0.50, 0.25, 0.10, 0.05, 0.025, 0.01, 0.005, 0.001]])
     j = np.array([[1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 15, 20, 24, 30, 40, 60, 120, 1.e5]])
@@ -39,59 +44,117 @@ def pyn_ftest(nu, p):
     f_array[18,:] = np.array([[0.458, 1.34, 2.75, 3.92, 5.15, 6.85, 8.18, 11.4]])
     f_array[19,:] = np.array([[0.455, 1.32, 2.71, 3.84, 5.02, 6.63, 7.88, 10.8]])
 
-    jj = np.where(np.ravel(j <= nu))[0]
-    jj = jj[jj.size - 1]
+    return f_array, i, j
 
-    ii = np.where(np.ravel(i <= p))[0]
-    ii = ii[0]
+_FTEST_TABLE = _ftest_table()
 
-    return f_array[jj,ii]
+@lru_cache(maxsize=None)
+def _ftest_ppf(nu1, nu2, p):
+    # Exact critical value F(nu1, nu2) exceeded with probability p.
+    from scipy.stats import f
+    return float(f.ppf(1.-p, nu1, nu2))
 
-def legbasis(x, maxord):
+def pyn_ftest(nu, p, nu1=1, table=False):
+    """
+    This function calculates the significance of a fit using the
+     	"f-test".  See Bevington (1969).
+
+    Returns the critical value of F for nu1 (numerator) and nu
+    (denominator) degrees of freedom, exceeded with probability p, from
+    scipy.stats.f; values are memoized per (nu1, nu, p).
+
+    table=True uses the old Bevington table instead (nu1 = 1 only), which
+    snaps nu down to the nearest tabulated row and p down to the nearest
+    tabulated probability.
+    """
     import numpy as np
 
-    numpix = x.size
+    if table:
+        f_array, i, j = _FTEST_TABLE
 
-    #Form legendre polynomial.
-    p = np.zeros([maxord + 1, numpix])
+        jj = np.where(np.ravel(j <= nu))[0]
+        jj = jj[jj.size - 1]
+
+        ii = np.where(np.ravel(i <= p))[0]
+        ii = ii[0]
+
+        return f_array[jj,ii]
+
+    return _ftest_ppf(int(nu1), int(nu), float(p))
+
+def legbasis(x, maxord):
+    import numpy as np
+
+    #Form legendre polynomial (for x of any shape).
+    p = np.zeros((maxord + 1,) + np.shape(x))
     p[0,:] = 1.
-    p[1,:] = x
+    if maxord >= 1:
+        p[1,:] = x
     for j in np.arange(2, maxord+1):
         p[j,:] = ((2.*j- 1.)*x*p[j-1,:] - (j-1)*p[j-2,:])/j
 
     return p
 
+@timed()
 def legfit(x,y,nord):
     import numpy as np
 
-    numpix = x.size
     p = legbasis(x, nord)
 
-    ncoeff = nord + 1
-
     #Form alpha and beta matrices.
-    beta = np.zeros([nord + 1])
-    alpha = np.zeros([nord + 1, nord + 1], "float32")
-    # Fill alpha and beta matrices
-    for k in np.arange(0, nord+1):
-        beta[k] = np.sum(y * p[k,:])
-    for k in np.arange(0, nord+1):
-        for j in np.arange(0, nord+1):
-            alpha[j, k] = np.sum(p[j,:] * p[k,:])
+    beta = p @ y
+    alpha = p @ p.T
 
     # Invert alpha matrix ==> error matrix eps.
     eps = np.linalg.inv(alpha)
 
     #Calculate coefficients and fit.
-    a = np.transpose(np.matmul(np.transpose(beta), np.transpose(eps)))
-    yfit = np.zeros([numpix], "float32")
-
+    a = eps @ beta
     # Sum the Legendre orders
-    for j in np.arange(0, nord+1):
-        yfit += a[j]*p[j,:]
+    yfit = a @ p
 
     return yfit, a
 
+@timed()
+def legqr(x,y,maxord,weights=None):
+    """Least-squares Legendre fits of every order 0..maxord at once.
+
+    The basis is built once at maxord and factored as p.T = Q R. The
+    first n+1 columns of Q span the basis of order n, so with z = Q.T y
+    the residual sum of squares of order n is that of maxord plus the
+    sum of z[n+1:]**2, and its coefficients solve R[:n+1,:n+1] a = z[:n+1].
+    With weights (e.g., 1/eflux**2) the fits and residuals are weighted.
+
+    Returns the residual variances of all orders and (r, z), to be passed
+    to legqr_coeff.
+    """
+    import numpy as np
+
+    y = np.asarray(y, dtype=float)
+    p = legbasis(x, maxord)
+    if weights is not None:
+        sqrt_weights = np.sqrt(weights)
+        p = p*sqrt_weights
+        y = y*sqrt_weights
+    q, r = np.linalg.qr(p.T)
+    z = q.T @ y
+
+    # Residual variance of each order; positive terms only, so no
+    #  cancellation against sum(y**2).
+    resid = y - q @ z
+    tail = np.concatenate((np.cumsum((z**2)[::-1])[::-1][1:], [0.]))
+    variance = np.sum(resid**2) + tail
+
+    return variance, (r, z)
+
+def legqr_coeff(qr, nord):
+    # Coefficients of the order-nord fit from the factorization of legqr.
+    import numpy as np
+    from scipy.linalg import solve_triangular
+
+    r, z = qr
+    return solve_triangular(r[:nord+1,:nord+1], z[:nord+1])
+
 def legpoly(x,coeff):
     import numpy as np
 
@@ -108,6 +171,7 @@ def legpoly(x,coeff):
     return yfit
 
 
+@timed()
 def legerr(x,y,a):
     """Warning: assumes uniform weighting for pixels.
     """
@@ -117,7 +181,6 @@ def legerr(x,y,a):
     nord = a.size - 1
 
     numpix = x.size
-    ix = np.arange(numpix,dtype="float32")
 
     p = legbasis(x,nord)
     yfit = legpoly(x,a)
@@ -129,31 +192,32 @@ def legerr(x,y,a):
     #Calculate chi squared of fit - uniform weighting=1.
     chi2 = variance / (numpix - ncoeff - 1)
 
-    #Form alpha and beta matrices.
-    beta = np.zeros([nord + 1])
-    alpha = np.zeros([nord + 1, nord + 1], dtype="float32")
-    # Fill alpha and beta matrices
-    for k in np.arange(0, nord+1):
-        beta[k] = np.sum(y * p[k,:])
-    for k in np.arange(0, nord+1):
-        for j in np.arange(0, nord+1):
-            alpha[j, k] = np.sum(p[j,:] * p[k,:])
+    # Form the alpha (curvature) matrix: alpha[j,k] = sum(p[j,:]*p[k,:])
+    alpha = p @ p.T
 
     # Invert alpha matrix ==> error matrix eps.
     eps = np.linalg.inv(alpha)
 
     eps1 = chi2 * eps
-    tot = np.zeros([numpix], dtype="float32")
-    for i in np.arange(0, (numpix - 1)+(1)):
-        tot[i] = 0
-        for l in np.arange(0, nord+1):
-            for k in np.arange(0, nord+1):
-                tot[i] += eps1[k,l] * p[l,i] * p[k,i]
+    # Variance of the fit at each pixel, the diagonal of p.T @ eps1 @ p:
+    #  tot[i] = sum_k,l eps1[k,l]*p[l,i]*p[k,i]
+    tot = np.sum((eps1 @ p) * p, axis=0)
     error = np.sqrt(tot)
 
     return error
 
 def convert_inorm_mask(spec_in):
+    """
+    Convert an iNorm continuum mask ('mask_cont': 1 = fitted) to the
+    continuum regions spec['contin_mask'], an IntervalSet of the velocity
+    ranges of the fitted pixels (see pyn_intervals). The intervals are the
+    only stored form of the mask; continuum_mask(spec) gives the per-pixel
+    Boolean mask (formerly stored as contin_mask_bool, and as
+    contin_mask_bits).
+
+    contin_v1/contin_v2 give the region boundaries as before, for reference
+    only: the fits use contin_mask.
+    """
     import numpy as np
 
     spec = spec_in.copy()
@@ -164,8 +228,10 @@ def convert_inorm_mask(spec_in):
     except:
         return spec
 
-    # Create a boolean mask from original
-    gdcont = (mask == 1)
+    # The runs of fitted pixels, as velocity ranges
+    spec['contin_mask'] = IntervalSet.from_mask(spec['vel'],
+                                                np.asarray(mask) == 1)
+
     # Find the places where the mask changes.
     delta = mask-np.roll(mask,1)
 
@@ -179,62 +245,38 @@ def convert_inorm_mask(spec_in):
         vstarts = np.concatenate([np.array([0]), strt])
         vstops = np.concatenate([stps, np.array([np.size(mask)-1])])
     # Transform the results to velocity ranges:
-    vstarts = spec['vel'][vstarts]
-    vstops = spec['vel'][vstops]
-
-    # # Create a boolean mask from velocity ranges
-    # gdcont = np.repeat(False,np.size(spec['vel']))
-    # for j in np.arange(np.size(vstarts)):
-    #     gdnew = (spec['vel'] >= vstarts[j]) & (spec['vel'] <= vstops[j])
-    #     gdcont = gdcont | gdnew
-
-    spec['contin_mask_bits'] = mask
-    spec['contin_mask_bool'] = gdcont
-    spec['contin_v1'] = vstarts
-    spec['contin_v2'] = vstops
+    spec['contin_v1'] = spec['vel'][vstarts]
+    spec['contin_v2'] = spec['vel'][vstops]
 
-    try:
-        del spec['mask_cont']
-    except:
-        pass
+    # Stale per-pixel masks would contradict the intervals.
+    for kkk in ['mask_cont', 'contin_mask_bits', 'contin_mask_bool']:
+        spec.pop(kkk, None)
 
     return spec
 
-def continuum_fit(spec_in, minord, maxord):
+def continuum_mask(spec):
     """
-    Fit Legendre polynomial continua
+    The Boolean mask (True = fitted) of the continuum regions of a
+    spectrum: its contin_mask intervals on the velocity grid, or, for
+    spectra saved before the intervals, their contin_mask_bool.
     """
     import numpy as np
-    import scipy
-
-    spec = spec_in.copy()
-
-    # Create new-style continuum mask
-    if "mask_cont" in spec:
-        spec = convert_inorm_mask(spec)
-    # Which are the continuum regions
-    gd = spec['contin_mask_bool']
 
-    # Misc.
-    nflag = 0
-    nord = maxord
+    if 'contin_mask' in spec:
+        return as_mask(spec['contin_mask'], spec['vel'])
+    return np.asarray(spec['contin_mask_bool'], dtype=bool)
 
-    # Set the variables for the Legendre fit
-    xmax = np.max(np.abs(spec['vel'][gd]))
-    x = spec['vel'][gd]/xmax
-    y = spec['flux'][gd]
-
-    # Array subscript length and vector.
-    numpix = x.size
-    idx = np.arange(numpix)
+def _ftest_order(variances, numpix, minord, maxord, ftest_table=False):
+    # Choose the order from the residual variances of orders 0..maxord:
+    #  step up from minord while each added term passes the F-test.
+    import numpy as np
 
-    # Begin loop to do fit for each order.
+    # Step through the orders.
     for nord in np.arange(minord, maxord+1):
         ncoeff = nord + 1
-        yfit, coeff = legfit(x,y,nord)
 
         # Variance in f-test parlance
-        variance = np.sum((y - yfit)**2)
+        variance = variances[nord]
         # Degrees of freedum
         nu = numpix - ncoeff - 1
         #Calculate chi squared of fit - uniform weighting=1.
@@ -247,17 +289,22 @@ def continuum_fit(spec_in, minord, maxord):
             # F statistic
             f = (variance1 - variance) / chi2
 
-            fcutoff = pyn_ftest(nu, 0.05)
+            fcutoff = pyn_ftest(nu, 0.05, table=ftest_table)
             if f < fcutoff:
                 nord = nord - 1
-                yfit, coeff = legfit(x,y,nord)
-                nflag = 1
                 break
 
         variance1 = variance
 
+    return nord
+
+def _fill_continuum(spec, coeff, nord, xmax, gd, contin_err):
+    # Fill the continuum and normalized-flux outputs of continuum_fit.
+    import numpy as np
+    from pyNorm.aod.pyn_precision import low_memory, pyn_precision
+
     spec['contin'] = legpoly(spec['vel']/xmax,coeff)
-    spec['contin_err'] = legerr(spec['vel']/xmax,spec['flux'],coeff)
+    spec['contin_err'] = contin_err
     spec['contin_order'] = nord
     spec['contin_coeff'] = coeff
 
@@ -289,51 +336,365 @@ def continuum_fit(spec_in, minord, maxord):
     except:
         pass
 
+    # The fit is done in float64; store the results in the storage precision.
+    if low_memory():
+        spec = pyn_precision(spec, inplace=True)
+
     return spec
 
+def _continuum_key(spec, gd, minord, maxord, ftest_table, weighted):
+    # Cache key of a continuum fit: the velocity grid, the flux (and the
+    #  errors if they weight the fit), the packed mask bits and the orders.
+    import numpy as np
+
+    key = ('continuum_fit', array_fingerprint(spec['vel']),
+            array_fingerprint(spec['flux']),
+            np.size(gd), np.packbits(gd).tobytes(),
+            int(minord), int(maxord), bool(ftest_table), bool(weighted))
+    if weighted:
+        key += (array_fingerprint(spec['eflux']),)
 
-def continuum_autofit(spec_in,
-                vshift=0.,vcont = [-1000,1000],
-                vclip = 5.):
+    return key
 
+@timed()
+def continuum_fit(spec_in, minord, maxord, ftest_table=False, weighted=False):
+    """
+    Fit Legendre polynomial continua
+
+    The order is chosen with an F-test at 95% confidence; ftest_table=True
+    uses the old tabulated critical values (see pyn_ftest). weighted=True
+    weights the pixels by 1/eflux**2 (see continuum_fit_batch). With
+    fewer than maxord+3 continuum pixels the order is at most numpix-3.
+
+    Solutions are memoized on the velocities, flux (and errors, if
+    weighted), continuum mask and orders, so refitting identical inputs
+    costs only the hashing.
+    """
+    import numpy as np
+
+    spec = spec_in.copy()
+
+    # Create new-style continuum mask
+    if "mask_cont" in spec:
+        spec = convert_inorm_mask(spec)
+    # Which are the continuum regions
+    gd = continuum_mask(spec)
+
+    key = _continuum_key(spec, gd, minord, maxord, ftest_table, weighted)
+    solution = _contin_cache.get(key)
+    if solution is not None:
+        coeff, nord, contin_err = solution
+        xmax = np.max(np.abs(spec['vel'][gd]))
+        return _fill_continuum(spec, coeff.copy(), nord, xmax, gd,
+                    contin_err.copy())
+
+    if weighted:
+        spec = continuum_fit_batch([spec], minord, maxord,
+                    weighted=True, ftest_table=ftest_table)[0]
+        _contin_cache.put(key, (readonly(spec['contin_coeff'].copy()),
+                    spec['contin_order'],
+                    readonly(np.array(spec['contin_err']))))
+        return spec
+
+    coeff, nord, xmax, contin_err = _continuum_fit_qr(spec, gd, minord,
+                                        maxord, ftest_table)
+    _contin_cache.put(key, (readonly(coeff.copy()), nord,
+                readonly(contin_err.copy())))
+
+    return _fill_continuum(spec, coeff, nord, xmax, gd, contin_err)
+
+def _continuum_fit_qr(spec, gd, minord, maxord, ftest_table=False,
+                        weighted=False):
+    # Legendre fit of one spectrum over the pixels gd with legqr: the fit
+    #  of continuum_fit, and of continuum_fit_batch for the spectra it
+    #  cannot factor. weighted=True weights the pixels by 1/eflux**2
+    #  (leaving out eflux <= 0). maxord is lowered to numpix-3, the
+    #  highest order whose F-test has a degree of freedom left. Returns
+    #  coeff, nord, xmax and contin_err.
+    import numpy as np
+    from scipy.linalg import solve_triangular
+
+    # Set the variables for the Legendre fit
+    xmax = np.max(np.abs(spec['vel'][gd]))
+    x = spec['vel'][gd]/xmax
+    y = spec['flux'][gd]
+
+    if not weighted:
+        # Array subscript length and vector.
+        numpix = x.size
+        maxord = max(min(maxord, numpix-3), 0)
+        minord = min(minord, maxord)
+
+        # Residual variances of all orders from one QR factorization.
+        variances, qr = legqr(x,y,maxord)
+        nord = _ftest_order(variances, numpix, minord, maxord, ftest_table)
+        coeff = legqr_coeff(qr, nord)
+
+        contin_err = legerr(spec['vel']/xmax,spec['flux'],coeff)
+        return coeff, nord, xmax, contin_err
+
+    ferr = np.asarray(spec['eflux'][gd], dtype=float)
+    good = (ferr > 0.)
+    numpix = np.sum(good)
+    if numpix == 0:
+        raise ValueError('No continuum pixels with eflux > 0 to fit.')
+    maxord = max(min(maxord, numpix-3), 0)
+    minord = min(minord, maxord)
+
+    variances, qr = legqr(x[good], y[good], maxord,
+                        weights=1./ferr[good]**2)
+    nord = _ftest_order(variances, numpix, minord, maxord, ftest_table)
+    coeff = legqr_coeff(qr, nord)
+
+    # Weighted covariance inv(R.T R) = r_inv r_inv.T scaled by the reduced
+    #  chi-square. The variance of the fit at each pixel is then the sum
+    #  of squares of r_inv.T @ p, which (unlike p.T @ cov @ p) does not
+    #  cancel for a badly conditioned R.
+    ncoeff = nord + 1
+    r_inv = solve_triangular(qr[0][:ncoeff,:ncoeff], np.eye(ncoeff))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chi2 = variances[nord] / (numpix - ncoeff - 1)
+    pfull = legbasis(spec['vel']/xmax, nord)
+    contin_err = np.sqrt(chi2 * np.sum((r_inv.T @ pfull)**2, axis=0))
+
+    return coeff, nord, xmax, contin_err
+
+@timed()
+def continuum_fit_batch(spec_list, minord, maxord, weighted=True,
+                        ftest_table=False):
+    """
+    Fit Legendre polynomial continua to many transitions at once.
+
+    The weighted design matrices of all the transitions (padded to a
+    common length, with zero weight on the padding) are QR factored in one
+    batched call, as continuum_fit factors a single one (see legqr); the
+    normal equations are never formed. The leading block of each R is the
+    factor of the lower-order problem, so one factorization gives the
+    residual (chi-square) of every order, and the order is chosen by the
+    same F-test as continuum_fit.
+
+    With weighted=True each pixel is weighted by 1/eflux**2 (pixels with
+    eflux <= 0 are left out), as in the GUI's Absorber; contin_err then
+    comes from the weighted covariance, scaled by the reduced chi-square
+    as legerr does. With weighted=False the fits, orders and outputs are
+    those of continuum_fit.
+
+    A transition with too few fit pixels for order maxord (fewer than
+    maxord+3), or whose R is numerically singular, does not stop the
+    batch: it is fit on its own as continuum_fit does, up to the highest
+    order its pixels can constrain.
+
+    Returns the list of spectra with contin, contin_err, contin_order,
+    contin_coeff, the normalized flux and SNR filled in as continuum_fit
+    does.
+    """
+    import numpy as np
+    from scipy.linalg import solve_triangular
+
+    specs = []
+    fit_region = []
+    xmax = np.zeros(len(spec_list))
+    for j, spec_in in enumerate(spec_list):
+        spec = spec_in.copy()
+        # Create new-style continuum mask
+        if "mask_cont" in spec:
+            spec = convert_inorm_mask(spec)
+        gd = continuum_mask(spec)
+
+        xmax[j] = np.max(np.abs(spec['vel'][gd]))
+        specs.append(spec)
+        fit_region.append(gd)
+
+    # Stack the fit regions, padded with zero weights
+    nspec = len(specs)
+    npix = np.max([np.sum(gd) for gd in fit_region])
+    x = np.zeros([nspec, npix])
+    y = np.zeros([nspec, npix])
+    w = np.zeros([nspec, npix])
+    for j, spec in enumerate(specs):
+        gd = fit_region[j]
+        nn = np.sum(gd)
+        x[j,:nn] = spec['vel'][gd]/xmax[j]
+        y[j,:nn] = spec['flux'][gd]
+        if weighted:
+            ferr = np.asarray(spec['eflux'][gd], dtype=float)
+            with np.errstate(divide='ignore'):
+                w[j,:nn] = np.where(ferr > 0., 1./ferr**2, 0.)
+        else:
+            w[j,:nn] = 1.
+    numpix = np.sum(w > 0., axis=1)
+
+    # Weighted design matrices of the highest order for all transitions,
+    #  QR factored in one batched call: sqrt(w) p.T = Q R.
+    p = np.moveaxis(legbasis(x, maxord), 0, 1)
+    sqrt_w = np.sqrt(w)
+    q, r = np.linalg.qr(np.swapaxes(p*sqrt_w[:,np.newaxis,:], 1, 2))
+    yw = y*sqrt_w
+
+    # The transitions with enough pixels for order maxord and a full-rank
+    #  R are fit here; the rest are fit by QR on their own below.
+    rdiag = np.abs(np.diagonal(r, axis1=1, axis2=2))
+    full_rank = np.min(rdiag, axis=1) > \
+        np.max(rdiag, axis=1)*(maxord+1)*np.finfo(float).eps
+    factored = (numpix > maxord+2) & full_rank
+
+    # As in legqr: with z = Q.T sqrt(w) y, the fit of order n solves
+    #  R[:n+1,:n+1] a = z[:n+1], and its chi-square is that of the highest
+    #  order plus sum(z[n+1:]**2).
+    z = (np.swapaxes(q, 1, 2) @ yw[...,np.newaxis])[...,0]
+    resid = yw - (q @ z[...,np.newaxis])[...,0]
+    tail = np.concatenate((np.cumsum((z**2)[:,::-1], axis=1)[:,::-1][:,1:],
+                np.zeros([nspec, 1])), axis=1)
+    variances = np.sum(resid**2, axis=1)[:,np.newaxis] + tail
+
+    out_list = []
+    for j, spec in enumerate(specs):
+        if not factored[j]:
+            logger.debug('continuum_fit_batch: transition %d fit on its own '
+                            '(%d pixels)', j, numpix[j])
+            coeff, nord, xmax_j, contin_err = _continuum_fit_qr(spec,
+                fit_region[j], minord, maxord, ftest_table, weighted)
+            out_list.append(_fill_continuum(spec, coeff, nord, xmax_j,
+                                fit_region[j], contin_err))
+            continue
+
+        nord = _ftest_order(variances[j], numpix[j], minord, maxord,
+                            ftest_table)
+        ncoeff = nord + 1
+        coeff = solve_triangular(r[j,:ncoeff,:ncoeff], z[j,:ncoeff])
+
+        xfull = spec['vel']/xmax[j]
+        if weighted:
+            # Weighted covariance r_inv r_inv.T scaled by the reduced
+            #  chi-square, as in _continuum_fit_qr
+            r_inv = solve_triangular(r[j,:ncoeff,:ncoeff], np.eye(ncoeff))
+            chi2 = variances[j,nord] / (numpix[j] - ncoeff - 1)
+            pfull = legbasis(xfull, nord)
+            contin_err = np.sqrt(chi2 * np.sum((r_inv.T @ pfull)**2, axis=0))
+        else:
+            contin_err = legerr(xfull,spec['flux'],coeff)
+
+        out_list.append(_fill_continuum(spec, coeff, nord, xmax[j],
+                            fit_region[j], contin_err))
+
+    return out_list
+
+
+def _autofit_pass(x, y, good, minord, maxord, ftest_table=False):
+    # One Legendre fit of y over the good pixels, evaluated over all x.
+    import numpy as np
+
+    xmax = np.max(np.abs(x[good]))
+    variances, qr = legqr(x[good]/xmax, y[good], maxord)
+    nord = _ftest_order(variances, np.sum(good), minord, maxord, ftest_table)
+    return legpoly(x/xmax, legqr_coeff(qr, nord))
+
+@timed()
+def continuum_autofit(spec_in, minord=0, maxord=10,
+                vshift=0., vcont = [-1000,1000],
+                vclip = 5., nsig1=3., nsig2=0.75, pix1=4, pix2=8,
+                fmin=0.5e-15, ftest_table=False):
+    """
+    Automatically mask and fit the continuum (after nl_continuum_aod).
+
+    Within vcont:
+      1. The region is cut into vclip sections; in each, bins of pix1
+         pixels whose mean flux lies nsig1 (mean) errors above or below
+         the median flux of the section are masked.
+      2. The continuum is fit to the remaining pixels. Bins of pix2
+         pixels whose mean normalized flux lies more than nsig2 times the
+         standard deviation of the normalized flux below 1 (absorption)
+         are masked as well.
+      3. The continuum is refit with continuum_fit over the final mask,
+         which is stored as the contin_mask intervals.
+
+    The bins are evaluated as strided views of the spectrum (see
+    pyn_binstats), so the cost is that of the two fits. Pixels are masked
+    in their own section (the IDL counter drifted when a section's length
+    was not a multiple of pix1). If a step would leave too few pixels for
+    a maxord fit, its mask is not applied.
+
+    Raises ValueError if vcont holds fewer than maxord+3 pixels.
+    """
     import numpy as np
 
     spec = spec_in.copy()
 
     # Make sure velocities are in the right order
-    if vcont[0] > vcont[1]: np.reverse(vcont)
+    vcont = np.sort(np.asarray(vcont, dtype=float))
+    maxord = max(maxord, minord)
+    nsect = int(vclip)
 
     # TODO: Enable a frame of reference flag [LSR v Helio]
     # Shift the velocity.
-    spec['vel'] += vshift
-    spec['v1'] += vshift
-    spec['v2'] += vshift
+    spec['vel'] = spec['vel'] + vshift
+    for kkk in ['v1', 'v2']:
+        if kkk in spec:
+            spec[kkk] = spec[kkk] + vshift
 
     # Define fitting region for autocontinuum
     gd = (spec['vel'] >= vcont[0]) & (spec['vel'] <= vcont[1])
+    min_pixels = maxord + 3
+    if np.sum(gd) < min_pixels:
+        raise ValueError('{0} pixels within vcont = [{1:g}, {2:g}] km/s; '
+                         'the fits need at least {3} (maxord+3).'.format(
+                         np.sum(gd), vcont[0], vcont[1], min_pixels))
 
     # Extract initial continuum fit region
-    vi1 = spec['vel'][gd]
-    fi1 = spec['flux'][gd]
-    ei1 = spec['eflux'][gd]
-
-    # Set the variables for the Legendre fit
-    xmax = np.max(np.abs(spec['vel'][gd]))
-    x = spec['vel'][gd]/xmax
-    y = spec['flux'][gd]
+    vi1 = np.asarray(spec['vel'][gd], dtype=float)
+    fi1 = np.asarray(spec['flux'][gd], dtype=float)
+    ei1 = np.asarray(spec['eflux'][gd], dtype=float)
 
     # New mask variable
-    mask_cont = gd.copy()
-
+    mask_cont = np.ones(vi1.size, dtype=bool)
 
     # Cut the spectrum in sub-sections to check regions to be masked.
     # This should help when flux changes by a large amount over the considered
     # velocity interval.
-    # diffv = (vl2-vl1)/vclip1
-    # diffv1  = vl1
-    # diffv2   = vl1 + diffv
-
-
-
-
-    return spec
+    diffv = (vcont[1]-vcont[0])/nsect
+    edges = np.searchsorted(vi1, vcont[0] + diffv*np.arange(nsect+1))
+    starts = []
+    fm = []
+    for k in np.arange(nsect):
+        ftemp = fi1[edges[k]:edges[k+1]]
+        if ftemp.size == 0:
+            continue
+        # Median flux of the section, ignoring (near) zero fluxes
+        fpos = ftemp[ftemp > fmin]
+        if fpos.size == 0:
+            fpos = ftemp
+        kstarts = bin_starts(ftemp.size, pix1, edges[k])
+        starts.append(kstarts)
+        fm.append(np.repeat(np.median(fpos), kstarts.size))
+    starts = np.concatenate(starts).astype(int)
+    fm = np.concatenate(fm)
+
+    # Flag the bins that lie nsig1 sigma above or below the section median.
+    #  The IDL bins [i-pix1, i] are inclusive: pix1+1 pixels.
+    fmean = binned_mean(fi1, pix1+1, starts=starts)
+    emean = binned_mean(ei1, pix1+1, starts=starts)
+    bad = (fmean < fm-nsig1*emean) | (fmean > fm+nsig1*emean)
+    mask1 = mask_bins(mask_cont.copy(), starts[bad], pix1+1)
+    if np.sum(mask1) >= min_pixels:
+        mask_cont = mask1
+
+    # Fit the continuum a first time, then reject the bins lying below it
+    #  (absorption only, not positive spikes).
+    ycon = _autofit_pass(vi1, fi1, mask_cont, minord, maxord, ftest_table)
+    fnorm = fi1/ycon
+    starts = bin_starts(fi1.size, pix2)
+    bad = (binned_mean(fnorm, pix2+1, starts=starts) <
+            (1.-nsig2*np.std(fnorm, ddof=1)))
+    mask2 = mask_bins(mask_cont.copy(), starts[bad], pix2+1)
+    if np.sum(mask2) >= min_pixels:
+        mask_cont = mask2
+
+    # Fit the continuum a second time over the final mask.
+    mask = np.zeros(spec['vel'].size, dtype=int)
+    mask[gd] = mask_cont
+    spec['mask_cont'] = mask
+    for kkk in ['contin_mask', 'contin_mask_bits', 'contin_mask_bool',
+                'contin_v1', 'contin_v2']:
+        spec.pop(kkk, None)
+
+    return continuum_fit(spec, minord, maxord, ftest_table=ftest_table)
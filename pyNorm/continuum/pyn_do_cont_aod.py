@@ -0,0 +1,192 @@
+import csv
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pyNorm.aod.pyn_record import logger, Measurement
+from pyNorm.aod.pyn_timing import timed
+# Automatic continuum fitting and AOD measurements for many files
+#  (replaces nl_do_cont_aod).
+#
+#  -- Each file is read (read_inorm for *.save, read_rbcodes for pickles),
+#     continuum fit with pyn_autocontinuum and measured with pyn_batch in a
+#     worker process
+#  -- Only the measurement row comes back from a worker, and at most
+#     max_pending files are in flight, so memory does not grow with the
+#     number of files
+#  -- Rows are written to the output table as the workers finish them
+
+
+# Columns of the output table: the input, the Measurement fields, the
+#  continuum fit and any error
+_COLUMNS = ['index', 'filename'] + list(Measurement._fields) + \
+    ['contin_order', 'SNR', 'error']
+
+
+def pyn_manifest(filein):
+    """The list of inputs for pyn_do_cont_aod.
+
+    filein is a glob pattern (e.g. '*i.save'), a list of file names or
+    patterns, or a manifest file listing one input per line. Manifest lines
+    are 'filename' or, for rbcodes pickles, 'filename targname ra dec ion'
+    (the ion is the rest of the line); blank lines and lines starting with
+    '#' are skipped, and relative names are relative to the manifest.
+
+    Returns a list of (filename, rbcodes arguments or None).
+    """
+
+    if isinstance(filein, (list, tuple)):
+        jobs = []
+        for name in filein:
+            jobs += pyn_manifest(name)
+        return jobs
+
+    # A pattern or a single spectrum
+    if glob.has_magic(filein) or (not os.path.isfile(filein)) or \
+        filein.endswith(('.save', '.p', '.pkl')):
+        return [(name, None) for name in sorted(glob.glob(filein))]
+
+    # A manifest file
+    root = os.path.dirname(filein)
+    jobs = []
+    with open(filein) as file:
+        for line in file:
+            tokens = line.split()
+            if (len(tokens) == 0) or tokens[0].startswith('#'):
+                continue
+            name = os.path.join(root, tokens[0])
+            if len(tokens) >= 5:
+                rbcodes = (tokens[1], float(tokens[2]), float(tokens[3]),
+                            ' '.join(tokens[4:]))
+            else:
+                rbcodes = None
+            jobs.append((name, rbcodes))
+
+    return jobs
+
+
+def _process_file(index, filename, rbcodes, options):
+    # Read, continuum fit and measure one file; returns its table row. Runs
+    #  in the worker processes, so errors are reported in the row.
+    import numpy as np
+    from pyNorm.io import read_inorm, read_rbcodes
+    from pyNorm.aod import pyn_batch, pyn_measurement
+    from pyNorm.continuum import pyn_autocontinuum, continuum_fit
+
+    row = dict.fromkeys(_COLUMNS, '')
+    row['index'] = index
+    row['filename'] = filename
+
+    try:
+        # The input arrays only: the spectrum is measured once, below,
+        #  after the continuum fit.
+        if filename.endswith('.save'):
+            spec = read_inorm(filename, measure=False)
+        elif rbcodes is None:
+            raise ValueError('rbcodes input needs targname, ra, dec and ion '
+                                'in the manifest')
+        else:
+            targname, ra, dec, ion = rbcodes
+            spec = read_rbcodes(filename, targname, ra, dec, ion,
+                                measure=False)
+
+        if options['autocontinuum'] is not None:
+            spec = pyn_autocontinuum(spec, **options['autocontinuum'])
+        elif not filename.endswith('.save'):
+            # The continuum of order contin_order fit by read_rbcodes
+            spec = continuum_fit(spec, minord=spec['contin_order'],
+                                maxord=spec['contin_order'])
+
+        spec = pyn_batch(spec,
+                    partial_pixels=options['partial_pixels'],
+                    blemish_correction=options['blemish_correction'],
+                    inplace=True)
+        measurement = pyn_measurement(spec)
+    except Exception as err:
+        row['error'] = '{0}: {1}'.format(type(err).__name__, err)
+        return row
+
+    row.update(measurement._asdict())
+    row['contin_order'] = int(np.squeeze(spec['contin_order']))
+    row['SNR'] = float(np.squeeze(spec['SNR']))
+
+    return row
+
+
+@timed()
+def pyn_do_cont_aod(filein, output = 'pyn_cont_aod.csv', nproc = None,
+                    max_pending = None, autocontinuum = True,
+                    minord=0, maxord=10, vshift=0., vcont = [-1000,1000],
+                    vclip = 5., nsig1=3., nsig2=0.75, pix1=4, pix2=8,
+                    fmin=0.5e-15, partial_pixels = True,
+                    blemish_correction = True):
+    """Continuum fit and measure many spectra in parallel.
+
+    filein is a glob pattern, a list of files or a manifest (see
+    pyn_manifest). Each input is read, fit with pyn_autocontinuum (with
+    the continuum keywords given here; autocontinuum = False keeps the
+    input continuum) and measured with pyn_batch in a pool of nproc
+    worker processes (default: all cores; nproc = 1 runs in this
+    process). At most max_pending inputs (default 2*nproc) are queued at a
+    time.
+
+    One row per input is written to the CSV table output as soon as it is
+    done, so the rows are in completion order; 'index' gives the position
+    in the input list. Inputs that fail get a row with the 'error' column
+    filled in.
+
+    Returns the number of inputs processed and the number that failed.
+    """
+
+    jobs = pyn_manifest(filein)
+
+    if nproc is None:
+        nproc = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2*nproc
+
+    options = {'partial_pixels': partial_pixels,
+                'blemish_correction': blemish_correction,
+                'autocontinuum': None}
+    if autocontinuum:
+        options['autocontinuum'] = dict(minord=minord, maxord=maxord,
+                vshift=vshift, vcont=vcont, vclip=vclip,
+                nsig1=nsig1, nsig2=nsig2, pix1=pix1, pix2=pix2, fmin=fmin)
+
+    num_failed = 0
+    with open(output, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=_COLUMNS)
+        writer.writeheader()
+
+        def _write(row):
+            writer.writerow(row)
+            file.flush()
+            if row['error']:
+                logger.warning('pyn_do_cont_aod: %s failed (%s)',
+                                row['filename'], row['error'])
+                return 1
+            logger.debug('pyn_do_cont_aod: %s done', row['filename'])
+            return 0
+
+        if nproc == 1:
+            for index, (filename, rbcodes) in enumerate(jobs):
+                num_failed += _write(_process_file(index, filename,
+                                    rbcodes, options))
+            return len(jobs), num_failed
+
+        # Keep at most max_pending inputs in flight; write rows as they
+        #  finish.
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            pending = set()
+            for index, (filename, rbcodes) in enumerate(jobs):
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        num_failed += _write(future.result())
+                pending.add(pool.submit(_process_file, index, filename,
+                                        rbcodes, options))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    num_failed += _write(future.result())
+
+    return len(jobs), num_failed
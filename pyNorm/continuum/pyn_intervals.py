@@ -0,0 +1,161 @@
+import numpy as np
+from .pyn_binstats import run_lengths, runs_to_mask
+# Masks as sets of intervals (e.g., velocity ranges), instead of one flag
+#  per pixel.
+#
+#  -- An IntervalSet holds sorted, disjoint, closed intervals
+#     [start, stop]; edits and set operations cost O(k) (plus a sort) in
+#     the number k of intervals, not in the number of pixels
+#  -- to_mask(x) gives the boolean mask on any grid x: True where x lies
+#     in one of the intervals
+#  -- from_mask(x, mask) is its inverse on the same (increasing) grid
+#  -- The two small arrays are all that is pickled
+
+
+class IntervalSet(object):
+    """A set of closed intervals [start, stop], kept sorted and disjoint
+    (overlapping intervals are merged).
+
+        contam = IntervalSet()
+        contam = contam.add(-50., 20.).remove(0., 5.)
+        mask = contam.to_mask(spec['vel'])
+
+    Sets are not modified in place: add, remove and the set operations
+    (|, &, -) return new sets.
+    """
+    __slots__ = ('starts', 'stops')
+
+    def __init__(self, starts = (), stops = ()):
+        starts = np.atleast_1d(np.asarray(starts, dtype=float)).ravel()
+        stops = np.atleast_1d(np.asarray(stops, dtype=float)).ravel()
+        if starts.shape != stops.shape:
+            raise ValueError('Interval starts and stops must match in size.')
+
+        # Drop empty intervals, then sort and merge the rest
+        keep = (stops >= starts)
+        self.starts, self.stops = _merge(starts[keep], stops[keep])
+
+    @classmethod
+    def from_mask(cls, x, mask):
+        """The intervals [x[first], x[last]] of the runs of True pixels of
+        mask on the increasing grid x.
+        """
+        x = np.asarray(x, dtype=float)
+        mask = np.broadcast_to(np.asarray(mask, dtype=bool), x.shape)
+        first, stop = run_lengths(mask)
+        return cls(x[first], x[stop-1])
+
+    def to_mask(self, x):
+        """Boolean mask on the grid x: True where x lies in an interval."""
+        x = np.asarray(x, dtype=float)
+        order = None
+        if (x.size > 1) and np.any(np.diff(x) < 0):
+            order = np.argsort(x, kind='stable')
+            x = x[order]
+
+        # Pixels [lo, hi) of each interval
+        lo = np.searchsorted(x, self.starts, 'left')
+        hi = np.searchsorted(x, self.stops, 'right')
+        mask = runs_to_mask(lo, hi, x.size)
+
+        if order is not None:
+            unsorted = np.zeros(x.size, dtype=bool)
+            unsorted[order] = mask
+            mask = unsorted
+        return mask
+
+    def add(self, start, stop):
+        """The set plus the interval [start, stop]."""
+        return self | IntervalSet(start, stop)
+
+    def remove(self, start, stop):
+        """The set without the interval [start, stop]."""
+        return self - IntervalSet(start, stop)
+
+    def union(self, other):
+        return IntervalSet(np.concatenate((self.starts, other.starts)),
+                            np.concatenate((self.stops, other.stops)))
+
+    def intersection(self, other):
+        # Each interval of self overlaps the intervals [j0, j1) of other,
+        #  found by binary search; the pieces are the pairwise overlaps.
+        j0 = np.searchsorted(other.stops, self.starts, 'left')
+        j1 = np.searchsorted(other.starts, self.stops, 'right')
+        counts = np.maximum(j1-j0, 0)
+        i = np.repeat(np.arange(self.starts.size), counts)
+        j = np.repeat(j0, counts) + \
+            (np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts)-counts, counts))
+        return IntervalSet(np.maximum(self.starts[i], other.starts[j]),
+                            np.minimum(self.stops[i], other.stops[j]))
+
+    def complement(self):
+        """The (closed) gaps between the intervals, out to +/-inf. The
+        gap bounds are the floats just outside the intervals, so that no
+        point is in both a set and its complement.
+        """
+        starts = np.concatenate(([-np.inf], np.nextafter(self.stops, np.inf)))
+        stops = np.concatenate((np.nextafter(self.starts, -np.inf), [np.inf]))
+        return IntervalSet(starts, stops)
+
+    def difference(self, other):
+        return self & other.complement()
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def __iter__(self):
+        return zip(self.starts.tolist(), self.stops.tolist())
+
+    def __len__(self):
+        return self.starts.size
+
+    def __bool__(self):
+        return self.starts.size > 0
+
+    def __eq__(self, other):
+        if not isinstance(other, IntervalSet):
+            return NotImplemented
+        return np.array_equal(self.starts, other.starts) and \
+            np.array_equal(self.stops, other.stops)
+
+    def __repr__(self):
+        return 'IntervalSet({0})'.format(
+            ', '.join('[{0:g}, {1:g}]'.format(*iv) for iv in self))
+
+    def __getstate__(self):
+        return (self.starts, self.stops)
+
+    def __setstate__(self, state):
+        self.starts, self.stops = state
+
+
+def _merge(starts, stops):
+    # Sort intervals by start and merge those that overlap (or touch).
+    if starts.size == 0:
+        return starts, stops
+    order = np.argsort(starts, kind='stable')
+    starts, stops = starts[order], stops[order]
+
+    # A new group begins where an interval starts beyond the furthest stop
+    #  of all the intervals before it.
+    reach = np.maximum.accumulate(stops)
+    new_group = np.concatenate(([True], starts[1:] > reach[:-1]))
+    first = np.flatnonzero(new_group)
+    return starts[first], np.maximum.reduceat(stops, first)
+
+
+def as_mask(mask, x):
+    """A boolean mask on the grid x from an IntervalSet or a mask array
+    (as older spectra and sessions store them).
+    """
+    if isinstance(mask, IntervalSet):
+        return mask.to_mask(x)
+    return np.asarray(mask, dtype=bool)
+
+
+def as_intervals(mask, x):
+    """An IntervalSet from an IntervalSet or a boolean mask on the grid x."""
+    if isinstance(mask, IntervalSet):
+        return mask
+    return IntervalSet.from_mask(x, mask)
@@ -17,6 +17,8 @@ import numpy as np
 import numpy.polynomial.legendre as L
 import numpy as np
 from astropy.io import ascii
+from pyNorm.aod.pyn_precision import storage_array
+from pyNorm.continuum import IntervalSet
 
 # Use modern importlib.resources instead of deprecated pkg_resources
 try:
@@ -236,8 +238,9 @@ class Absorber:
 
             '''create window for flux,wave,error based on max and min velocity'''
             window = (ion_dict['vel']>window_lim[0]) & (ion_dict['vel']<window_lim[1])
-            ion_dict['flux'] = flux[window]; ion_dict['wave']=wave[window]
-            ion_dict['error'] = error[window]; ion_dict['vel'] = ion_dict['vel'][window]
+            # flux and error follow the storage precision (see pyn_precision)
+            ion_dict['flux'] = storage_array(flux[window]); ion_dict['wave']=wave[window]
+            ion_dict['error'] = storage_array(error[window]); ion_dict['vel'] = ion_dict['vel'][window]
             min_flux = max(min(ion_dict['flux']),0.25*np.mean(ion_dict['flux'])); max_flux= min(max(ion_dict['flux']),2*np.mean(ion_dict['flux']))
             #ion_dict['y_lim'] = [min(ion_dict['flux']),max(ion_dict['flux'])]
             ion_dict['y_lim'] = [min_flux,max_flux]
@@ -248,11 +251,13 @@ class Absorber:
             lets also give each ion object the Legendre function for ease of use during plotting'''
 
             if nofrills==False:
-                ion_dict['wc'] = ((ion_dict['vel']<mask[0])|(ion_dict['vel']>mask[1]))&(ion_dict['vel']>-500)&(ion_dict['vel']<500)&(ion_dict['error'] != 0) #error != 0 is a bad pixel mask
+                wc = ((ion_dict['vel']<mask[0])|(ion_dict['vel']>mask[1]))&(ion_dict['vel']>-500)&(ion_dict['vel']<500)&(ion_dict['error'] != 0) #error != 0 is a bad pixel mask
+                # the mask is stored as velocity intervals (see pyn_intervals)
+                ion_dict['wc'] = IntervalSet.from_mask(ion_dict['vel'], wc)
                 ion_dict['weight'] = 1/(ion_dict['error']**2)
                 ion_dict['order'] = 4 #order of poly fit
-                ion_dict['pco']=L.Legendre.fit(ion_dict['wave'][ion_dict['wc']],ion_dict['flux'][ion_dict['wc']],ion_dict['order'],w=ion_dict['weight'][ion_dict['wc']])
-                ion_dict['cont'] = np.full_like(ion_dict['wave'][ion_dict['wc']], np.nan)
+                ion_dict['pco']=L.Legendre.fit(ion_dict['wave'][wc],ion_dict['flux'][wc],ion_dict['order'],w=ion_dict['weight'][wc])
+                ion_dict['cont'] = np.full_like(ion_dict['wave'][wc], np.nan)
 
 
             '''Property initializations:'''
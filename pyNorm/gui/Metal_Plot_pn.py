@@ -26,8 +26,14 @@ import traceback
 from PyQt5.QtWidgets import QMessageBox
 from . import Absorber_pn
 from matplotlib.axes import Axes
-from pynorm.aod import pyn_batch
-from pynorm.continuum import continuum_fit
+from pyNorm.aod import pyn_batch
+from pyNorm.continuum import continuum_fit, dilate_mask
+from pyNorm.continuum import IntervalSet, as_mask, as_intervals
+from pyNorm.aod.pyn_cache import LRUCache, array_fingerprint
+
+# Memoized continuum fits of the plotting windows, keyed on the data, the
+#  weights, the mask and the order
+_fit_cache = LRUCache(maxsize=128)
 
 rcParams['lines.linewidth'] = .9
 
@@ -468,18 +474,9 @@ def estimate_continuum(xdata, ydata, yerr, wline, zabs, vwin, order):
     coeffs1, cont1 = fit_legendre(xnorm, ycut, order, mask=good)
     residual = np.abs(ycut - cont1)
 
+    # Mask runs of > 10 deviant pixels, grown by 20 pixels on either side
     bad_resid = (residual >= 2.5 * yerrcut)
-    padded = np.pad(bad_resid.astype(int), (1, 1), constant_values=(0, 0))
-    diff = np.diff(padded)
-    starts = np.where(diff == 1)[0]
-    ends = np.where(diff == -1)[0]
-
-    absorption_mask = np.ones_like(residual, dtype=bool)
-    for s, e in zip(starts, ends):
-        if (e - s) > 10:
-            s_clip = max(s - 20, 0)
-            e_clip = min(e + 20, len(residual))
-            absorption_mask[s_clip:e_clip] = False
+    absorption_mask = ~dilate_mask(bad_resid, 20, min_length=10)
 
     good2 = (ycut / yerrcut > 3) & absorption_mask
     coeffs2, final_cont = fit_legendre(xnorm, ycut, order, mask=good2)
@@ -525,10 +522,9 @@ def compute_nav_profile(ion_data):
     spec['gb'] = coords.galactic.b.value
 
     spec['contin_coeff'] = np.array([0.0, 0.0])
-    spec['mask_cont'] = np.ones_like(vel)
-    spec['contin_mask_bits'] = np.ones_like(vel)
+    spec['contin_mask'] = IntervalSet(np.min(vel), np.max(vel))
 
-    spec = pyn_batch(spec, verbose=False, partial_pixels=True, blemish_correction=True)
+    spec = pyn_batch(spec, partial_pixels=True, blemish_correction=True)
     #spec = continuum_fit(spec, minord=spec['contin_order'], maxord=spec['contin_order'])
     if spec['flag_sat']:
         flag = -2
@@ -681,8 +677,7 @@ class mainWindow(QtWidgets.QTabWidget):
         # --- Ensure contamination_mask exists for all ions ---
         for key in self.keys:
             if 'contamination_mask' not in self.ions[key]:
-                wave = self.ions[key]['wave']
-                self.ions[key]['contamination_mask'] = np.zeros_like(wave, dtype=bool)
+                self.ions[key]['contamination_mask'] = IntervalSet()
 
         # -- Auto-continuum fitting for all ions --
         for key in self.keys:
@@ -709,7 +704,6 @@ class mainWindow(QtWidgets.QTabWidget):
                     self.ions[key]['cont'] = cont
                     self.ions[key]['order'] = order
                     self.ions[key]['pco'] = coeffs
-                    self.ions[key]['wc'] = mask_full
                     # --- Normalize flux and set initial y-limits for plotting ---
                     norm_flux = flux / cont
                     ylims = [0.0, np.nanmax(norm_flux) * 1.2]
@@ -719,7 +713,9 @@ class mainWindow(QtWidgets.QTabWidget):
 # --- Compute velocity array for this ion (needed for axis limits, masks) ---
                     vel = (wave - wline * (1 + zabs)) / wline / (1 + zabs) * 2.9979e5
                     self.ions[key]['vel'] = vel
-                    self.ions[key]['contamination_mask'] = np.zeros_like(wave, dtype=bool)
+                    # Masks are kept as velocity intervals
+                    self.ions[key]['wc'] = IntervalSet.from_mask(vel, mask_full)
+                    self.ions[key]['contamination_mask'] = IntervalSet()
 
 # --- Set default window limits if not already present ---
                     if 'window_lim' not in self.ions[key]:
@@ -1184,7 +1180,7 @@ class mainWindow(QtWidgets.QTabWidget):
                     mask = mask_reg.split(',')
                     mask = np.array(mask).astype('float32')
 
-                    wc=((vel<mask[0]) | (vel>mask[1])) & wc
+                    wc = as_intervals(wc, vel).remove(mask[0], mask[1])
                     self.ions[self.keys[key_idx]]['wc'] = wc
                     Plotting(self,self.Lidx,modify=True)
                     
@@ -1431,9 +1427,12 @@ class mainWindow(QtWidgets.QTabWidget):
                         self.vclim = None
                         wc = self.ions[self.keys[key_idx]]['wc']
                         if event.button == 1:
-                            wc = ((vel < vclim[0]) | (vel > vclim[1])) & wc
+                            wc = as_intervals(wc, vel).remove(vclim[0], vclim[1])
                         else:
-                            wc = ((vel > vclim[0]) & (vel < vclim[1])) | wc
+                            # Open interval (vclim[0], vclim[1])
+                            wc = as_intervals(wc, vel).add(
+                                np.nextafter(vclim[0], np.inf),
+                                np.nextafter(vclim[1], -np.inf))
                         self.ions[self.keys[key_idx]]['wc'] = wc
                         Plotting(self, self.Lidx, modify=True)
                     else:
@@ -1486,14 +1485,13 @@ class mainWindow(QtWidgets.QTabWidget):
                         contam_mask = self.ions[self.keys[key_idx]]['contamination_mask']
                     
                     # Apply mask logic (same as left panel but for contamination_mask)
+                        contam_mask = as_intervals(contam_mask, vel)
                         if event.button == 1:
-                        # Left click: mark selected region as contaminated (True)
-                            new_mask = (vel >= vclim[0]) & (vel <= vclim[1])
-                            contam_mask[new_mask] = True
+                        # Left click: mark selected region as contaminated
+                            contam_mask = contam_mask.add(vclim[0], vclim[1])
                         else:
-                        # Right click: mark selected region as clean (False)
-                            new_mask = (vel >= vclim[0]) & (vel <= vclim[1])
-                            contam_mask[new_mask] = False
+                        # Right click: mark selected region as clean
+                            contam_mask = contam_mask.remove(vclim[0], vclim[1])
                     
                     # Update the mask
                         self.ions[self.keys[key_idx]]['contamination_mask'] = contam_mask
@@ -1512,16 +1510,21 @@ class mainWindow(QtWidgets.QTabWidget):
 
 
 def get_mask_regions(vel, mask):
-    from itertools import groupby
-    from operator import itemgetter
-    idxs = np.where(mask)[0]
-    if len(idxs) == 0:
-        return []
-    grouped = []
-    for k, g in groupby(enumerate(idxs), lambda x: x[0] - x[1]):
-        group = list(map(itemgetter(1), g))
-        grouped.append((vel[group[0]], vel[group[-1]]))
-    return grouped
+    # (vmin, vmax) of each masked region; mask is an IntervalSet or (older
+    #  sessions) a boolean array on vel
+    return list(as_intervals(mask, vel))
+
+def legendre_fit_cached(wave, flux, weight, mask, order):
+    # Legendre.fit of the masked pixels, memoized so that returning to an
+    #  earlier (mask, order) pair doesn't refit.
+    key = (array_fingerprint(wave), array_fingerprint(flux),
+           array_fingerprint(weight), np.size(mask),
+           np.packbits(mask).tobytes(), int(order))
+    pco = _fit_cache.get(key)
+    if pco is None:
+        pco = L.Legendre.fit(wave[mask], flux[mask], order, w=weight[mask])
+        _fit_cache.put(key, pco)
+    return pco
 
 class Plotting:
     def __init__(self, parent, ii, modify=False, Print=False, **kwargs):
@@ -1539,7 +1542,7 @@ class Plotting:
         flux = parent.ions[parent.keys[key_idx]]['flux']
         weight = parent.ions[parent.keys[key_idx]]['weight']
         name = parent.ions[parent.keys[key_idx]]['name']
-        wc = np.array(parent.ions[parent.keys[key_idx]]['wc'] & (error != 0))
+        wc = as_mask(parent.ions[parent.keys[key_idx]]['wc'], vel) & (error != 0)
         cont = parent.ions[parent.keys[key_idx]]['cont']
         window_lim = parent.ions[parent.keys[key_idx]]['window_lim']
         window_lim_p = parent.ions[parent.keys[key_idx]]['window_lim_p']
@@ -1553,7 +1556,7 @@ class Plotting:
             if modify:
                 try:
                     if len(wave[wc]) > 0 and order >= 0:
-                        parent.ions[parent.keys[key_idx]]['pco'] = L.Legendre.fit(wave[wc], flux[wc], order, w=weight[wc])
+                        parent.ions[parent.keys[key_idx]]['pco'] = legendre_fit_cached(wave, flux, weight, wc, order)
                         parent.ions[parent.keys[key_idx]]['cont'] = parent.ions[parent.keys[key_idx]]['pco'](wave)
                     else:
                         raise ValueError("Invalid data for fitting")
@@ -1661,7 +1664,7 @@ class Plotting:
             key = parent.keys[parent.page * 6 + ii]
             contam_mask = parent.ions[key].get('contamination_mask', None)
 
-            if contam_mask is not None and np.any(contam_mask):
+            if contam_mask is not None and np.any(as_mask(contam_mask, parent.ions[key]['vel'])):
                 vel = parent.ions[key]['vel']
                 regions = get_mask_regions(vel, contam_mask)
                 for vmin, vmax in regions:
@@ -17,6 +17,8 @@ import PyQt5.QtGui as qtg
 from astropy.io import ascii
 from astropy.table import Table
 from pyND.absorption import logmean  # Assuming this is your custom module
+from pyNorm.aod import pyn_correct_saturation
+from pyNorm.continuum import as_mask
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial  # For optimized callbacks
 import traceback
@@ -63,37 +65,21 @@ def correct_saturation(logN, err_logN, corr_max = 0.15, printresults=True):
     err_logNf -- Error in final column density (-2 == saturated).
     """
 
-    # The difference in columns is
-    diff=logN[1]-logN[0]
-    # Check that the column densities aren't reversed.
-    # Assume they are if the difference in columns is negative.
-    if diff < 0:
-        print, "The logN difference is negative! Did you put the strong line first? If so, there may be a problem, BUT ASSUMING THERE IS NONE...."
+    # The correction itself is done by pyn_correct_saturation (pyNorm.aod),
+    #  which works on whole arrays of pairs.
+    logNf, err_logNf, flag_sat = pyn_correct_saturation(logN, err_logN,
+                                        corr_max = corr_max)
+    logNf = float(logNf)
+    err_logNf = float(err_logNf)
 
-        logN = logN[::-1]
-        err_logN = err_logN[::-1]
-        diff=logN[1]-logN[0]
-
-    # Calculate the correction using polynomial fit to SS1991 results.
-    ssdiff=diff
-    sscorrect=16.026*ssdiff**3 - 0.507*ssdiff**2 \
-                + 0.9971*ssdiff + 5.e-5
-
-
-    err_logNf = np.sqrt(err_logN[1]**2 + \
-        ((48.078*ssdiff**2 - 1.014*ssdiff + 0.9971)*np.sqrt(err_logN[1]**2 \
-        + err_logN[0]**2) )**2 )
-
-    if sscorrect >= corr_max:
+    if flag_sat:
         print("Your correction exceeded the maximum correction, d(logN)_max = {0:0.3f}.".format(corr_max))
         print("Applying the maximum correction and assuming the final result is saturated.")
 
-        logNf = logN[1]+corr_max
         err_logNf = -2
         if printresults:
             print("Final result: logN_final > {0:0.3f}".format(logNf))
     else:
-        logNf=logN[1]+sscorrect
         if printresults:
             print("Final result: logN_final = {0:0.3f}+/-{1:0.3f}".format(logNf,err_logNf))
 
@@ -779,7 +765,7 @@ class SpectroscopicAnalysisGUI(qtw.QMainWindow):
 
                 # Add contamination shading if contamination_flag exists
                 if data['contamination_mask'] is not None:
-                    contamination_flag = np.array(data['contamination_mask'])
+                    contamination_flag = as_mask(data['contamination_mask'], data['vel'])
                     vel = np.array(data['vel'])
                     nav = np.array(data['Nav'])
     
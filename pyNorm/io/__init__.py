@@ -1 +1,2 @@
 from .pyn_io import *
+from .pyn_spectrum import *
@@ -1,27 +1,39 @@
+from pyNorm.aod.pyn_timing import timed, stage
+
+@timed()
 def pyn_save(spec,filename = 'None'):
     import pickle
+    from pyNorm.aod.pyn_precision import pyn_precision
     '''
     Function to write a pickle file containing the updated pynorm calculations
     Autogenerates a filename of the form:ion_z_redshift_ra_dec.p
+    Pixel arrays are written in the storage precision (see set_precision).
     '''
     if filename == 'None':
         filename = spec['ion']+'_z_'+str(spec['redshift'])+str(spec['RA'])+'_'+str(spec['Dec'])
 
-    with open(filename+'.p', "wb") as file:
-        pickle.dump(spec, file)
+    spec = pyn_precision(spec)
+
+    with stage('pyn_save.pickle'):
+        with open(filename+'.p', "wb") as file:
+            pickle.dump(spec, file)
 
-def read_rbcodes(input_filename, targname, ra, dec, ion, partial_pixels=True, blemish_correction=True):
+@timed()
+def read_rbcodes(input_filename, targname, ra, dec, ion, partial_pixels=True, blemish_correction=True,
+                 auto_limits=False, measure=True, spectrum=False, verbose=None):
     import numpy as np
     from collections import OrderedDict
     from scipy.io import readsav
-    from pyNorm.aod import pyn_batch
-    from pyNorm.continuum import continuum_fit
+    from pyNorm.aod import pyn_batch, pyn_auto_limits
+    from pyNorm.aod.pyn_record import _verbose_report
+    from pyNorm.continuum import continuum_fit, as_mask
+    from pyNorm.io.pyn_spectrum import Spectrum
     import pickle
     from astropy.coordinates import SkyCoord
 
     # Read the saved pickle file:
     spec_in = []
-    with (open(input_filename, "rb")) as openfile:
+    with stage('read_rbcodes.pickle'), (open(input_filename, "rb")) as openfile:
         while True:
             try:
                 spec_in.append(pickle.load(openfile))
@@ -30,12 +42,6 @@ def read_rbcodes(input_filename, targname, ra, dec, ion, partial_pixels=True, bl
     #adjust to the level of the specified ion in the pickle file
     spec_in = spec_in[0][ion]
 
-    # FIX NON-WRITEABLE ARRAYS due to discontiguous
-    # memory in some readsav inputs
-    if ~spec_in['vel'].flags.writeable:
-        spec_in = __fix_unwriteable_spec(spec_in)
-
-
     # Create the dictionary
     spec = OrderedDict()
 
@@ -69,10 +75,11 @@ def read_rbcodes(input_filename, targname, ra, dec, ion, partial_pixels=True, bl
     # Coordinates
     spec['RA'] =ra
     spec['Dec'] =dec
-    coords  = SkyCoord(ra, dec, unit="deg",frame = 'icrs')
-    #fill in the lat and long
-    spec['gl'] = coords.galactic.l.value
-    spec['gb'] = coords.galactic.b.value
+    with stage('read_rbcodes.SkyCoord'):
+        coords  = SkyCoord(ra, dec, unit="deg",frame = 'icrs')
+        #fill in the lat and long
+        spec['gl'] = coords.galactic.l.value
+        spec['gb'] = coords.galactic.b.value
 
     # Sometimes LSR shift is missing
     try:
@@ -106,12 +113,10 @@ def read_rbcodes(input_filename, targname, ra, dec, ion, partial_pixels=True, bl
     # Construct continuum masks / velocity range
     #rb_codes saves the mask as a boolean array, need to convert to 0s and 1s before using the
     #__convert_inorm_mask function
-    masked_area = (spec_in['wc'] == False) #these are the areas masked from rb_codes
-    spec['contin_mask_bits'] = np.zeros(len(spec_in['wc'])) #True = included
-    spec['contin_mask_bits'][masked_area] = 0
-    spec['contin_mask_bits'][~masked_area] = 1
-    spec['contin_mask_bits'][spec['flux']<0] = 0 
-    spec['mask_cont'] = np.zeros(len(spec_in['wc']))
+    # (pyNorm GUI sessions store it as velocity intervals)
+    wc = as_mask(spec_in['wc'], spec_in['vel'])
+    masked_area = (wc == False) #these are the areas masked from rb_codes
+    spec['mask_cont'] = np.zeros(len(wc))
     spec['mask_cont'][masked_area] = 0
     spec['mask_cont'][~masked_area] = 1
     spec['mask_cont'][spec['flux']<0] = 0      
@@ -150,7 +155,6 @@ def read_rbcodes(input_filename, targname, ra, dec, ion, partial_pixels=True, bl
 
     # Detection flags
     if spec['EW'] >= 2*spec['EW_err']:
-        print(spec['EW'],spec['EW_err'],type(spec['EW_err']))
         spec['detection_2sig'] = True
     else:
         spec['detection_2sig'] = False
@@ -177,28 +181,40 @@ def read_rbcodes(input_filename, targname, ra, dec, ion, partial_pixels=True, bl
 
     # Create an integration limit if not already available
     if spec['v1'] == spec['v2']:
-        spec['v1'] = -100.
-        spec['v2'] = +100.
+        if auto_limits:
+            # Detect the absorption; falls back to +/-100 km/s.
+            pyn_auto_limits([spec], default_limits=(-100., 100.), inplace=True)
+        else:
+            spec['v1'] = -100.
+            spec['v2'] = +100.
+
+    # measure=False returns the input arrays, without the continuum fit
+    #  and the AOD measurements (for callers that refit and measure).
+    # verbose is deprecated (see pyn_batch).
+    if measure:
+        with _verbose_report('read_rbcodes', verbose):
+            spec = pyn_batch(spec, partial_pixels=partial_pixels,blemish_correction=blemish_correction)
+        spec = continuum_fit(spec,minord=spec['contin_order'],maxord=spec['contin_order'])
 
-    spec = pyn_batch(spec, verbose=True, partial_pixels=partial_pixels,blemish_correction=blemish_correction)
-    spec = continuum_fit(spec,minord=spec['contin_order'],maxord=spec['contin_order'])
+    # spectrum=True returns a compact Spectrum rather than an OrderedDict.
+    if spectrum:
+        spec = Spectrum.from_dict(spec)
 
     return spec
 
-def read_inorm(input_filename, partial_pixels=True, blemish_correction=True):
+@timed()
+def read_inorm(input_filename, partial_pixels=True, blemish_correction=True,
+               auto_limits=False, measure=True, spectrum=False, verbose=None):
     import numpy as np
     from collections import OrderedDict
     from scipy.io import readsav
-    from pynorm.aod import pyn_batch
+    from pyNorm.aod import pyn_batch, pyn_auto_limits
+    from pyNorm.aod.pyn_record import _verbose_report
+    from pyNorm.io.pyn_spectrum import Spectrum
 
     # Read the save file:
-    spec_in = readsav(input_filename)
-
-    # FIX NON-WRITEABLE ARRAYS due to discontiguous
-    # memory in some readsav inputs
-    if ~spec_in['vel'].flags.writeable:
-        spec_in = __fix_unwriteable_spec(spec_in)
-
+    with stage('read_inorm.readsav'):
+        spec_in = readsav(input_filename)
 
     # Create the dictionary
     spec = OrderedDict()
@@ -271,7 +287,6 @@ def read_inorm(input_filename, partial_pixels=True, blemish_correction=True):
     spec['contin_coeff'] = np.array([0,0.])
     #
     # Construct continuum masks / velocity range
-    spec['contin_mask_bits'] = spec_in['mask_cont']
     spec['mask_cont'] = spec_in['mask_cont']
     spec = __convert_inorm_mask(spec)
     #
@@ -333,71 +348,31 @@ def read_inorm(input_filename, partial_pixels=True, blemish_correction=True):
 
     # Create an integration limit if not already available
     if spec['v1'] == spec['v2']:
-        spec['v1'] = -100.
-        spec['v2'] = +100.
-
-    spec = pyn_batch(spec, verbose=False, partial_pixels=partial_pixels, blemish_correction=blemish_correction)
-
-    return spec
+        if auto_limits:
+            # Detect the absorption; falls back to +/-100 km/s.
+            pyn_auto_limits([spec], default_limits=(-100., 100.), inplace=True)
+        else:
+            spec['v1'] = -100.
+            spec['v2'] = +100.
 
-def __fix_unwriteable_spec(spec):
-    import numpy as np
+    # measure=False returns the input arrays, without the AOD measurements
+    #  (for callers that refit the continuum and measure).
+    # verbose is deprecated (see pyn_batch).
+    if measure:
+        with _verbose_report('read_inorm', verbose):
+            spec = pyn_batch(spec, partial_pixels=partial_pixels, blemish_correction=blemish_correction)
 
-    # FIX NON-WRITEABLE ARRAYS due to discontiguous memory
-    for kkk in spec.keys():
-        if isinstance(spec[kkk],(np.ndarray)):
-            spec[kkk] = spec[kkk].copy()
+    # spectrum=True returns a compact Spectrum rather than an OrderedDict.
+    if spectrum:
+        spec = Spectrum.from_dict(spec)
 
     return spec
 
-
 def __convert_inorm_mask(spec_in):
-    import numpy as np
-
-    spec = spec_in.copy()
-
-    # Extract the mask
-    try:
-        mask = spec['mask_cont']
-    except:
-        return spec
-
-    # Create a boolean mask from original
-    gdcont = (mask == 1)
-    # Find the places where the mask changes.
-    delta = mask-np.roll(mask,1)
-
-    # Identify where the mask transitions are:
-    vstarts = np.where(delta == -1)[0]
-    vstops = np.where(delta == 1)[0]
-    # If the first data point is fitted, adjust the continuum boundaries.
-    if mask[0] == 1:
-        strt = vstops
-        stps = vstarts
-        vstarts = np.concatenate([np.array([0]), strt])
-        vstops = np.concatenate([stps, np.array([np.size(mask)-1])])
-    # Transform the results to velocity ranges:
-    vstarts = spec['vel'][vstarts]
-    vstops = spec['vel'][vstops]
-
-    # # Create a boolean mask from velocity ranges
-    # gdcont = np.repeat(False,np.size(spec['vel']))
-    # for j in np.arange(np.size(vstarts)):
-    #     gdnew = (spec['vel'] >= vstarts[j]) & (spec['vel'] <= vstops[j])
-    #     gdcont = gdcont | gdnew
-
-    spec['contin_mask_bits'] = mask
-    spec['contin_mask_bool'] = gdcont
-    spec['contin_v1'] = vstarts
-    spec['contin_v2'] = vstops
-
-    try:
-        del spec['mask_cont']
-    except:
-        pass
-
-    return spec
+    # Continuum mask to velocity intervals (see continuum.convert_inorm_mask)
+    from pyNorm.continuum import convert_inorm_mask
 
+    return convert_inorm_mask(spec_in)
 
 def lsrvel(long, lat, radec=False, mihalas=False, silent=True):
     """delta_v = lsrvel(long, lat, mihalas=False, SILENT=False):
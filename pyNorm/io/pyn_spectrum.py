@@ -0,0 +1,293 @@
+import numpy as np
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from pyNorm.aod.pyn_cache import LRUCache
+# A compact container for pyNorm spectra.
+#
+#  -- Pixel arrays of the length of 'vel' are stored as rows of contiguous
+#     (n_arrays x n_pixels) blocks, one block per dtype
+#  -- Scalar measurements are held in typed attribute slots
+#  -- Anything else (odd dtypes/lengths, legacy keywords, arrays assigned
+#     after construction) is kept as is
+#  -- Key order is remembered, so conversion to and from the OrderedDict
+#     form is lossless
+
+
+# Typed scalar fields. A value goes into its slot only if it is of the
+#  listed kind; otherwise it is kept among the extras, unchanged.
+_FLOAT_FIELDS = ('wavc', 'fval', 'gamma', 'redshift', 'RA', 'Dec',
+    'gl', 'gb', 'vlsr', 'SNR', 'v1', 'v2',
+    'EW', 'EW_err', 'EW_err_stat', 'EW_err_cont', 'EW_err_zero',
+    'ncol_linearCoG', 'ncol_linear2sig', 'ncol_linear3sig',
+    'ncol', 'ncol_err_lo', 'ncol_err_hi',
+    'va', 'va_err', 'ba', 'ba_err', 'm3', 'm3_err',
+    'dv90', 'v90a', 'v90b')
+_BOOL_FIELDS = ('flag_sat', 'flag_blemish',
+    'detection_2sig', 'detection_3sig')
+_INT_FIELDS = ('contin_order',)
+_STR_FIELDS = ('ion', 'wni', 'targname', 'object')
+
+_FIELD_TYPES = {}
+for kkk in _FLOAT_FIELDS:
+    _FIELD_TYPES[kkk] = (float, np.floating)
+for kkk in _BOOL_FIELDS:
+    _FIELD_TYPES[kkk] = (bool, np.bool_)
+for kkk in _INT_FIELDS:
+    _FIELD_TYPES[kkk] = (int, np.integer)
+for kkk in _STR_FIELDS:
+    _FIELD_TYPES[kkk] = (str,)
+
+# Key orders and pixel layouts are shared between spectra with the same
+#  structure. The cache is bounded: each spectrum holds on to its own
+#  layout, so an evicted layout is only no longer shared.
+_LAYOUTS = LRUCache(maxsize = 256)
+
+
+def _layout(keys, pixel_keys):
+    # The shared (keys, pixel_keys, index) for a structure; index maps
+    #  each live key of the pixel blocks to its block and row.
+    layout = _LAYOUTS.get((keys, pixel_keys))
+    if layout is None:
+        index = {}
+        for b, block_keys in enumerate(pixel_keys):
+            for j, kkk in enumerate(block_keys):
+                if kkk is not None:
+                    index[kkk] = (b, j)
+        layout = (keys, pixel_keys, index)
+        _LAYOUTS.put((keys, pixel_keys), layout)
+    return layout
+
+def _field_value(key, value):
+    # Does value fit the typed slot for key?
+    types = _FIELD_TYPES.get(key)
+    if types is None:
+        return False
+    if isinstance(value, (bool, np.bool_)) and (types[0] is not bool):
+        return False
+
+    return isinstance(value, types) and (np.ndim(value) == 0)
+
+
+class Spectrum(MutableMapping):
+    """Slotted, dictionary-like container for a pyNorm spectrum.
+
+    Behaves as the OrderedDict spec used throughout pyNorm (spec['flux'],
+    spec.keys(), spec.copy(), ...), so it can be passed to pyn_batch and
+    friends directly; read_inorm and read_rbcodes return one with
+    spectrum = True. Pixel arrays with the length of 'vel' are stored as
+    rows of contiguous blocks (one per dtype) and returned as views of
+    them; measurements are held in typed slots and are also available as
+    attributes (spec.ncol).
+
+    Assigning a new array to a block key, or deleting it, frees its row:
+    the blocks are repacked once they hold more freed rows than live ones,
+    and when the spectrum is pickled.
+
+    Spectrum.from_dict(spec) and spec.to_dict() convert to and from the
+    OrderedDict form without loss (key order, types, dtypes and values);
+    spectra pickle as their packed blocks.
+    """
+
+    __slots__ = ('_keys', '_pixel_keys', '_index', '_pixels', '_extras') + \
+        tuple(_FIELD_TYPES.keys())
+
+    def __init__(self, *args, **kwargs):
+        self._set_layout((), ())
+        self._pixels = ()
+        self._extras = None
+        if args or kwargs:
+            self._fill(OrderedDict(*args, **kwargs))
+
+    # ---- Construction and conversion
+    @classmethod
+    def from_dict(cls, spec_in):
+        """Build a Spectrum from a spec dictionary."""
+        spec = cls()
+        spec._fill(spec_in)
+        return spec
+
+    def to_dict(self):
+        """The OrderedDict form of the spectrum, in the original key order."""
+        return OrderedDict((kkk, self[kkk]) for kkk in self._keys)
+
+    def _set_layout(self, keys, pixel_keys):
+        keys, pixel_keys, index = _layout(keys, pixel_keys)
+        object.__setattr__(self, '_keys', keys)
+        object.__setattr__(self, '_pixel_keys', pixel_keys)
+        object.__setattr__(self, '_index', index)
+
+    def _fill(self, spec_in):
+        # Sort the entries into the pixel blocks, typed slots and extras.
+        keys = tuple(spec_in.keys())
+
+        # Group the pixel arrays by dtype
+        groups = OrderedDict()
+        try:
+            npix = np.shape(spec_in['vel'])
+        except KeyError:
+            npix = None
+        if (npix is not None) and (len(npix) == 1):
+            for kkk in keys:
+                value = spec_in[kkk]
+                if isinstance(value, np.ndarray) and (value.shape == npix):
+                    groups.setdefault(value.dtype, []).append(kkk)
+
+        pixels = []
+        for dtype in groups.keys():
+            block = np.empty((len(groups[dtype]),)+npix, dtype=dtype)
+            for j, kkk in enumerate(groups[dtype]):
+                block[j] = spec_in[kkk]
+            pixels.append(block)
+        object.__setattr__(self, '_pixels', tuple(pixels))
+        self._set_layout(keys, tuple(tuple(groups[dtype])
+                                    for dtype in groups.keys()))
+
+        extras = None
+        for kkk in keys:
+            if kkk in self._index:
+                continue
+            value = spec_in[kkk]
+            if _field_value(kkk, value):
+                object.__setattr__(self, kkk, value)
+            else:
+                if extras is None:
+                    extras = {}
+                extras[kkk] = value
+        object.__setattr__(self, '_extras', extras)
+
+    def pack(self):
+        """Repack the pixel blocks, dropping freed rows and taking in the
+        pixel arrays assigned since."""
+        self._fill(self.to_dict())
+        return self
+
+    # ---- Mapping protocol
+    def __getitem__(self, key):
+        try:
+            b, j = self._index[key]
+            return self._pixels[b][j]
+        except KeyError:
+            pass
+        if key in _FIELD_TYPES:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        if self._extras is not None and key in self._extras:
+            return self._extras[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._index:
+            b, j = self._index[key]
+            row = self._pixels[b][j]
+            if isinstance(value, np.ndarray) and \
+                (value.base is self._pixels[b]) and \
+                (value.__array_interface__ == row.__array_interface__):
+                return
+            # Assignment replaces the array, as for a dict.
+            self._free_row(key)
+
+        if key in _FIELD_TYPES and hasattr(self, key):
+            object.__delattr__(self, key)
+        if self._extras is not None:
+            self._extras.pop(key, None)
+
+        if _field_value(key, value):
+            object.__setattr__(self, key, value)
+        else:
+            if self._extras is None:
+                object.__setattr__(self, '_extras', {})
+            self._extras[key] = value
+
+        if key not in self._keys:
+            self._set_layout(self._keys + (key,), self._pixel_keys)
+
+    def __delitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+
+        if key in self._index:
+            self._free_row(key)
+        elif key in _FIELD_TYPES and hasattr(self, key):
+            object.__delattr__(self, key)
+        else:
+            del self._extras[key]
+
+        self._set_layout(tuple(kkk for kkk in self._keys if kkk != key),
+                            self._pixel_keys)
+
+    def _free_row(self, key):
+        pixel_keys = tuple(
+            tuple(None if kkk == key else kkk for kkk in block_keys)
+                for block_keys in self._pixel_keys)
+        self._set_layout(self._keys, pixel_keys)
+
+        # Repack once the freed rows outnumber the live ones. The key
+        #  being replaced or deleted is still listed in _keys, so it is
+        #  held aside meanwhile.
+        nfree = sum(block_keys.count(None) for block_keys in pixel_keys)
+        if 2*nfree > sum(len(block_keys) for block_keys in pixel_keys):
+            keys = self._keys
+            spec = OrderedDict((kkk, self[kkk]) for kkk in keys
+                                if kkk != key)
+            self._fill(spec)
+            self._set_layout(keys, self._pixel_keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __repr__(self):
+        return 'Spectrum(' + repr(list(self._keys)) + ')'
+
+    def __setattr__(self, key, value):
+        # Typed fields set as attributes go through the mapping.
+        if key in _FIELD_TYPES:
+            self[key] = value
+        else:
+            object.__setattr__(self, key, value)
+
+    def copy(self):
+        """Shallow copy: entries are shared, as with dict.copy()."""
+        spec = Spectrum()
+        for kkk in ['_keys', '_pixel_keys', '_index', '_pixels']:
+            object.__setattr__(spec, kkk, getattr(self, kkk))
+        if self._extras is not None:
+            object.__setattr__(spec, '_extras', dict(self._extras))
+        for kkk in _FIELD_TYPES:
+            try:
+                object.__setattr__(spec, kkk, getattr(self, kkk))
+            except AttributeError:
+                pass
+        return spec
+
+    # ---- Pickling
+    def __getstate__(self):
+        spec = self
+        # Don't pickle freed rows.
+        if any(None in block_keys for block_keys in self._pixel_keys):
+            spec = self.copy().pack()
+
+        fields = {}
+        for kkk in _FIELD_TYPES:
+            try:
+                fields[kkk] = getattr(spec, kkk)
+            except AttributeError:
+                pass
+
+        return (spec._keys, spec._pixel_keys, spec._pixels,
+                    spec._extras, fields)
+
+    def __setstate__(self, state):
+        keys, pixel_keys, pixels, extras, fields = state
+        self._set_layout(keys, pixel_keys)
+        object.__setattr__(self, '_pixels', pixels)
+        object.__setattr__(self, '_extras', extras)
+        for kkk in fields.keys():
+            object.__setattr__(self, kkk, fields[kkk])
@@ -0,0 +1,80 @@
+import glob
+import os
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from pyNorm.io import read_inorm
+# Spectra shared by the tests: the iNorm files in docs/Data and synthetic
+#  absorbers built on the same spec template.
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'docs', 'Data')
+DATA_FILES = sorted(glob.glob(os.path.join(DATA_DIR, '*.save')))
+
+
+def read_data_spec(filename, float64=False, perturb=0., seed=0):
+    # read_inorm without its warnings. float64=True casts the float arrays
+    #  to float64 (the files store float32); perturb > 0 then multiplies
+    #  all but the pixel grids by 1+U(-perturb, perturb).
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        spec = read_inorm(filename)
+    if not float64:
+        return spec
+
+    rng = np.random.default_rng(seed)
+    for kkk in spec.keys():
+        value = spec[kkk]
+        if isinstance(value, np.ndarray) and (value.dtype.kind == 'f'):
+            value = value.astype(np.float64)
+            if (perturb > 0.) and (kkk not in ['vel', 'wave', 'vnorm']):
+                value = value*(1.+rng.uniform(-perturb, perturb, value.shape))
+            spec[kkk] = value
+    return spec
+
+
+def absorber_spec(vel, flux, eflux, contin=None, contin_err=None,
+                    ion='SiIV', wni='1393.8', wavc=1393.76, fval=0.513,
+                    v1=-37.3, v2=71.2):
+    # A spec dictionary with the keys pyn_batch needs. The continuum
+    #  defaults to 1 with a 1% error.
+    if contin is None:
+        contin = np.ones(vel.size)
+    if contin_err is None:
+        contin_err = 0.01*contin
+
+    spec = OrderedDict()
+    spec['ion'] = ion
+    spec['wni'] = wni
+    spec['wavc'] = np.float64(wavc)
+    spec['fval'] = np.float64(fval)
+    spec['vel'] = vel
+    spec['flux'] = flux
+    spec['eflux'] = eflux
+    spec['contin'] = contin
+    spec['contin_err'] = contin_err
+    spec['v1'] = v1
+    spec['v2'] = v2
+    return spec
+
+
+def blemished_spec(vel, seed, large, negative):
+    # A normalized Gaussian absorber with blemished pixels: errors of 2 at
+    #  the pixels large and of -1 at the pixels negative.
+    rng = np.random.default_rng(seed)
+    flux = 1.-0.6*np.exp(-0.5*((vel-20.)/15.)**2) + \
+        rng.normal(0., 0.03, vel.size)
+    eflux = np.full(vel.size, 0.03)
+    eflux[large] = 2.
+    eflux[negative] = -1.
+    return absorber_spec(vel, flux, eflux)
+
+
+@pytest.fixture(scope='session')
+def data_specs():
+    # The docs/Data spectra as read_inorm gives them; tests must not
+    #  modify them.
+    return [read_data_spec(filename) for filename in DATA_FILES]
@@ -0,0 +1,210 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from pyNorm.continuum.pyn_continuum import legbasis, legerr, legpoly, \
+    continuum_fit_batch, continuum_mask, convert_inorm_mask, \
+    continuum_autofit, _continuum_fit_qr
+from pyNorm.continuum.pyn_intervals import IntervalSet
+# The vectorized legerr against the original loops over pixels and orders,
+#  and batched continuum fits with transitions the batch cannot factor.
+
+
+def _legerr_loops(x, y, a):
+    # legerr as it was written before vectorizing.
+    ncoeff = a.size
+    nord = a.size - 1
+    numpix = x.size
+
+    p = legbasis(x, nord)
+    yfit = legpoly(x, a)
+    chi2 = np.sum((y - yfit)**2) / (numpix - ncoeff - 1)
+
+    alpha = np.zeros([nord + 1, nord + 1])
+    for k in np.arange(0, nord+1):
+        for j in np.arange(0, nord+1):
+            alpha[j, k] = np.sum(p[j,:] * p[k,:])
+    eps1 = chi2 * np.linalg.inv(alpha)
+
+    tot = np.zeros([numpix])
+    for i in np.arange(0, numpix):
+        for l in np.arange(0, nord+1):
+            for k in np.arange(0, nord+1):
+                tot[i] += eps1[k,l] * p[l,i] * p[k,i]
+    return np.sqrt(tot)
+
+
+@pytest.mark.parametrize('nord', range(0, 9))
+def test_legerr_matches_loops(nord):
+    # Random pixels of a grid on [-1, 1] (as a masked spectrum), random
+    #  coefficients and noise. The two differ only by rounding, which
+    #  grows with the condition number of alpha for the fewest pixels.
+    rng = np.random.default_rng(nord)
+    grid = np.linspace(-1., 1., 1000)
+    for numpix in [2*nord+4, 50, 400]:
+        x = np.sort(rng.choice(grid, numpix, replace=False))
+        a = rng.normal(size=nord+1)
+        y = legpoly(x, a) + rng.normal(0., 0.1, numpix)
+
+        np.testing.assert_allclose(legerr(x, y, a), _legerr_loops(x, y, a),
+                                    rtol=1e-7, atol=0.)
+
+
+def _best_time(func, *args, repeat = 3):
+    # Best wall-clock time of repeat calls.
+    best = np.inf
+    for j in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter()-start)
+    return best
+
+
+@pytest.mark.benchmark
+def test_legerr_speedup():
+    # The vectorized legerr against the loops on a 2000-pixel window at
+    #  order 8 (162,000 loop iterations). It is typically a few hundred
+    #  times faster; ask for 20 to leave room for noisy machines.
+    rng = np.random.default_rng(0)
+    x = np.linspace(-1., 1., 2000)
+    a = rng.normal(size=9)
+    y = legpoly(x, a) + rng.normal(0., 0.1, x.size)
+
+    loops = _best_time(_legerr_loops, x, y, a, repeat=1)
+    vectorized = _best_time(legerr, x, y, a)
+    print('legerr: loops {0:.3g} s, vectorized {1:.3g} s ({2:.0f}x)'.format(
+        loops, vectorized, loops/vectorized))
+    assert loops > 20.*vectorized
+
+
+def _continuum_spec(vel1, vel2, seed = 0):
+    # Cubic continuum with noise, fit over [vel1, vel2].
+    rng = np.random.default_rng(seed)
+    vel = np.linspace(-800., 800., 700)
+    eflux = rng.uniform(0.01, 0.05, vel.size)
+    flux = legpoly(vel/800., np.array([1., 0.2, -0.1, 0.1])) + \
+        rng.normal(0., eflux)
+
+    spec = OrderedDict()
+    spec['vel'] = vel
+    spec['flux'] = flux
+    spec['eflux'] = eflux
+    spec['contin'] = np.ones(vel.size)
+    spec['contin_err'] = np.zeros(vel.size)
+    spec['contin_mask'] = IntervalSet(vel1, vel2)
+    return spec
+
+
+@pytest.mark.parametrize('weighted', [True, False])
+def test_continuum_fit_batch_bad_transition(weighted):
+    good = _continuum_spec(-800., 800.)
+    # Four pixels for an order-6 fit
+    few = _continuum_spec(-100., -92., seed = 1)
+    # Continuum pixels with no positive errors but three
+    blank = _continuum_spec(-800., 800., seed = 2)
+    blank['eflux'] = np.where(np.arange(700) % 200 == 0, 0.02, 0.)
+
+    out = continuum_fit_batch([good, few, blank], 0, 6, weighted=weighted)
+    alone = continuum_fit_batch([good], 0, 6, weighted=weighted)[0]
+
+    assert len(out) == 3
+    np.testing.assert_array_equal(out[0]['contin'], alone['contin'])
+    np.testing.assert_array_equal(out[0]['contin_err'], alone['contin_err'])
+    assert out[0]['contin_order'] == 3
+    for spec in out[1:]:
+        assert np.all(np.isfinite(spec['contin']))
+
+
+@pytest.mark.parametrize('weighted', [True, False])
+def test_continuum_fit_batch_matches_qr(weighted):
+    # High-order fits over half of the velocity range (a poorly
+    #  conditioned basis) with errors spanning a factor of 25, batched
+    #  with a well-conditioned transition, must match the single QR fit.
+    specs = []
+    for seed, vel1 in enumerate([-800., 0., 100., 200.]):
+        spec = _continuum_spec(vel1, 800., seed = seed)
+        rng = np.random.default_rng(seed)
+        spec['eflux'] = spec['eflux']*rng.uniform(0.2, 5., spec['vel'].size)
+        specs.append(spec)
+
+    out = continuum_fit_batch(specs, 10, 10, weighted=weighted)
+    for spec, fit in zip(specs, out):
+        gd = continuum_mask(spec)
+        coeff, nord, xmax, contin_err = _continuum_fit_qr(spec, gd, 10, 10,
+                                            weighted=weighted)
+        assert fit['contin_order'] == nord
+        np.testing.assert_allclose(fit['contin_coeff'], coeff,
+                    rtol=0., atol=1e-8*np.max(np.abs(coeff)))
+        np.testing.assert_allclose(fit['contin_err'][gd], contin_err[gd],
+                    rtol=1e-6)
+
+
+@pytest.mark.parametrize('first', [0, 1])
+def test_convert_inorm_mask(first):
+    # The intervals are the only stored mask; contin_v1/contin_v2 keep the
+    #  iNorm boundaries.
+    vel = np.arange(-100., 100., 10.)
+    mask = np.full(vel.size, 1-first)
+    mask[first:5] = first
+    mask[9:13] = 1
+    spec = OrderedDict(vel=vel, mask_cont=mask,
+                        contin_mask_bool=np.zeros(vel.size, dtype=bool))
+    spec = convert_inorm_mask(spec)
+
+    for kkk in ['mask_cont', 'contin_mask_bits', 'contin_mask_bool']:
+        assert kkk not in spec
+    assert np.all(continuum_mask(spec) == (mask == 1))
+
+    delta = mask-np.roll(mask, 1)
+    vstarts = np.where(delta == -1)[0]
+    vstops = np.where(delta == 1)[0]
+    if mask[0] == 1:
+        vstarts, vstops = np.concatenate([[0], vstops]), \
+            np.concatenate([vstarts, [vel.size-1]])
+    assert np.all(spec['contin_v1'] == vel[vstarts])
+    assert np.all(spec['contin_v2'] == vel[vstops])
+
+
+def _absorber_spec(seed = 0):
+    # A Gaussian absorber (60% deep, 20 km/s wide) at v = 50 km/s on a
+    #  sloped continuum with 1% noise.
+    rng = np.random.default_rng(seed)
+    vel = np.arange(-800., 800., 2.5)
+    contin = legpoly(vel/800., np.array([1., 0.1, -0.05]))
+    eflux = np.full(vel.size, 0.01)
+    flux = contin*(1.-0.6*np.exp(-0.5*((vel-50.)/20.)**2)) + \
+        rng.normal(0., 0.01, vel.size)
+
+    spec = OrderedDict()
+    spec['vel'] = vel
+    spec['flux'] = flux
+    spec['eflux'] = eflux
+    return spec, contin
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_continuum_autofit_masks_absorber(seed):
+    spec, contin = _absorber_spec(seed)
+    out = continuum_autofit(spec, 0, 4, vcont=[-600., 600.])
+    gd = continuum_mask(out)
+    vel = spec['vel']
+
+    # The absorption is masked, most of the continuum is kept, and the
+    #  fit follows the true continuum.
+    assert not np.any(gd[np.abs(vel-50.) <= 40.])
+    far = (np.abs(vel-50.) > 150.) & (np.abs(vel) <= 600.)
+    assert np.mean(gd[far]) > 0.9
+    assert not np.any(gd[np.abs(vel) > 600.])
+    inner = np.abs(vel) <= 600.
+    np.testing.assert_allclose(out['contin'][inner], contin[inner],
+                                rtol=0.01)
+
+
+@pytest.mark.parametrize('vcont', [[900., 1000.], [0., 10.]])
+def test_continuum_autofit_too_few_pixels(vcont):
+    # No pixel, or too few for a maxord = 4 fit, within vcont
+    spec, contin = _absorber_spec()
+    with pytest.raises(ValueError, match='vcont'):
+        continuum_autofit(spec, 0, 4, vcont=vcont)
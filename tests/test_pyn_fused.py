@@ -0,0 +1,167 @@
+import logging
+import os
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from pyNorm.aod import pyn_batch, pyn_measurement, Measurement
+from pyNorm.io import read_inorm
+from conftest import DATA_FILES, blemished_spec
+# The fused single-pass pyn_batch must reproduce the separate
+#  pyn_column/pyn_eqwidth/pyn_istat passes (fused = False) and the values
+#  the code gave before either existed.
+
+
+
+# pyn_batch outputs of the code before the fused kernel (baseline
+#  pyn_batch on read_inorm output), per file and partial_pixels.
+PINNED = {
+    ('BD+532790_SiIV1402.8i_o.save', True): {
+        'ncol': 12.795405744129146, 'ncol_err_lo': -0.17912945875389852,
+        'ncol_err_hi': 0.1264499030616033, 'EW': 25.884426451159726,
+        'EW_err': 8.500208862014492, 'va': -27.553044316880907,
+        'ba': 21.85348986888983, 'dv90': 51.45584216534445,
+        'm3': 0.5438347959448756},
+    ('BD+532790_SiIV1402.8i_o.save', False): {
+        'ncol': 12.799212955963268, 'ncol_err_lo': -0.18100605888781907,
+        'ncol_err_hi': 0.12737543534225004, 'EW': 26.1237907043593,
+        'EW_err': 8.657655382629377, 'va': -27.24762048557396,
+        'ba': 22.347462235638115, 'dv90': 51.45584216534445,
+        'm3': 0.6544187792553057},
+    ('CIV1548.2i_o.save', True): {
+        'ncol': 12.691862375497585, 'ncol_err_lo': -0.44607055747875535,
+        'ncol_err_hi': 0.21536303221963848, 'EW': 16.430926840187016,
+        'EW_err': 12.11756149793671, 'va': -268.8693512287394,
+        'ba': 35.474126710181196, 'dv90': 68.71381243529802,
+        'm3': 5.753026536508479},
+    ('CIV1548.2i_o.save', False): {
+        'ncol': 12.660419517240591, 'ncol_err_lo': -0.5034875144399091,
+        'ncol_err_hi': 0.22693521823326712, 'EW': 15.16638159672371,
+        'EW_err': 12.063372593878103, 'va': -267.69472561478324,
+        'ba': 34.67920452903722, 'dv90': 1272.682865201691,
+        'm3': 0.4715756218485667},
+    ('rbs2005_SiII1260_o.save', True): {
+        'ncol': 12.109952925281341, 'ncol_err_lo': -0.4351524560920659,
+        'ncol_err_hi': 0.2129453886066326, 'EW': 16.984140305716426,
+        'EW_err': 12.878540713830281, 'va': -386.2458670819038,
+        'ba': 27.08479072549736, 'dv90': 1166.1331665387631,
+        'm3': -15.590078087151156},
+    ('rbs2005_SiII1260_o.save', False): {
+        'ncol': 12.11987063013023, 'ncol_err_lo': -0.4173804527853626,
+        'ncol_err_hi': 0.2088471015312674, 'EW': 17.52420608074253,
+        'EW_err': 12.848270224941986, 'va': -387.28772207777325,
+        'ba': 27.265369508517452, 'dv90': 82.95096247388824,
+        'm3': -0.06973781241406102},
+}
+
+
+@pytest.fixture(scope='module')
+def specs(data_specs):
+    # A Gaussian absorber with blemished pixels: large errors and a
+    #  negative one.
+    return data_specs + [blemished_spec(np.arange(-500., 500., 2.5), 1,
+                                        large=[150, 151, 230], negative=190)]
+
+
+def _assert_same(fused, legacy):
+    assert list(fused.keys()) == list(legacy.keys())
+    for key in fused.keys():
+        a, b = fused[key], legacy[key]
+        if isinstance(a, (np.ndarray, float, np.floating)) and \
+            np.issubdtype(np.asarray(a).dtype, np.number):
+            np.testing.assert_allclose(a, b, rtol=1e-12, atol=0.,
+                                        equal_nan=True, err_msg=key)
+        else:
+            assert np.all(np.asarray(a) == np.asarray(b)), key
+
+
+@pytest.mark.parametrize('partial_pixels', [True, False])
+@pytest.mark.parametrize('index', range(len(DATA_FILES)+1))
+def test_fused_matches_legacy(specs, index, partial_pixels):
+    spec = specs[index]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        fused = pyn_batch(spec, partial_pixels=partial_pixels, fused=True)
+        legacy = pyn_batch(spec, partial_pixels=partial_pixels, fused=False)
+    _assert_same(fused, legacy)
+
+
+@pytest.mark.parametrize('window_margin', [None, 10])
+@pytest.mark.parametrize('inplace', [True, False])
+@pytest.mark.parametrize('fused', [True, False])
+def test_batch_options(specs, fused, inplace, window_margin):
+    # Every combination of the pyn_batch options gives the default results.
+    spec = specs[-1]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        default = pyn_batch(spec, window_margin=window_margin)
+        spec_in = OrderedDict((kkk, np.copy(value)
+                    if isinstance(value, np.ndarray) else value)
+                    for kkk, value in spec.items())
+        out = pyn_batch(spec_in, fused=fused, inplace=inplace,
+                    window_margin=window_margin)
+
+    assert (out is spec_in) == inplace
+    _assert_same(out, default)
+
+
+def test_batch_report(specs, caplog):
+    # The report is logged at INFO by the 'pyNorm.aod' logger.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        with caplog.at_level(logging.INFO, logger='pyNorm.aod'):
+            pyn_batch(specs[-1])
+    assert len(caplog.records) == 1
+    assert 'log N = ' in caplog.records[0].getMessage()
+
+
+def test_batch_record(specs):
+    # record = True returns the Measurement of the output spec.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        out, measurement = pyn_batch(specs[-1], record=True)
+    assert isinstance(measurement, Measurement)
+    assert measurement == pyn_measurement(out)
+    _assert_same(out, pyn_batch(specs[-1]))
+
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+@pytest.mark.parametrize('verbose', [True, False])
+def test_batch_verbose(specs, verbose, capsys):
+    # The deprecated verbose keyword still works: verbose = True prints the
+    #  report as verbose_output() does.
+    logger = logging.getLogger('pyNorm.aod')
+    # The capture handlers of pytest count as configured logging.
+    handlers = logging.getLogger().handlers
+    logging.getLogger().handlers = []
+    try:
+        with pytest.deprecated_call() as record:
+            out = pyn_batch(specs[-1], verbose=verbose)
+            read_inorm(DATA_FILES[0], verbose=verbose)
+    finally:
+        logging.getLogger().handlers = handlers
+
+    # The warnings point at the caller.
+    assert [os.path.basename(w.filename) for w in record
+                if w.category is DeprecationWarning] == ['test_pyn_fused.py']*2
+
+    printed = capsys.readouterr().out
+    assert printed.count('log N = ') == (2 if verbose else 0)
+    assert logger.getEffectiveLevel() > logging.INFO
+    _assert_same(out, pyn_batch(specs[-1]))
+
+
+@pytest.mark.parametrize('partial_pixels', [True, False])
+@pytest.mark.parametrize('index', range(len(DATA_FILES)))
+def test_fused_matches_pinned(specs, index, partial_pixels):
+    # Against values from before the refactoring, which the fused and
+    #  separate passes could share a regression with.
+    pinned = PINNED[(os.path.basename(DATA_FILES[index]), partial_pixels)]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        fused = pyn_batch(specs[index], partial_pixels=partial_pixels)
+    for kkk in pinned.keys():
+        np.testing.assert_allclose(fused[kkk], pinned[kkk], rtol=1e-12,
+                                    atol=0., err_msg=kkk)
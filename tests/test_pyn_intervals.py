@@ -0,0 +1,164 @@
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+from scipy.io import readsav
+
+from pyNorm.continuum import IntervalSet, as_mask, as_intervals, \
+    convert_inorm_mask, continuum_mask
+from conftest import DATA_FILES
+# IntervalSet masks against the per-pixel boolean masks they replace: the
+#  set operations, pickling, the iNorm mask conversion and the GUI edits
+#  of the continuum ('wc') and contamination masks.
+
+
+def _grid(seed):
+    # A non-uniform increasing velocity grid
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.uniform(1., 4., 500))-750.
+
+
+def _random_set(x, seed, nint = 8):
+    # Intervals with some bounds on pixels of x, some between pixels, and
+    #  some overlapping, touching or empty.
+    rng = np.random.default_rng(seed)
+    starts = rng.uniform(x[0]-50., x[-1]+50., nint)
+    stops = starts + rng.uniform(-10., 200., nint)
+    on_pixel = rng.random(nint) < 0.5
+    starts[on_pixel] = rng.choice(x, np.sum(on_pixel))
+    stops[1] = starts[0]
+    return IntervalSet(starts, stops)
+
+
+def _old_mask(x, intervals):
+    # The per-pixel mask, one interval at a time.
+    mask = np.zeros(x.size, dtype=bool)
+    for start, stop in zip(intervals.starts, intervals.stops):
+        mask |= (x >= start) & (x <= stop)
+    return mask
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_set_operations_match_masks(seed):
+    x = _grid(seed)
+    a = _random_set(x, 2*seed)
+    b = _random_set(x, 2*seed+1)
+    ma, mb = a.to_mask(x), b.to_mask(x)
+
+    # Sorted, disjoint intervals
+    for s in [a, b, a | b, a & b, a - b]:
+        assert np.all(s.starts <= s.stops)
+        assert np.all(s.starts[1:] > s.stops[:-1])
+
+    assert np.array_equal(ma, _old_mask(x, a))
+    assert np.array_equal((a | b).to_mask(x), ma | mb)
+    assert np.array_equal((a & b).to_mask(x), ma & mb)
+    assert np.array_equal((a - b).to_mask(x), ma & ~mb)
+    assert np.array_equal((b - a).to_mask(x), mb & ~ma)
+    assert np.array_equal(a.complement().to_mask(x), ~ma)
+    assert (a - a) == IntervalSet()
+    assert (a & a) == a
+    assert (a | a) == a
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_from_mask_round_trip(seed):
+    # Any per-pixel mask survives the trip through its intervals, and the
+    #  grid need not be sorted for to_mask.
+    rng = np.random.default_rng(seed)
+    x = _grid(seed)
+    mask = rng.random(x.size) < rng.uniform(0.1, 0.9)
+    intervals = IntervalSet.from_mask(x, mask)
+    assert np.array_equal(intervals.to_mask(x), mask)
+    assert len(intervals) == np.sum(np.diff(mask.astype(int)) == 1) + mask[0]
+
+    order = rng.permutation(x.size)
+    assert np.array_equal(intervals.to_mask(x[order]), mask[order])
+
+    assert np.array_equal(as_mask(intervals, x), mask)
+    assert np.array_equal(as_mask(mask, x), mask)
+    assert as_intervals(mask, x) == intervals
+    assert as_intervals(intervals, x) is intervals
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_pickle_round_trip(seed):
+    x = _grid(seed)
+    for s in [_random_set(x, seed), IntervalSet()]:
+        out = pickle.loads(pickle.dumps(s))
+        assert out == s
+        assert np.array_equal(out.to_mask(x), s.to_mask(x))
+        assert out.starts.dtype == s.starts.dtype
+
+
+@pytest.mark.parametrize('filename', DATA_FILES)
+def test_convert_inorm_mask_matches_bool(filename):
+    # The intervals give the contin_mask_bool of the old conversion
+    #  (mask_cont == 1), for the iNorm masks and random ones.
+    data = readsav(filename)
+    vel = data['vel']
+    rng = np.random.default_rng(0)
+    masks = [rng.integers(0, 2, vel.size) for j in range(5)]
+    if np.shape(data['mask_cont']) == np.shape(vel):
+        masks.append(data['mask_cont'])
+
+    for mask in masks:
+        spec = convert_inorm_mask(OrderedDict(vel=vel, mask_cont=mask))
+        assert isinstance(spec['contin_mask'], IntervalSet)
+        assert np.array_equal(continuum_mask(spec), mask == 1)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_gui_mask_edits(seed):
+    # The edits of the continuum ('wc') and contamination masks in
+    #  Metal_Plot_pn, made on intervals, against the per-pixel edits they
+    #  replace. Clicks (float64) land on and between pixels; limits typed
+    #  in after the 'v' key are float32.
+    rng = np.random.default_rng(seed)
+    vel = _grid(seed)
+    error = np.where(rng.random(vel.size) < 0.05, 0., 0.1)
+    window = (-200., 300.)
+    wc_old = ((vel < window[0]) | (vel > window[1])) & \
+        (vel > -500) & (vel < 500) & (error != 0)
+    contam_old = np.zeros(vel.size, dtype=bool)
+    wc = IntervalSet.from_mask(vel, wc_old)
+    contam = IntervalSet()
+
+    for j in range(20):
+        clicks = np.sort(rng.uniform(vel[0]-20., vel[-1]+20., 2))
+        if rng.random() < 0.5:
+            clicks[0] = rng.choice(vel)
+            clicks = np.sort(clicks)
+        vclim = clicks
+        action = rng.integers(5)
+        if action == 4:
+            vclim = clicks.astype(np.float32)
+            action = 0
+        if action == 0:
+            # Left click, or the 'v' key: unmask [vclim[0], vclim[1]]
+            wc_old = ((vel < vclim[0]) | (vel > vclim[1])) & wc_old
+            wc = as_intervals(wc, vel).remove(vclim[0], vclim[1])
+        elif action == 1:
+            # Right click: mask the open interval (vclim[0], vclim[1])
+            wc_old = ((vel > vclim[0]) & (vel < vclim[1])) | wc_old
+            wc = as_intervals(wc, vel).add(np.nextafter(vclim[0], np.inf),
+                                            np.nextafter(vclim[1], -np.inf))
+        elif action == 2:
+            # Left click: contaminated [vclim[0], vclim[1]]
+            contam_old[(vel >= vclim[0]) & (vel <= vclim[1])] = True
+            contam = as_intervals(contam, vel).add(vclim[0], vclim[1])
+        else:
+            # Right click: clean [vclim[0], vclim[1]]
+            contam_old[(vel >= vclim[0]) & (vel <= vclim[1])] = False
+            contam = as_intervals(contam, vel).remove(vclim[0], vclim[1])
+
+        assert np.array_equal(as_mask(wc, vel), wc_old)
+        assert np.array_equal(as_mask(contam, vel), contam_old)
+
+    # Sessions keep the intervals; they pickle to the same masks, and the
+    #  fits use the same pixels.
+    wc, contam = pickle.loads(pickle.dumps((wc, contam)))
+    assert np.array_equal(as_mask(wc, vel) & (error != 0),
+                            wc_old & (error != 0))
+    assert np.array_equal(as_mask(contam, vel), contam_old)
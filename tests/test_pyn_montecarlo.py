@@ -0,0 +1,64 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from pyNorm.aod import pyn_batch, pyn_montecarlo
+from conftest import blemished_spec
+# The Monte Carlo medians and 1-sigma spreads must track the analytic
+#  column density and equivalent width errors of pyn_batch.
+
+
+NSAMPLES = 2000
+
+
+def _blemished_spec():
+    # Blemishes (eflux of 2 and -1) within the integration range
+    spec = blemished_spec(np.arange(-500., 500., 2.5), 1,
+                            large=[20, 21, 30], negative=35)
+    spec['v1'] = -450.
+    spec['v2'] = -380.
+    return spec
+
+
+def _measure(spec, partial_pixels):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        analytic = pyn_batch(spec, partial_pixels=partial_pixels)
+        mc = pyn_montecarlo(spec, partial_pixels=partial_pixels,
+                            nsamples=NSAMPLES, seed=1)
+    return analytic, mc
+
+
+def _check(analytic, mc, ncol_median):
+    # Equivalent width: linear in the flux, so the median sits on the
+    #  analytic value.
+    spread = (mc['EW_mc_err_hi']-mc['EW_mc_err_lo'])/2.
+    assert np.abs(spread/analytic['EW_err']-1.) < 0.1
+    assert np.abs(mc['EW_mc']-analytic['EW']) < 0.1*analytic['EW_err']
+
+    # Column density, compared in linear units. log(1/flux) is biased for
+    #  noisy pixels, so the median of a weak line may sit up to
+    #  ncol_median sigma off.
+    column = 10.**analytic['ncol']
+    column_err = column*(10.**analytic['ncol_err_hi'] -
+                            10.**analytic['ncol_err_lo'])/2.
+    spread = (10.**(mc['ncol_mc']+mc['ncol_mc_err_hi']) -
+                10.**(mc['ncol_mc']+mc['ncol_mc_err_lo']))/2.
+    assert np.abs(spread/column_err-1.) < 0.1
+    assert np.abs(10.**mc['ncol_mc']-column) < ncol_median*column_err
+
+
+@pytest.mark.parametrize('partial_pixels', [True, False])
+def test_montecarlo_matches_analytic(data_specs, partial_pixels):
+    for spec in data_specs:
+        analytic, mc = _measure(spec, partial_pixels)
+        _check(analytic, mc, ncol_median=0.75)
+
+
+def test_montecarlo_blemishes():
+    # The blemish flags must not be taken as the flux errors.
+    analytic, mc = _measure(_blemished_spec(), True)
+    assert analytic['flag_blemish']
+    spread = (mc['EW_mc_err_hi']-mc['EW_mc_err_lo'])/2.
+    assert np.abs(spread/analytic['EW_err']-1.) < 0.1
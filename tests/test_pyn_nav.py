@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+
+from pyNorm.aod import nav_rebin, nav_common_grid, pyn_nav_saturation
+from conftest import absorber_spec
+# nav_rebin conserves the integral of a profile and propagates the
+#  variance of partial pixels as var*p**2; pyn_nav_saturation compares
+#  each absorber's transitions on a grid of their own.
+
+
+def _pixel_edges(vel):
+    # Pixel edges as nav_rebin takes them: midpoints, half a pixel beyond
+    #  the ends.
+    mid = (vel[1:]+vel[:-1])/2.
+    return np.concatenate([[vel[0]-(vel[1]-vel[0])/2.], mid,
+                            [vel[-1]+(vel[-1]-vel[-2])/2.]])
+
+
+@pytest.fixture(scope='module')
+def profile():
+    rng = np.random.default_rng(4)
+    vel = np.cumsum(rng.uniform(1.5, 4., 300))-400.
+    y = rng.uniform(0., 5., vel.size)
+    y_err = rng.uniform(0.1, 1., vel.size)
+    return vel, y, y_err
+
+
+def test_rebin_conserves_integral(profile):
+    vel, y, y_err = profile
+    pix_edges = _pixel_edges(vel)
+    integral = np.sum(y*np.diff(pix_edges))
+
+    # Bins of any width, some narrower than a pixel, covering the spectrum
+    rng = np.random.default_rng(5)
+    edges = np.sort(np.concatenate([pix_edges[[0, -1]],
+                    rng.uniform(pix_edges[0], pix_edges[-1], 97)]))
+    y_bin, y_bin_err, covered = nav_rebin(vel, y, y_err, edges)
+    assert covered.all()
+    np.testing.assert_allclose(np.sum(y_bin[0]*np.diff(edges)), integral,
+                                rtol=1e-12)
+
+    # A single bin over part of the spectrum: the whole pixels inside it
+    #  plus the covered parts of the two edge pixels.
+    lo, hi = vel[40]+0.3, vel[200]-0.2
+    y_bin, y_bin_err, covered = nav_rebin(vel, y, y_err, [lo, hi])
+    inner = np.sum(y[41:200]*np.diff(pix_edges)[41:200])
+    expected = inner + y[40]*(pix_edges[41]-lo) + y[200]*(hi-pix_edges[200])
+    np.testing.assert_allclose(y_bin[0,0]*(hi-lo), expected, rtol=1e-12)
+
+
+def test_rebin_partial_pixel_variance(profile):
+    vel, y, y_err = profile
+    pix_edges = _pixel_edges(vel)
+    width = np.diff(pix_edges)
+    var = y_err**2
+
+    # A bin within one pixel keeps that pixel's error: var*p**2/p**2.
+    lo = pix_edges[50]+0.2*width[50]
+    hi = pix_edges[50]+0.7*width[50]
+    y_bin, y_bin_err, covered = nav_rebin(vel, y, y_err, [lo, hi])
+    np.testing.assert_allclose(y_bin_err[0,0], y_err[50], rtol=1e-12)
+
+    # A bin over parts p1, p2 of two neighbouring pixels:
+    #  var1*p1**2 + var2*p2**2 over the bin width squared.
+    lo = pix_edges[60]+0.25*width[60]
+    hi = pix_edges[61]+0.6*width[61]
+    p1 = pix_edges[61]-lo
+    p2 = hi-pix_edges[61]
+    y_bin, y_bin_err, covered = nav_rebin(vel, y, y_err, [lo, hi])
+    np.testing.assert_allclose(y_bin_err[0,0],
+        np.sqrt(var[60]*p1**2+var[61]*p2**2)/(hi-lo), rtol=1e-12)
+
+    # And whole pixels in between add var*width**2.
+    hi = pix_edges[64]+0.6*width[64]
+    p2 = hi-pix_edges[64]
+    y_bin, y_bin_err, covered = nav_rebin(vel, y, y_err, [lo, hi])
+    total = var[60]*p1**2 + np.sum(var[61:64]*width[61:64]**2) + \
+        var[64]*p2**2
+    np.testing.assert_allclose(y_bin_err[0,0], np.sqrt(total)/(hi-lo),
+                                rtol=1e-12)
+
+
+def _nav_spec(vel, nav, ion, wavc, fval, target):
+    spec = absorber_spec(vel, np.ones(vel.size), np.full(vel.size, 0.01),
+                            ion=ion, wavc=wavc, fval=fval, v1=-50., v2=50.)
+    spec['targname'] = target
+    spec['redshift'] = 0.
+    spec['Nav'] = nav
+    spec['Nav_err'] = 0.05*nav+1e10
+    return spec
+
+
+def test_grid_per_group():
+    # A coarse, wide spectrum of another absorber must not change the
+    #  grid of a fine doublet, which covers only their overlap.
+    vel_a = np.arange(-300., 300., 2.)
+    vel_b = np.arange(-200., 400., 2.5)
+    vel_c = np.arange(-3000., 3000., 20.)
+    nav = lambda vel: 1e12*np.exp(-0.5*(vel/20.)**2)
+    specs = [_nav_spec(vel_a, 0.5*nav(vel_a), 'CIV', 1548.2, 0.19, 'A'),
+             _nav_spec(vel_b, nav(vel_b), 'CIV', 1550.8, 0.095, 'A'),
+             _nav_spec(vel_c, nav(vel_c), 'CIV', 1548.2, 0.19, 'B'),
+             _nav_spec(vel_c, nav(vel_c), 'CIV', 1550.8, 0.095, 'B')]
+
+    results = pyn_nav_saturation(specs)
+    assert list(results['strong']) == [0, 2]
+    assert list(results['weak']) == [1, 3]
+
+    edges = nav_common_grid([vel_a, vel_b])
+    np.testing.assert_allclose(np.diff(edges), 2.5)
+    assert (edges[0] >= vel_b[0]) and (edges[-1] <= vel_a[-1]+2.5)
+    np.testing.assert_allclose(results['vel'][0],
+                                (edges[1:]+edges[:-1])/2.)
+    np.testing.assert_allclose(np.diff(results['vel'][1]), 20.)
+
+    # The strong line of the first doublet has half the weak line's
+    #  Na(v), as if saturated: flagged. The second doublet agrees.
+    assert list(results['flag_sat']) == [True, False]
+    assert results['ratio'][0].shape == results['vel'][0].shape
+
+
+def test_no_overlap():
+    vel_a = np.arange(-300., 0., 2.)
+    vel_b = np.arange(10., 300., 2.)
+    specs = [_nav_spec(vel_a, np.ones(vel_a.size), 'CIV', 1548.2, 0.19, 'A'),
+             _nav_spec(vel_b, np.ones(vel_b.size), 'CIV', 1550.8, 0.095, 'A')]
+    results = pyn_nav_saturation(specs)
+    assert results['vel'][0].size == 0
+    assert not results['flag_sat'][0]
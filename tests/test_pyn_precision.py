@@ -0,0 +1,90 @@
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+from pyNorm.aod import pyn_batch, precision
+from conftest import DATA_FILES, read_data_spec, absorber_spec
+# float32 storage must stay within the bounds quoted in pyn_precision.py
+#  for genuinely float64 spectra, measured both ways: the spectra in
+#  docs/Data (stored as float32) perturbed below float32 resolution, and
+#  synthetic noisy absorbers.
+
+
+NSYNTHETIC = 40
+
+
+def _synthetic_spec(seed):
+    # A Gaussian absorber (optical depth 0.1-2.5) on a sloped continuum in
+    #  flux units, with S/N 8-80 and a random pixel grid.
+    rng = np.random.default_rng(seed)
+    vel = np.arange(-600., 600., rng.uniform(1.5, 7.))+rng.uniform(0., 1.)
+    depth = rng.uniform(0.1, 2.5)
+    bvalue = rng.uniform(8., 40.)
+    vcenter = rng.uniform(-50., 50.)
+    snr = rng.uniform(8., 80.)
+
+    contin = 1e-14*(1.+0.05*vel/600.)
+    flux = contin*np.exp(-depth*np.exp(-0.5*((vel-vcenter)/bvalue)**2))
+    eflux = contin/snr*np.sqrt(flux/contin+0.05)
+    flux = flux+rng.normal(0., 1., vel.size)*eflux
+    return absorber_spec(vel, flux, eflux, contin=contin,
+                v1=vcenter-2.5*bvalue-rng.uniform(0., 5.),
+                v2=vcenter+2.5*bvalue+rng.uniform(0., 5.))
+
+
+@pytest.fixture(scope='module',
+                params=DATA_FILES+list(range(NSYNTHETIC)),
+                ids=[os.path.basename(name) for name in DATA_FILES] + \
+                    ['synthetic{0}'.format(j) for j in range(NSYNTHETIC)])
+def spec(request):
+    if isinstance(request.param, str):
+        # Relative perturbations of up to 3e-8 (float32 resolves 6e-8) so
+        #  that float32 storage actually rounds the data.
+        return read_data_spec(request.param, float64=True, perturb=3e-8)
+    return _synthetic_spec(request.param)
+
+
+@pytest.fixture(scope='module', params=[True, False],
+                ids=['partial', 'whole'])
+def measured(request, spec):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        spec64 = pyn_batch(spec, partial_pixels=request.param)
+        with precision('float32'):
+            spec32 = pyn_batch(spec, partial_pixels=request.param)
+    return spec64, spec32
+
+
+def test_float32_storage(measured):
+    spec64, spec32 = measured
+    assert spec64['flux'].dtype == np.float64
+    assert spec32['flux'].dtype == np.float32
+    assert spec32['Nav'].dtype == np.float32
+    assert spec32['vel'].dtype == np.float64
+
+
+def test_column_density(measured):
+    spec64, spec32 = measured
+    for kkk in ['ncol', 'ncol_err_lo', 'ncol_err_hi']:
+        assert np.abs(spec32[kkk]-spec64[kkk]) < 1e-6, kkk
+
+
+def test_equivalent_width(measured):
+    spec64, spec32 = measured
+    for kkk in ['EW', 'EW_err', 'EW_err_stat', 'EW_err_cont', 'EW_err_zero']:
+        assert np.abs(spec32[kkk]/spec64[kkk]-1.) < 2e-6, kkk
+
+
+def test_velocity_moments(measured):
+    spec64, spec32 = measured
+    for kkk in ['va', 'ba']:
+        assert np.abs(spec32[kkk]-spec64[kkk]) < 1e-4, kkk
+    assert np.abs(spec32['m3']-spec64['m3']) < 1e-3
+
+
+def test_velocity_extent(measured):
+    spec64, spec32 = measured
+    for kkk in ['dv90', 'v90a', 'v90b']:
+        assert spec32[kkk] == spec64[kkk], kkk
@@ -0,0 +1,115 @@
+import pickle
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from pyNorm.aod import pyn_batch
+from pyNorm.io import Spectrum, read_inorm
+from pyNorm.io import pyn_spectrum
+from conftest import DATA_FILES
+# Spectrum must convert to and from the OrderedDict spec and pickle
+#  without loss, and measure as the dictionary does.
+
+
+def _pickled(spec):
+    return pickle.loads(pickle.dumps(spec))
+
+
+def _assert_identical(a, b):
+    # Same keys in the same order, with values of the same type, dtype
+    #  and value.
+    assert list(a.keys()) == list(b.keys())
+    for kkk in a.keys():
+        x, y = a[kkk], b[kkk]
+        assert type(x) is type(y), kkk
+        if isinstance(x, np.ndarray):
+            assert x.dtype == y.dtype, kkk
+            np.testing.assert_array_equal(x, y, err_msg=kkk)
+        elif isinstance(x, (float, np.floating)) and np.isnan(x):
+            assert np.isnan(y), kkk
+        else:
+            assert np.all(x == y), kkk
+
+
+@pytest.fixture(scope='module', params=DATA_FILES)
+def spec(request):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return read_inorm(request.param)
+
+
+def test_round_trip(spec):
+    packed = Spectrum.from_dict(spec)
+    _assert_identical(packed.to_dict(), spec)
+    # numpy unpickles big-endian (readsav) arrays in native byte order, so
+    #  against the pickled dictionary.
+    _assert_identical(_pickled(packed).to_dict(), _pickled(spec))
+
+    # The pixel arrays share one block per dtype; the measurements sit in
+    #  slots.
+    pixels = [value for value in spec.values()
+                if isinstance(value, np.ndarray) and
+                    (value.shape == spec['vel'].shape)]
+    assert len(packed._pixels) == len(set(value.dtype for value in pixels))
+    assert len(packed._index) == len(pixels)
+    assert packed.ncol == spec['ncol']
+
+
+def test_reader_returns_spectrum():
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        spec = read_inorm(DATA_FILES[0])
+        packed = read_inorm(DATA_FILES[0], spectrum=True)
+    assert isinstance(packed, Spectrum)
+    _assert_identical(packed.to_dict(), spec)
+
+
+def test_batch_on_spectrum(spec):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        out = pyn_batch(Spectrum.from_dict(spec))
+        expected = pyn_batch(spec)
+    assert isinstance(out, Spectrum)
+    _assert_identical(out.to_dict(), expected)
+
+
+def test_replace_and_delete(spec):
+    packed = Spectrum.from_dict(spec)
+    old_flux = packed['flux']
+    flux = spec['flux']*2.
+    packed['flux'] = flux
+    del packed['eflux']
+    packed['Nav'] = 1.
+
+    # As for a dict: the old array is untouched and the key order kept.
+    expected = OrderedDict(spec)
+    expected['flux'] = flux
+    del expected['eflux']
+    expected['Nav'] = 1.
+    np.testing.assert_array_equal(old_flux, spec['flux'])
+    _assert_identical(packed.to_dict(), expected)
+
+    # Freed rows are not pickled, and never outnumber the live ones.
+    state = packed.__getstate__()
+    assert all(None not in block_keys for block_keys in state[1])
+    _assert_identical(_pickled(packed).to_dict(), _pickled(expected))
+
+    keys = [kkk for kkk in list(packed.keys())
+                if kkk in packed._index and kkk != 'vel']
+    for kkk in keys:
+        packed[kkk] = np.zeros(np.size(spec['vel']))
+        nfree = sum(block_keys.count(None)
+                        for block_keys in packed._pixel_keys)
+        nrows = sum(len(block_keys) for block_keys in packed._pixel_keys)
+        assert 2*nfree <= nrows
+
+
+def test_layouts_bounded():
+    # Each new structure adds a layout; the shared cache stays bounded.
+    vel = np.arange(10.)
+    for j in range(2*pyn_spectrum._LAYOUTS.maxsize):
+        packed = Spectrum(vel=vel, **{'key{0}'.format(j): vel})
+        assert packed['key{0}'.format(j)] is not None
+    assert len(pyn_spectrum._LAYOUTS) <= pyn_spectrum._LAYOUTS.maxsize
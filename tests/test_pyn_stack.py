@@ -0,0 +1,56 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from pyNorm.aod import pyn_batch, pyn_stack, stack_spectra
+from conftest import DATA_FILES, read_data_spec, absorber_spec
+# Each row of pyn_stack must reproduce pyn_batch on that spectrum alone,
+#  for the ragged (padded) docs/Data spectra and a saturated transition.
+
+
+def _saturated_spec():
+    # A Gaussian absorber whose core is black: zero and negative fluxes.
+    rng = np.random.default_rng(2)
+    vel = np.arange(-400., 400., 3.)
+    flux = np.exp(-4.*np.exp(-0.5*((vel+10.)/20.)**2)) + \
+        rng.normal(0., 0.02, vel.size)
+    flux[np.abs(vel+10.) < 12.] = -0.01
+    flux[np.argmin(np.abs(vel+10.))] = 0.
+    return absorber_spec(vel, flux, np.full(vel.size, 0.02), ion='CII',
+                wni='1334.5', wavc=1334.5323, fval=0.1278, v1=-80., v2=62.5)
+
+
+@pytest.fixture(scope='module')
+def specs():
+    # The stack is float64; the docs/Data fluxes are float32, which
+    #  pyn_batch would keep.
+    return [read_data_spec(filename, float64=True)
+                for filename in DATA_FILES] + [_saturated_spec()]
+
+
+@pytest.mark.parametrize('partial_pixels', [True, False])
+def test_stack_matches_batch(specs, partial_pixels):
+    stack = stack_spectra(specs)
+    # The spectra have different lengths, so all but one row is padded.
+    assert np.sum(~stack['valid'].all(axis=1)) == len(specs)-1
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        results = pyn_stack(partial_pixels=partial_pixels, **stack)
+        singles = [pyn_batch(spec, partial_pixels=partial_pixels,
+                            blemish_correction=False) for spec in specs]
+
+    assert singles[-1]['flag_sat']
+    for j, single in enumerate(singles):
+        nn = np.size(single['vel'])
+        for kkk in results.keys():
+            value = results[kkk][j]
+            if np.ndim(value) > 0:
+                # Per-pixel outputs; the padding carries no weight.
+                value = value[:nn]
+                if kkk == 'integration_weights':
+                    assert np.all(results[kkk][j,nn:] == 0.)
+            np.testing.assert_allclose(value, single[kkk], rtol=1e-10,
+                        atol=0., equal_nan=True,
+                        err_msg='{0} row {1}'.format(kkk, j))
@@ -0,0 +1,72 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from pyNorm.aod import AODSweep, pyn_column, pyn_eqwidth
+from conftest import DATA_FILES, read_data_spec
+# AODSweep queries must give pyn_column and pyn_eqwidth over the same
+#  integration limits.
+
+
+COLUMN_KEYS = ['ncol', 'ncol_err_lo', 'ncol_err_hi', 'flag_sat']
+EQWIDTH_KEYS = ['EW', 'EW_err', 'EW_err_stat', 'EW_err_cont', 'EW_err_zero',
+                'detection_2sig', 'detection_3sig']
+
+
+def _limits(spec):
+    # Ranges around the integration range of the file, with edges that
+    #  fall inside pixels.
+    v1, v2 = float(spec['v1']), float(spec['v2'])
+    return [(v1, v2), (v1-17.3, v2+4.1), (v1+3.7, v2-11.9),
+            (v1-150.2, v1+0.4)]
+
+
+@pytest.fixture(scope='module', params=DATA_FILES)
+def spec(request):
+    return read_data_spec(request.param, float64=True)
+
+
+def _single(spec, v1, v2, partial_pixels):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        column = pyn_column(spec, [v1, v2], partial_pixels=partial_pixels)
+        eqwidth = pyn_eqwidth(spec, [v1, v2],
+                                partial_pixels=partial_pixels)
+    return column, eqwidth
+
+
+def _assert_close(a, b, key):
+    np.testing.assert_allclose(np.asarray(a, dtype=float),
+                    np.asarray(b, dtype=float), rtol=1e-9, atol=1e-12,
+                    err_msg=key)
+
+
+@pytest.mark.parametrize('partial_pixels', [True, False])
+def test_sweep_matches_single(spec, partial_pixels):
+    sweep = AODSweep(spec, partial_pixels=partial_pixels)
+    for v1, v2 in _limits(spec):
+        column, eqwidth = _single(spec, v1, v2, partial_pixels)
+        out = sweep.column(v1, v2)
+        for kkk in COLUMN_KEYS:
+            _assert_close(out[kkk], column[kkk], kkk)
+        out = sweep.eqwidth(v1, v2)
+        for kkk in EQWIDTH_KEYS:
+            _assert_close(out[kkk], eqwidth[kkk], kkk)
+
+
+@pytest.mark.parametrize('partial_pixels', [True, False])
+def test_sweep_grid(spec, partial_pixels):
+    sweep = AODSweep(spec, partial_pixels=partial_pixels)
+    v1 = float(spec['v1'])+np.array([-20.3, -5.1, 0., 6.6])
+    v2 = float(spec['v2'])+np.array([-7.2, 0., 12.8])
+    grid = sweep.grid(v1, v2)
+    assert grid['ncol'].shape == (v1.size, v2.size)
+
+    for j in range(v1.size):
+        for k in range(v2.size):
+            column, eqwidth = _single(spec, v1[j], v2[k], partial_pixels)
+            for kkk in COLUMN_KEYS:
+                _assert_close(grid[kkk][j,k], column[kkk], kkk)
+            for kkk in EQWIDTH_KEYS:
+                _assert_close(grid[kkk][j,k], eqwidth[kkk], kkk)
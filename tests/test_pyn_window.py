@@ -0,0 +1,154 @@
+import time
+import warnings
+
+import numpy as np
+import pytest
+
+from pyNorm.aod import pyn_batch
+from conftest import DATA_FILES, blemished_spec
+# pyn_batch on a window around the integration range (window_margin) must
+#  give the same measurements whatever the margin, and those of the full
+#  grid where the spacing over the integration range is the grid's.
+
+
+# Per-pixel outputs, which are only computed over the window
+PIXEL_OUTPUTS = ['EW_cumulative', 'Nav', 'Nav_err', 'Nav_sat',
+                    'integration_weights']
+NONUNIFORM = len(DATA_FILES)+1
+
+
+@pytest.fixture(scope='module')
+def specs(data_specs):
+    # Gaussian absorbers with blemished pixels, without a wavelength
+    #  array: on a uniform grid and on a non-uniform one.
+    rng = np.random.default_rng(3)
+    vel = np.cumsum(rng.uniform(2., 3., 600))-900.
+    return data_specs + \
+        [blemished_spec(np.arange(-500., 500., 2.5), 1,
+                        large=[150, 151, 230], negative=190),
+         blemished_spec(vel, 3, large=[300, 301, 345], negative=330)]
+
+
+def _batch(spec, **kwargs):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return pyn_batch(spec, **kwargs)
+
+
+def _assert_close(a, b, kkk, rtol = 1e-12):
+    if isinstance(b, (np.ndarray, float, np.floating)) and \
+        np.issubdtype(np.asarray(b).dtype, np.number):
+        np.testing.assert_allclose(a, b, rtol=rtol, atol=rtol,
+                                    equal_nan=True, err_msg=kkk)
+    else:
+        assert np.all(np.asarray(a) == np.asarray(b)), kkk
+
+
+@pytest.mark.parametrize('partial_pixels', [True, False])
+@pytest.mark.parametrize('window_margin', [0, 5, 50, 200])
+@pytest.mark.parametrize('index', range(len(DATA_FILES)+2))
+def test_window_matches_full_grid(specs, index, window_margin,
+                                    partial_pixels):
+    spec = specs[index]
+    if partial_pixels and (index == NONUNIFORM):
+        pytest.skip('partial pixel weights use the spacing of the window')
+
+    full = _batch(spec, partial_pixels=partial_pixels)
+    window = _batch(spec, partial_pixels=partial_pixels,
+                    window_margin=window_margin, window_scatter=True)
+
+    start, stop = window.pop('pixel_window')
+    assert list(window.keys()) == list(full.keys())
+
+    # The docs/Data grids are uniform to 0.5%, so the window spacing
+    #  differs slightly from that of the full grid.
+    rtol = 1e-12
+    if partial_pixels and (index < len(DATA_FILES)):
+        rtol = 1e-3
+
+    npix = len(full['vel'])
+    outside = np.ones(npix, dtype=bool)
+    outside[start:stop] = False
+    for kkk in full.keys():
+        a, b = window[kkk], full[kkk]
+        if kkk in PIXEL_OUTPUTS:
+            # Same length as the full grid; outside the window the weights
+            #  (and so the measurements) are zero.
+            assert np.shape(a) == np.shape(b), kkk
+            a, b = a[start:stop], b[start:stop]
+            if kkk == 'integration_weights':
+                assert np.all(full[kkk][outside] == 0.)
+        elif kkk in ['flux', 'eflux']:
+            # Blemishes are only repaired around the window.
+            a, b = a[start:stop], b[start:stop]
+        _assert_close(a, b, kkk, rtol)
+
+
+@pytest.mark.parametrize('partial_pixels', [True, False])
+@pytest.mark.parametrize('index', range(len(DATA_FILES)+2))
+def test_window_margin_independent(specs, index, partial_pixels):
+    spec = specs[index]
+    ref = _batch(spec, partial_pixels=partial_pixels, window_margin=0)
+    ref_start, ref_stop = ref['pixel_window']
+
+    for window_margin in [5, 50, 200]:
+        window = _batch(spec, partial_pixels=partial_pixels,
+                        window_margin=window_margin)
+        start, stop = window['pixel_window']
+        assert list(window.keys()) == list(ref.keys())
+        for kkk in ref.keys():
+            a, b = window[kkk], ref[kkk]
+            if kkk == 'pixel_window':
+                continue
+            if kkk in PIXEL_OUTPUTS or ((kkk == 'wave') and
+                                        (kkk not in spec)):
+                # Compare over the pixels of the margin-0 window.
+                a = a[ref_start-start:ref_stop-start]
+            elif kkk in ['flux', 'eflux']:
+                # Blemishes are only repaired around the window.
+                a, b = a[ref_start:ref_stop], b[ref_start:ref_stop]
+            _assert_close(a, b, kkk)
+
+
+@pytest.mark.parametrize('index', range(len(DATA_FILES)+2))
+def test_window_outputs(specs, index):
+    # By default the per-pixel outputs cover the window only; the input
+    #  arrays stay full length.
+    spec = specs[index]
+    window = _batch(spec, window_margin=10)
+    scatter = _batch(spec, window_margin=10, window_scatter=True)
+    start, stop = window['pixel_window']
+    npix = len(spec['vel'])
+
+    assert list(window.keys()) == list(scatter.keys())
+    for kkk in window.keys():
+        a, b = window[kkk], scatter[kkk]
+        if kkk in PIXEL_OUTPUTS or ((kkk == 'wave') and (kkk not in spec)):
+            assert np.shape(a) == (stop-start,), kkk
+            assert np.shape(b) == (npix,), kkk
+            b = b[start:stop]
+        elif kkk in spec and isinstance(spec[kkk], np.ndarray):
+            assert np.shape(a) == np.shape(spec[kkk]), kkk
+        _assert_close(a, b, kkk, 0.)
+
+
+@pytest.mark.benchmark
+def test_window_cost():
+    # Without blemishes to repair, the cost of a window does not grow
+    #  with the length of the spectrum. 100x more pixels must take less
+    #  than 5x the time.
+    def best_time(spec):
+        best = np.inf
+        for j in range(5):
+            start = time.perf_counter()
+            _batch(spec, window_margin=10)
+            best = min(best, time.perf_counter()-start)
+        return best
+
+    times = []
+    for npix in [10**4, 10**6]:
+        spec = blemished_spec(np.arange(npix)*2.5-500., 1, large=[],
+                                negative=[])
+        times.append(best_time(spec))
+    print('window: {0:.3g} s at 1e4 pixels, {1:.3g} s at 1e6'.format(*times))
+    assert times[1] < 5.*times[0]